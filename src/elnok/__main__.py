@@ -24,20 +24,34 @@ ELnoK. If not, see http://www.gnu.org/licenses/.
 # Call like :
 # elnok [OPTIONS...] [MATCHES...]
 # -S, --since=, -U, --until=
+# elnok sync [OPTIONS...] DATABASE [MATCHES...]
 
 import argparse
+import collections
+import functools
+import itertools
+import json
 import logging
+import os
 import re
 import sys
-from typing import Set
+import time
+from typing import Callable, Dict, Iterator, List, Set
 
-from elnok import es, output
+from elnok import cache, es, export, logfile, output, query, stats, store
 import elnok
 
 DEFAULT_OUTPUT_SHORT = "@timestamp,level,module,component,subcomponent:line,message"
+CHECKPOINT_INTERVAL = 10  # s, period between storing the progress of the search (with --resume)
+DEFAULT_INDEXED_FIELDS = "level,module,component"
+DEFAULT_CONTEXT_FIELDS = "host,path"
+CONTEXT_SEPARATOR = "--"  # Written between non-consecutive entries, with -A/-B/-C
 
 
 def main(args: list) -> int:
+    if len(args) > 1 and args[1] == "sync":
+        return main_sync(args[:1] + args[2:])
+
     # arguments handling
     parser = argparse.ArgumentParser(description="A light front-end to Logstash/Elasticsearch")
 
@@ -46,11 +60,15 @@ def main(args: list) -> int:
     parser.add_argument("--log-level", dest="loglev", metavar="<level>", type=int, choices=[0, 1, 2, 3],
                         default=0, help="Set verbosity level (0-3, default = 0) of the elnok internals")
     parser.add_argument("--host", default="localhost:9200",
-                        help="Specify the name or IP address and port of the elasticsearch server (default is localhost:9200)")
+                        help="Specify the name or IP address and port of the elasticsearch server (default is localhost:9200). "
+                             "It can be comma separated, to search on multiple servers simultaneously.")
+    parser.add_argument("--show-cluster", dest="show_cluster", action='store_true',
+                        help="Show the server each entry comes from (as first column, or as _cluster field)")
     parser.add_argument("--index", default="logstash-*",
                         help="Specify the index pattern to look into (default is logstash-*). It can be comma separated.")
     parser.add_argument("--list-fields", dest="list", action='store_true',
-                        help="List all the fields present in the index (tab separated)")
+                        help="List all the fields present in the index (tab separated). "
+                             "With several hosts, the fields of all the servers are listed.")
     parser.add_argument("--output", "-o", dest="output", default="short", choices=["short", "json"],
                         help="Controls the format of the generated output.\n "
                         "Default is short, which outputs each log on a line, tab/semicolon separated.\n "
@@ -61,14 +79,128 @@ def main(args: list) -> int:
                         help="Show entries on or newer than the given date. Format is 2012-10-30T18:17:16 or now-2d.")
     parser.add_argument("--until", "-U", dest="until",
                         help="Show entries on or before the given date. Format is 2012-10-30T18:17:16 or now-1h.")
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=1,
+                        help="Number of pages of results to download in advance, while the current one is being displayed (default is 1). "
+                             "0 disables prefetching.")
+    parser.add_argument("--parallel", dest="parallel", type=int, default=1,
+                        help="Number of parts of the search to download simultaneously (default is 1). "
+                             "Useful for large periods on servers with many shards.")
+    parser.add_argument("--page-size", dest="page_size", type=int,
+                        help="Number of log entries to download per request (1-%d). "
+                             "By default, it's adjusted automatically based on the speed of the server."
+                             % (es.MAX_PAGE_SIZE,))
+    parser.add_argument("--no-cache", dest="cache", action='store_false',
+                        help="Do not use the local cache (in %s) of the results of past periods "
+                             "(always download everything)." % (cache.get_cache_dir(),))
+    parser.add_argument("--lines", "-n", dest="lines", type=int,
+                        help="Show only the latest N entries (within the period requested).")
+    parser.add_argument("--follow", "-f", dest="follow", action='store_true',
+                        help="After showing the entries, keep waiting for new entries, and show them as they arrive.")
+    parser.add_argument("--after-context", "-A", dest="after", type=int, metavar="N",
+                        help="Also show the N entries after each entry matching, from the same host and file.")
+    parser.add_argument("--before-context", "-B", dest="before", type=int, metavar="N",
+                        help="Also show the N entries before each entry matching, from the same host and file.")
+    parser.add_argument("--context", "-C", dest="context", type=int, metavar="N",
+                        help="Same as -A N -B N.")
+    parser.add_argument("--context-fields", dest="context_fields", default=DEFAULT_CONTEXT_FIELDS,
+                        help="Fields which must be the same for the context entries (comma separated, "
+                             "default is %s)." % (DEFAULT_CONTEXT_FIELDS,))
+    aggregate = parser.add_mutually_exclusive_group()
+    aggregate.add_argument("--count", dest="count", action='store_true',
+                           help="Only show the number of entries.")
+    aggregate.add_argument("--histogram", dest="histogram", metavar="INTERVAL",
+                           help="Only show the number of entries per period of time (eg, 1h, 30m, 1d, 1M).")
+    aggregate.add_argument("--top", dest="top", metavar="FIELD",
+                           help="Only show the most frequent values of the given field, with the number of entries.")
+    parser.add_argument("--split", dest="split", metavar="FIELD",
+                        help="With --histogram, also show the number of entries per value of the given field.")
+    parser.add_argument("--top-size", dest="top_size", type=int, default=10,
+                        help="Number of values shown with --top and --split (default is 10).")
+    parser.add_argument("--resume", dest="resume", metavar="FILE",
+                        help="Regularly store the progress of the search in FILE. If FILE already exists, "
+                             "continue the search where it stopped (eg, after a crash). "
+                             "The new output should be appended to the previous one. "
+                             "FILE is deleted once the search is complete.")
+    parser.add_argument("--export", dest="export", metavar="PATH",
+                        help="Instead of showing the entries, write them (in the output format) into compressed "
+                             "files in the directory PATH, with an index of the period of each part.")
+    parser.add_argument("--export-compression", dest="export_compression", default="gzip",
+                        choices=sorted(export.COMPRESSIONS.keys()),
+                        help="Compression of the exported files (default is gzip).")
+    parser.add_argument("--export-rotate", dest="export_rotate", default="1G",
+                        help="Start a new exported file before it exceeds the given size (eg, 500M, 2G), "
+                             "or every day, with \"day\" (default is 1G).")
+    parser.add_argument("--export-workers", dest="export_workers", type=int,
+                        help="Number of processes compressing the exported files (default is the number of CPUs).")
+    parser.add_argument("--stats", dest="stats", action='store_true',
+                        help="At the end, show on stderr statistics about the time spent in each step of the processing. "
+                             "When downloading in parallel or in advance, the time of the steps overlap.")
+    parser.add_argument("--local", dest="local", metavar="DATABASE",
+                        help="Search the entries stored in DATABASE (by elnok sync), instead of the server.")
+    parser.add_argument("--include-file", dest="include_files", metavar="PATH", action="append", default=[],
+                        help="Also show the entries of the log file PATH (eg, /var/log/odemis.log), "
+                             "which are not yet on the server. Can be passed multiple times.")
     parser.add_argument("matches", nargs="*",
-                        help="Filter the output to only the fields that match")
+                        help="Filter the output to only the fields that match. Format is field=value, "
+                             "field!=value (exclude), field~regex, or field!~regex. Values can contain * and ? wildcards. "
+                             "If the same field is passed multiple times, any of the values can match.")
     parser.add_argument("--username", "-u", type=str, default="elastic",
                         help="The Elasticsearch username (default is elastic).")
     parser.add_argument("--password", "-p", type=str, default="",
                         help="The Elasticsearch username's password (default is an empty string).")
 
     options = parser.parse_args(args[1:])
+    if options.prefetch < 0:
+        parser.error("--prefetch must be positive or 0")
+    if options.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if options.page_size is not None and not 1 <= options.page_size <= es.MAX_PAGE_SIZE:
+        parser.error("--page-size must be between 1 and %d" % (es.MAX_PAGE_SIZE,))
+    if options.follow and options.until:
+        parser.error("--follow cannot be used with --until")
+    if options.lines is not None and options.lines < 0:
+        parser.error("--lines must be positive or 0")
+    aggregation = options.count or options.histogram or options.top
+    if aggregation and (options.follow or options.lines is not None):
+        parser.error("--count, --histogram and --top cannot be used with --follow or --lines")
+    if options.split and not options.histogram:
+        parser.error("--split can only be used with --histogram")
+    if options.resume and (aggregation or options.follow or options.lines is not None):
+        parser.error("--resume cannot be used with --count, --histogram, --top, --follow or --lines")
+    # Number of entries before and after each entry matching
+    before = options.before if options.before is not None else (options.context or 0)
+    after = options.after if options.after is not None else (options.context or 0)
+    if before < 0 or after < 0:
+        parser.error("-A, -B and -C must be positive or 0")
+    context = before > 0 or after > 0
+    if context and (aggregation or options.follow or options.resume or options.lines is not None or options.local):
+        parser.error("-A, -B and -C cannot be used with --count, --histogram, --top, --follow, --resume, --lines or --local")
+    if options.export and (aggregation or options.follow or options.resume or context or options.list):
+        parser.error("--export cannot be used with --count, --histogram, --top, --follow, --resume, "
+                     "-A, -B, -C or --list-fields")
+    try:
+        export_max_size, export_daily = export.parse_rotation(options.export_rotate)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if options.export_workers is not None and options.export_workers < 1:
+        parser.error("--export-workers must be at least 1")
+    hosts = [h.strip() for h in options.host.split(",") if h.strip()]
+    if not hosts:
+        parser.error("--host must contain at least one server")
+    if len(hosts) > 1 and (aggregation or options.follow or options.resume or context):
+        parser.error("--count, --histogram, --top, --follow, --resume, -A, -B and -C can only be used with a single --host")
+    if options.local and (aggregation or options.follow or options.resume or options.list or options.show_cluster):
+        parser.error("--local cannot be used with --count, --histogram, --top, --follow, --resume, "
+                     "--list-fields or --show-cluster")
+    if options.include_files and (aggregation or options.follow or options.resume or context):
+        parser.error("--include-file cannot be used with --count, --histogram, --top, --follow, --resume, "
+                     "-A, -B or -C")
+    if options.local and not os.path.exists(options.local):
+        parser.error("--local database %s doesn't exist, use elnok sync to create it" % (options.local,))
+    try:
+        conditions = [query.parse_match(m) for m in options.matches]
+    except ValueError as ex:
+        parser.error(str(ex))
 
     # Cannot use the internal feature, because it doesn't support multiline
     if options.version:
@@ -78,27 +210,46 @@ def main(args: list) -> int:
         return 0
 
     # Set up logging before everything else
-    loglev_names = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
-    loglev = loglev_names[options.loglev]
-
-    # change the log format to be more descriptive
-    logging.basicConfig(level=loglev, format='%(asctime)s (%(module)s) %(levelname)s: %(message)s')
-
+    set_up_logging(options.loglev)
+
+    collector = None
+    if options.stats:
+        collector = stats.Collector()
+        stats.subscribe(collector)
+
+    position = None  # Progress of the search, when it can be resumed
+    search_desc = None
+
+    # A single connection to each server, reused for all the requests
+    clients = []
+    if not options.local:  # The servers are not used with the local store
+        clients = [es.Client(h, options.username, options.password, max_connections=max(10, options.parallel))
+                   for h in hosts]
+    client = clients[0] if clients else None  # For the actions which only use one server
+    # The server of each hit is shown (as a column, or in the json output)
+    cluster_requested = (options.show_cluster or
+                         output.CLUSTER_FIELD in re.split("[,:]", options.fields or ""))
+    # If several servers, the hits are merged and tagged with the server
+    multi = len(clients) > 1 or cluster_requested
+    local_store = store.Store(options.local) if options.local else None
+    log_files = []
+    exporter = None
     try:
+        for p in options.include_files:
+            try:
+                log_files.append(logfile.LogFile(p))
+            except OSError as ex:
+                logging.error("Failed to open %s: %s", p, ex)
+                return 1
+
         if options.list:
-            fields_names = es.list_fields(options.host, options.index, options.username, options.password)
+            # As for the check of the fields, a field is listed if any of the servers has it
+            fields_names = set()
+            for c in clients:
+                fields_names.update(c.list_fields(options.index))
             print("\t".join(sorted(fields_names)))
             return 0
 
-        # Convert matches from field=value to a dict field -> value
-        matches = {}
-        for m in options.matches:
-            field, value = m.split("=")
-            # TODO: support multiple times the same field (as a OR)
-            if field in matches:
-                raise ValueError("Cannot pass multiple matches on the same field (%s)" % (field,))
-            matches[field] = value
-
         # Create the set of fields to retrieve
         if options.fields is None:
             # Pick different default fields based on output format
@@ -108,7 +259,8 @@ def main(args: list) -> int:
 
         fields = None  # all
         if options.fields:
-            fields = set(f for f in re.split("[,:]", options.fields) if f)
+            # The cluster is not a real field, so it's not requested
+            fields = set(f for f in re.split("[,:]", options.fields) if f) - {output.CLUSTER_FIELD}
 
         logging.debug("Selected fields are: %s", fields)
 
@@ -131,57 +283,493 @@ def main(args: list) -> int:
                     fields_fmt.append("{%s}" % (p,))
 
             fields_fmt = "".join(fields_fmt)
+            if options.show_cluster and "{%s}" % (output.CLUSTER_FIELD,) not in fields_fmt:
+                fields_fmt = "{%s}\t%s" % (output.CLUSTER_FIELD, fields_fmt)
 
         logging.debug("Field format: %s", fields_fmt)
 
+        # Check all the fields requested exist, before running the (potentially long) search
+        fields_available = {}
+        match_fields = {c.field for c in conditions}
+        requested_fields = match_fields | (fields or set())
+        if aggregation:  # Output fields are not used, but the aggregation fields are
+            requested_fields = match_fields | {f for f in (options.top, options.split) if f}
+        context_fields = [f for f in options.context_fields.split(",") if f] if context else []
+        if local_store:
+            # Only the names are known, which is sufficient for the local matches
+            fields_available = dict.fromkeys(local_store.list_fields(), "")
+            if not fields_available:  # Empty store => nothing to check
+                requested_fields = set()
+        elif requested_fields or context_fields:
+            # A field is fine as long as one of the servers has it.
+            # The context fields are optional, but should be in the (cached) mapping if they exist.
+            for c in clients:
+                fields_available.update(get_field_types(c, options.index, requested_fields | set(context_fields),
+                                                        options.cache))
+        if requested_fields:
+            wrong_fields = requested_fields - fields_available.keys()
+            if wrong_fields:
+                logging.error("These fields do not exists: %s", ", ".join(sorted(wrong_fields)))
+                return 1
+
+        # Convert the matches to a query for the server, and (rarely) a local filter
+        if options.local:  # The store evaluates all the matches itself
+            matches, hit_filter = [], None
+        else:
+            # The aggregations are only computed by the server
+            matches, hit_filter = query.plan(conditions, fields_available, check_long=not aggregation)
+        if hit_filter:
+            if aggregation:
+                logging.error("Matches on %s cannot be evaluated by the server, so cannot be used with "
+                              "--count, --histogram or --top", ", ".join(sorted(hit_filter.fields)))
+                return 1
+            if fields is not None:  # The filter needs the values of the fields
+                fields = fields | hit_filter.fields
+
+        # The context is defined by the exact value of the fields
+        context_query_fields = {}
+        for f in context_fields:
+            if f in fields_available:
+                context_query_fields[f] = es.get_aggregatable_field(f, fields_available)
+            else:
+                logging.warning("Field %s is not present, so not used for the context", f)
+        if context and fields is not None:
+            fields = fields | context_query_fields.keys()
+        # The entries of the files already on the server are recognized by their message
+        file_fields = fields
+        if log_files and fields is not None:
+            fields = fields | {"message"}
+
+        if aggregation:
+            print_aggregation(client, options, matches, fields_available)
+            return 0
+
+        # For the short output, the server directly formats the timestamp,
+        # which saves parsing it for every hit.
+        timestamp_format = None
         if options.output == "short":
-            print_output = output.print_hit
+            if (fields is not None and output.TIMESTAMP_FIELD in fields and not options.local and
+                not log_files and not (hit_filter and output.TIMESTAMP_FIELD in hit_filter.fields)):
+                timestamp_format = output.ES_TIME_FMT
+            render = output.Renderer(fields_fmt, server_timestamp=bool(timestamp_format))
         elif options.output == "json":
-            print_output = output.print_json_raw
+            render = output.render_json_raw_cluster if cluster_requested else output.render_json_raw
         else:
             raise ValueError("Unknown output %s" % options.output)
 
-        no_matches = True
-        hit_fields: Set[str] = set()  # all the fields returned by the search
-        for hit in es.search(options.host, options.index, options.username, options.password, match=matches, since=options.since, until=options.until, fields=fields):
-            no_matches = False
-            hit_fields.update(hit.get("_source", {}).keys())
-            print_output(hit, fields_fmt)
-
-        # If one of the fields to output was *never* returned, it might be that
-        # there is a mistake in the field names to output. As it's easy to check,
-        # we do it and report a error in this case.
-        logging.debug("hit fields = %s, vs %s", hit_fields, fields)
-        if fields:
-            always_empty_fields = fields - hit_fields
-            logging.debug("empty fields = %s", always_empty_fields)
-            if always_empty_fields:
-                fields_available = set(es.list_fields(options.host, options.index, options.username, options.password))
-                wrong_fields = always_empty_fields - fields_available
-                if wrong_fields:
-                    logging.error("These fields do not exists: %s", ", ".join(sorted(wrong_fields)))
+        follower = None
+        if options.follow:
+            follower = es.Follower(client, options.index, match=matches, fields=fields,
+                                   timestamp_format=timestamp_format)
+        # When following, the hits are deduplicated based on their _id
+        hit_kwargs = dict(timestamp_format=timestamp_format, keep_id=bool(follower))
+
+        writer = output.BatchWriter(sys.stdout)
+        write, flush = writer.write, writer.flush
+        if options.export:
+            # Created before the search, as it starts the compression processes
+            try:
+                exporter = export.Exporter(options.export, options.export_compression, export_max_size,
+                                           export_daily, options.export_workers,
+                                           suffix=".ndjson" if options.output == "json" else ".log")
+            except ValueError as ex:
+                logging.error("%s", ex)
+                return 1
+            export_write = exporter.write
+        if collector:
+            render = collector.timed("formatting", render)
+            write = collector.timed("writing", write)
+            flush = collector.timed("writing", flush)
+            if exporter:
+                export_write = collector.timed("writing", export_write)
+        # The entries are passed in batches, which is more efficient than one at a time
+        separator = False  # If True, the batches are separated in the output
+        if local_store:
+            try:
+                if options.lines is None:
+                    hits = local_store.search(conditions, since=options.since, until=options.until, fields=fields)
+                    batches = es.batched(hits, es.MERGE_BATCH_SIZE)
+                else:
+                    batches = [local_store.search_last(options.lines, conditions, since=options.since,
+                                                       until=options.until, fields=fields)]
+            except ValueError as ex:  # Date not supported
+                logging.error("%s", ex)
+                return 1
+        elif context:
+            # Each group of context is a batch
+            batches = client.search_context(options.index, context_query_fields, before, after,
+                                            match=matches, since=options.since, until=options.until,
+                                            fields=fields, hit_filter=hit_filter, prefetch=options.prefetch,
+                                            parallel=options.parallel, page_size=options.page_size,
+                                            timestamp_format=timestamp_format)
+            if multi:
+                batches = es.tag_batches(batches, client.host)
+            # Separators would make the JSON output invalid
+            separator = options.output == "short"
+            hit_filter = None  # Only applies to the entries matching, not to their context
+        elif options.lines is None:
+            search_kwargs = dict(prefetch=options.prefetch, parallel=options.parallel, page_size=options.page_size,
+                                 **hit_kwargs)
+            if options.resume:
+                # Everything which defines the output has to be the same to continue
+                search_desc = {"host": options.host, "index": options.index, "matches": options.matches,
+                               "since": options.since, "until": options.until,
+                               "output": options.output, "fields": options.fields}
+                try:
+                    position = load_checkpoint(options.resume, search_desc)
+                except (OSError, ValueError) as ex:
+                    logging.error("Cannot resume the search: %s", ex)
                     return 1
-
-        # If nothing found, and the user has passed some matches, it could be that
-        # there was a mistake in the field names of the matches. As it's easy to check, we do it and
-        # report an "error" in this case.
-        if no_matches and matches:
-            # Something is strange => check if the user selected a field which doesn't exists
-            fields_available = set(es.list_fields(options.host, options.index, options.username, options.password))
-            wrong_fields = set(matches.keys()) - fields_available
-            if wrong_fields:
-                logging.error("These fields do not exists: %s", ", ".join(sorted(wrong_fields)))
+                # The search updates its own copy of the position for a whole batch
+                # at once, while position only advances once a hit is written.
+                search_position = es.SearchPosition.from_dict(position.to_dict())
+                batches = client.iter_batches(options.index, match=matches, since=options.since,
+                                              until=options.until, fields=fields, position=search_position,
+                                              **search_kwargs)
+                if multi:
+                    batches = es.tag_batches(batches, client.host)
+            else:
+                searches = []
+                for c in clients:
+                    if options.cache:
+                        c_batches = cache.Cache().iter_batches(c, options.index, match=matches, since=options.since,
+                                                               until=options.until, fields=fields, **search_kwargs)
+                    else:
+                        c_batches = c.iter_batches(options.index, match=matches, since=options.since,
+                                                   until=options.until, fields=fields, **search_kwargs)
+                    searches.append((c.host, c_batches))
+                batches = es.merge_clusters(searches, max(1, options.prefetch)) if multi else searches[0][1]
+        elif options.lines > 0 and hit_filter:
+            # It's unknown how many entries will be filtered out => need to look at all of them
+            searches = [(c.host, c.iter_batches(options.index, match=matches, since=options.since,
+                                                until=options.until, fields=fields, prefetch=options.prefetch,
+                                                **hit_kwargs))
+                        for c in clients]
+            all_batches = es.merge_clusters(searches, max(1, options.prefetch)) if multi else searches[0][1]
+            last_hits: collections.deque = collections.deque(maxlen=options.lines)
+            for batch in all_batches:
+                last_hits.extend(filter(hit_filter, batch))
+            hits = list(last_hits)
+            batches = [hits]
+            if follower and hits:
+                follower.ignore_before(hits[-1]["sort"][0])
+        elif options.lines > 0:
+            if multi:
+                # All the servers are searched simultaneously (in separate threads)
+                searches = [(c.host, call_batch(functools.partial(c.search_last, options.index, options.lines,
+                                                                  match=matches, since=options.since,
+                                                                  until=options.until, fields=fields,
+                                                                  **hit_kwargs)))
+                            for c in clients]
+                # Only keep the latest ones of all the servers
+                all_hits = itertools.chain.from_iterable(es.merge_clusters(searches, prefetch=1))
+                hits = list(all_hits)[-options.lines:]
+            else:
+                hits = client.search_last(options.index, options.lines, match=matches, since=options.since,
+                                          until=options.until, fields=fields, **hit_kwargs)
+            batches = [hits]
+            if follower and hits:
+                # The older entries were skipped on purpose, so don't show them when following
+                follower.ignore_before(hits[-1]["sort"][0])
+        else:  # Explicitly no history requested
+            batches = []
+
+        if log_files:
+            try:
+                if options.lines is None:
+                    batches = logfile.merge(batches, log_files, conditions, since=options.since,
+                                            until=options.until, fields=file_fields)
+                elif options.lines > 0:
+                    hits = batches[0]
+                    # The latest entries are either the ones found, or newer ones from the files
+                    since = hits[0]["sort"][0] if len(hits) >= options.lines else options.since
+                    merged = logfile.merge(batches, log_files, conditions, since=since,
+                                           until=options.until, fields=file_fields)
+                    batches = [list(collections.deque(itertools.chain.from_iterable(merged),
+                                                      maxlen=options.lines))]
+            except ValueError as ex:  # Date not supported
+                logging.error("%s", ex)
                 return 1
 
+        next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+        with writer:
+            for i, batch in enumerate(batches):
+                if separator and i > 0:  # Between groups of context
+                    write(CONTEXT_SEPARATOR)
+                for hit in batch:
+                    if follower:
+                        follower.add(hit)
+                    if not hit_filter or hit_filter(hit):
+                        if exporter:
+                            export_write(render(hit), hit["sort"][0])
+                        else:
+                            write(render(hit))
+                    if position:
+                        position.add(hit)
+                if position and time.monotonic() > next_checkpoint:
+                    flush()  # The progress stored must not be ahead of the output
+                    save_checkpoint(options.resume, search_desc, position)
+                    next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+            flush()
+        if exporter:
+            exporter.close()
+
+        if position:  # Search complete => no need to resume it
+            position = None
+            try:
+                os.remove(options.resume)
+            except FileNotFoundError:  # Completed before the first checkpoint
+                pass
+
+        if follower:
+            try:
+                followed = es.tag_batches(follower, client.host) if multi else follower
+                for hits in followed:
+                    for hit in hits:
+                        if hit_filter and not hit_filter(hit):
+                            continue
+                        write(render(hit))
+                    flush()
+            except KeyboardInterrupt:  # That's the normal way to stop following
+                logging.debug("Following interrupted")
+                return 0
+
     except KeyboardInterrupt:  # Stopped by user
         logging.debug("Execution interrupted")
         return 128
+    except es.SearchError as ex:
+        es.report_error(ex)
+        return 1
+    except Exception:
+        logging.exception("Failure during execution")
+        return 1
+    finally:
+        for c in clients:
+            c.close()
+        if local_store:
+            local_store.close()
+        for f in log_files:
+            f.close()
+        if exporter:  # Write what was received so far (if interrupted)
+            exporter.close()
+        if position:  # Search interrupted => store where it stopped, so that it can be resumed
+            try:
+                save_checkpoint(options.resume, search_desc, position)
+                logging.warning("Search interrupted, use the same command to resume it")
+            except OSError as ex:
+                logging.error("Failed to store the progress of the search: %s", ex)
+        if collector:
+            stats.unsubscribe(collector)
+            sys.stderr.write(collector.summary() + "\n")
+
+    return 0
+
+
+def main_sync(args: list) -> int:
+    """
+    Downloads the new entries of the server into a local store (elnok sync)
+    """
+    parser = argparse.ArgumentParser(prog="elnok sync",
+                                     description="Download the log entries into a local database, to search them "
+                                                 "with elnok --local. Each run only downloads the new entries.")
+    parser.add_argument("--log-level", dest="loglev", metavar="<level>", type=int, choices=[0, 1, 2, 3],
+                        default=0, help="Set verbosity level (0-3, default = 0) of the elnok internals")
+    parser.add_argument("--host", default="localhost:9200",
+                        help="Specify the name or IP address and port of the elasticsearch server (default is localhost:9200)")
+    parser.add_argument("--index", default="logstash-*",
+                        help="Specify the index pattern to look into (default is logstash-*). It can be comma separated.")
+    parser.add_argument("--since", "-S", dest="since",
+                        help="On the first synchronization, only download the entries on or newer than the given date. "
+                             "Format is 2012-10-30T18:17:16 or now-2d.")
+    parser.add_argument("--index-fields", dest="index_fields", default=DEFAULT_INDEXED_FIELDS,
+                        help="List of the fields to index, to quickly find the entries matching field=value "
+                             "(comma separated, default is %s)" % (DEFAULT_INDEXED_FIELDS,))
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=1,
+                        help="Number of pages of results to download in advance (default is 1).")
+    parser.add_argument("--parallel", dest="parallel", type=int, default=1,
+                        help="Number of parts of the search to download simultaneously (default is 1).")
+    parser.add_argument("--username", "-u", type=str, default="elastic",
+                        help="The Elasticsearch username (default is elastic).")
+    parser.add_argument("--password", "-p", type=str, default="",
+                        help="The Elasticsearch username's password (default is an empty string).")
+    parser.add_argument("database",
+                        help="The file where the entries are stored. It's created if it doesn't exist.")
+    parser.add_argument("matches", nargs="*",
+                        help="Only store the entries that match (same format as for searching).")
+
+    options = parser.parse_args(args[1:])
+    if options.prefetch < 0:
+        parser.error("--prefetch must be positive or 0")
+    if options.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    try:
+        conditions = [query.parse_match(m) for m in options.matches]
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    set_up_logging(options.loglev)
+
+    # The store only makes sense if it always contains the same entries
+    search_desc = {"host": options.host, "index": options.index, "matches": options.matches}
+    client = es.Client(options.host, options.username, options.password, max_connections=max(10, options.parallel))
+    try:
+        with store.Store(options.database) as local_store:
+            prev_desc = local_store.get_meta("search")
+            if prev_desc is None:
+                local_store.set_meta("search", search_desc)
+            elif prev_desc != search_desc:
+                logging.error("Database %s was synchronized with a different search: %s",
+                              options.database, prev_desc)
+                return 1
+            local_store.add_indexed_fields(f for f in options.index_fields.split(",") if f)
+
+            fields_available = {}
+            match_fields = {c.field for c in conditions}
+            if match_fields:
+                fields_available = get_field_types(client, options.index, match_fields, True)
+                wrong_fields = match_fields - fields_available.keys()
+                if wrong_fields:
+                    logging.error("These fields do not exists: %s", ", ".join(sorted(wrong_fields)))
+                    return 1
+            matches, hit_filter = query.plan(conditions, fields_available)
+
+            n = local_store.sync(client, options.index, match=matches, hit_filter=hit_filter, since=options.since,
+                                 prefetch=options.prefetch, parallel=options.parallel)
+            print("Added %d entries, %d in total" % (n, len(local_store)))
+    except KeyboardInterrupt:  # Stopped by user
+        logging.warning("Synchronization interrupted, use the same command to continue it")
+        return 128
+    except es.SearchError as ex:
+        es.report_error(ex)
+        return 1
     except Exception:
         logging.exception("Failure during execution")
         return 1
+    finally:
+        client.close()
 
     return 0
 
+
+def call_batch(func: Callable[[], List[dict]]) -> Iterator[List[dict]]:
+    """
+    Calls a function only when its result is needed
+    func: function returning a batch of hits
+    yield: the result of the function (once)
+    """
+    yield func()
+
+
+def set_up_logging(level: int) -> None:
+    """
+    level: verbosity level, from 0 (only errors) to 3 (debug)
+    """
+    loglev_names = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
+    loglev = loglev_names[level]
+
+    # change the log format to be more descriptive
+    logging.basicConfig(level=loglev, format='%(asctime)s (%(module)s) %(levelname)s: %(message)s')
+
+
+def get_field_types(client: es.Client, index: str, requested_fields: Set[str], use_cache: bool
+                    ) -> Dict[str, str]:
+    """
+    Get the type of all the fields of the index
+    requested_fields: the fields which should be present
+    use_cache: if True, the answer of the server is stored on disk, and reused
+      (as long as all the requested fields are present)
+    return: field name -> type
+    """
+    if use_cache:
+        field_cache = cache.Cache()
+        fields_available = field_cache.get_field_types(client, index)
+        if not requested_fields <= fields_available.keys():
+            # Maybe the fields were just added => check with the latest version
+            fields_available = field_cache.get_field_types(client, index, refresh=True)
+        return fields_available
+    else:
+        return client.get_field_types(index)
+
+
+def load_checkpoint(path: str, search_desc: dict) -> es.SearchPosition:
+    """
+    Reads the progress of a search
+    path: the file where the progress is stored
+    search_desc: the parameters of the search
+    return: the position where to continue the search. If the file doesn't
+      exist, the position corresponds to the beginning of the search.
+    raises ValueError: if the file corresponds to another search, or is not valid
+    raises OSError: if the file cannot be read
+    """
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return es.SearchPosition()
+
+    if state.get("search") != search_desc:
+        raise ValueError("File %s was stored for a different search: %s" % (path, state.get("search")))
+    try:
+        position = es.SearchPosition.from_dict(state["position"])
+    except (KeyError, TypeError) as ex:
+        raise ValueError("File %s doesn't contain a valid position: %s" % (path, ex))
+    logging.info("Resuming search from %s", position.ts)
+    return position
+
+
+def save_checkpoint(path: str, search_desc: dict, position: es.SearchPosition) -> None:
+    """
+    Stores the progress of a search
+    path: the file where the progress is stored
+    search_desc: the parameters of the search
+    position: where the search is
+    """
+    # Write it to a temporary file first, so that if it crashes in the middle,
+    # the previous version is still there
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"search": search_desc, "position": position.to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+def print_aggregation(client: es.Client, options: argparse.Namespace,
+                      matches: List[dict], field_types: dict) -> None:
+    """
+    Computes and displays the aggregation requested (count, histogram, or top)
+    client: the connection to the server
+    options: the command line options
+    matches: the query clauses to filter the entries, as returned by query.plan()
+    field_types: field name -> type
+    raises SearchError: if the server failed to compute the aggregation
+    """
+    query_args = dict(match=matches, since=options.since, until=options.until)
+
+    if options.count:
+        print(client.count(options.index, **query_args))
+    elif options.top:
+        field = es.get_aggregatable_field(options.top, field_types)
+        aggs = {"top": {"terms": {"field": field, "size": options.top_size}}}
+        res = client.aggregate(options.index, aggs, **query_args)
+        for b in res["top"]["buckets"]:
+            print("%s\t%d" % (b["key"], b["doc_count"]))
+    elif options.histogram:
+        histo = {"field": "@timestamp",
+                 "format": "yyyy-MM-dd HH:mm:ss",
+                 "min_doc_count": 0}
+        histo.update(es.get_histogram_interval(options.histogram))
+        aggs = {"histogram": {"date_histogram": histo}}
+        if options.split:
+            field = es.get_aggregatable_field(options.split, field_types)
+            aggs["histogram"]["aggs"] = {"split": {"terms": {"field": field, "size": options.top_size}}}
+        res = client.aggregate(options.index, aggs, **query_args)
+        for b in res["histogram"]["buckets"]:
+            if options.split:
+                for sb in b["split"]["buckets"]:
+                    print("%s\t%s\t%d" % (b["key_as_string"], sb["key"], sb["doc_count"]))
+            else:
+                print("%s\t%d" % (b["key_as_string"], b["doc_count"]))
+
+
 ret = main(sys.argv)
 exit(ret)
 
@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+
+# Measures the speed of elnok, by downloading and displaying log entries from
+# a fake Elasticsearch server, running locally.
+# Call like:
+# python3 -m elnok.benchmark --hits 200000 --latency 0.01 --save before.json
+# python3 -m elnok.benchmark --hits 200000 --latency 0.01 --compare before.json
+#
+# The fake server runs in a separate process, so that it doesn't compete for the
+# CPU (and memory) with elnok. It implements just enough of the API for
+# the searches: _pit, _search (with search_after, slice, _source,
+# docvalue_fields and filter_path), and _mapping. The query is ignored: all the
+# entries always match.
+
+import argparse
+import bisect
+from datetime import datetime, timezone
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import elnok
+from elnok import es, output, stats
+
+INDEX = "logstash-bench"
+BASE_TS = 1618232266000  # ms, timestamp of the first entry
+ENTRY_INTERVAL = 10  # ms between each entry
+GZIP_LEVEL = 3  # Same as Elasticsearch
+
+LEVELS = ("DEBUG", "DEBUG", "DEBUG", "INFO", "INFO", "WARNING", "ERROR")
+MODULES = ("driver", "acq", "gui", "stream", "comp", "dataflow", "util")
+COMPONENTS = ("Stage", "Camera", "E-beam", "SEM", "Focus", "Light", "Spectrometer")
+WORDS = ("Moving", "axis", "to", "position", "with", "speed", "acquisition", "of", "image",
+         "received", "done", "in", "s", "failed", "retrying", "the", "stream", "settings",
+         "x", "y", "z", "0.00012", "1.5e-06", "True", "None", "(", ")", "=", "{", "}")
+# The fields which can be missing (the others are always present)
+OPTIONAL_FIELDS = ("module", "component", "subcomponent", "line")
+
+# Same as the default output of elnok (see DEFAULT_OUTPUT_SHORT)
+SHORT_FORMAT = "{@timestamp}\t{level}\t{module}\t{component}\t{subcomponent}:{line}\t{message}"
+SHORT_FIELDS = {"@timestamp", "level", "module", "component", "subcomponent", "line", "message"}
+
+
+def generate_docs(n: int, message_size: int, sparsity: float, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Creates log entries, similar to the ones of Odemis
+    n: number of entries
+    message_size: average length of the message (characters)
+    sparsity (0 <= float <= 1): probability for each of the optional fields to be missing
+    seed: initialisation of the random generator, to always get the same entries
+    return: the _source of each entry, in time order
+    """
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n):
+        ts = BASE_TS + i * ENTRY_INTERVAL
+        size = rng.randint(message_size // 2, message_size * 3 // 2)
+        words = []
+        length = 0
+        while length < size:
+            w = rng.choice(WORDS)
+            words.append(w)
+            length += len(w) + 1
+        dt = datetime.fromtimestamp(ts / 1000, timezone.utc)
+        doc = {
+            "@timestamp": dt.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (ts % 1000),
+            "level": rng.choice(LEVELS),
+            "module": rng.choice(MODULES),
+            "component": rng.choice(COMPONENTS),
+            "subcomponent": "sub%d" % rng.randint(0, 3),
+            "line": str(rng.randint(1, 2000)),
+            "message": " ".join(words)[:size],
+            "host": "odemis-pc",
+            "path": "/var/log/odemis.log",
+        }
+        for f in OPTIONAL_FIELDS:
+            if rng.random() < sparsity:
+                del doc[f]
+        docs.append(doc)
+    return docs
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockServer(_ThreadingHTTPServer):
+    """
+    Fake Elasticsearch server, with log entries in a single index
+    """
+
+    def __init__(self, address: Tuple[str, int], docs: List[Dict[str, Any]], latency: float = 0,
+                 compress: bool = True):
+        """
+        address: IP address and port to listen to. Port 0 picks any free port.
+        docs: the _source of each entry, in time order
+        latency: time to wait before answering each request (s)
+        compress: if True, the responses are compressed, when the client supports it
+        """
+        super().__init__(address, _MockHandler)
+        self.docs = docs
+        self.latency = latency
+        self.compress = compress
+        self.pits = set()
+        self._next_pit = 0
+        # The (time) sort key of each entry, as in a PIT: timestamp, shard doc
+        self.keys = [(BASE_TS + i * ENTRY_INTERVAL, i) for i in range(len(docs))]
+        # Hits already encoded (as JSON, without the sort), for each type of request
+        self._encoded: Dict[tuple, List[Optional[str]]] = {}
+        # Statistics
+        self.nrequests = 0
+        self.nbytes = 0
+
+    def open_pit(self) -> str:
+        self._next_pit += 1
+        pit = "pit%d" % self._next_pit
+        self.pits.add(pit)
+        return pit
+
+    def encode_hit(self, i: int, hit_keys: frozenset, source: Optional[tuple], docvalue: bool) -> str:
+        """
+        i: the index of the entry
+        hit_keys, source, docvalue: the content of the hit, as returned by get_hit_format()
+        return: the JSON of the hit i, without the sort, nor the closing brace
+        """
+        key = (hit_keys, source, docvalue)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = self._encoded.setdefault(key, [None] * len(self.docs))
+        s = encoded[i]
+        if s is None:
+            hit = {}
+            if "_index" in hit_keys:
+                hit["_index"] = INDEX
+                hit["_type"] = "_doc"
+            if "_id" in hit_keys:
+                hit["_id"] = "id%d" % (i,)
+            if "_score" in hit_keys:
+                hit["_score"] = None
+            if "_source" in hit_keys:
+                doc = self.docs[i]
+                if source is not None:
+                    doc = {k: v for k, v in doc.items() if k in source}
+                hit["_source"] = doc
+            if docvalue and "fields" in hit_keys:
+                # Only ES_TIME_FMT is supported
+                ts = self.keys[i][0]
+                dt = datetime.fromtimestamp(ts / 1000, timezone.utc)
+                hit["fields"] = {"@timestamp": [dt.strftime(output.TIME_FMT)]}
+            s = json.dumps(hit)[:-1]
+            encoded[i] = s
+        return s
+
+
+def get_hit_format(req: dict, filter_path: List[str]) -> Tuple[frozenset, Optional[tuple], bool]:
+    """
+    Find out what each hit should contain
+    req: the search request
+    filter_path: the response filters
+    return: the keys of the hit, the fields of the _source (None means all),
+      whether the timestamp is requested as a doc value
+    """
+    if filter_path:
+        hit_keys = {p[len("hits.hits."):] for p in filter_path if p.startswith("hits.hits.")}
+    else:
+        hit_keys = {"_index", "_id", "_score", "_source", "fields", "sort"}
+    source = req.get("_source")
+    if source is False:
+        hit_keys.discard("_source")
+        source = None
+    elif source is not None:
+        source = tuple(sorted(source))
+    return frozenset(hit_keys), source, bool(req.get("docvalue_fields"))
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # To keep the connections open
+    server: MockServer
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _send(self, code: int, data: str) -> None:
+        body = data.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if self.server.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, GZIP_LEVEL)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.nrequests += 1
+        self.server.nbytes += len(body)
+
+    def _send_error(self, code: int, err_type: str, reason: str) -> None:
+        self._send(code, json.dumps({"error": {"root_cause": [], "type": err_type, "reason": reason},
+                                     "status": code}))
+
+    def _handle(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path = url.path.rstrip("/")
+        if path.endswith("/_pit") and self.command == "POST":
+            self._send(200, json.dumps({"id": self.server.open_pit()}))
+        elif path == "/_pit" and self.command == "DELETE":
+            self.server.pits.discard(body.get("id"))
+            self._send(200, json.dumps({"succeeded": True, "num_freed": 1}))
+        elif path.endswith("/_mapping"):
+            self._send_mapping()
+        elif path.endswith("/_search"):
+            filter_path = params.get("filter_path", [""])[0]
+            self._send_search(body, [p for p in filter_path.split(",") if p])
+        else:
+            self._send_error(404, "resource_not_found_exception", "Unsupported request %s" % (url.path,))
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def _send_mapping(self):
+        props = {}
+        for doc in self.server.docs[:100]:
+            for k in doc:
+                props[k] = {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+        props["@timestamp"] = {"type": "date"}
+        self._send(200, json.dumps({INDEX: {"mappings": {"properties": props}}}))
+
+    def _send_search(self, req: dict, filter_path: List[str]):
+        server = self.server
+        pit = req.get("pit", {}).get("id")
+        if pit is not None and pit not in server.pits:
+            self._send_error(404, "search_context_missing_exception", "No search context found for id [%s]" % (pit,))
+            return
+
+        # Which entries are returned
+        if "search_after" in req:
+            sa = req["search_after"]
+            if len(sa) == 1:
+                sa = (sa[0], len(server.docs))  # All the entries at the same timestamp were already returned
+            start = bisect.bisect_right(server.keys, tuple(sa))
+        else:
+            start = 0
+        size = req.get("size", 10)
+        slice_id, slice_max = 0, 1
+        if "slice" in req:
+            slice_id, slice_max = req["slice"]["id"], req["slice"]["max"]
+        indices = []
+        i = start
+        while len(indices) < size and i < len(server.docs):
+            if i % slice_max == slice_id:
+                indices.append(i)
+            i += 1
+
+        hit_format = get_hit_format(req, filter_path)
+        sort_in_hit = not filter_path or "sort" in hit_format[0]
+
+        hits = []
+        for i in indices:
+            s = server.encode_hit(i, *hit_format)
+            if sort_in_hit:
+                sort = server.keys[i] if pit else server.keys[i][:1]
+                s += "%s\"sort\": %s}" % (", " if len(s) > 1 else "", json.dumps(list(sort)))
+            else:
+                s += "}"
+            hits.append(s)
+
+        parts = []
+        if pit is not None and (not filter_path or "pit_id" in filter_path):
+            parts.append("\"pit_id\": %s" % (json.dumps(pit),))
+        if not filter_path:
+            parts.append("\"took\": 1, \"timed_out\": false")
+        if hits or not filter_path:
+            parts.append("\"hits\": {\"hits\": [%s]}" % (", ".join(hits),))
+        self._send(200, "{%s}" % (", ".join(parts),))
+
+
+def _serve(conn, ndocs: int, message_size: int, sparsity: float, latency: float, compress: bool) -> None:
+    """
+    Runs the mock server (in a separate process)
+    conn: multiprocessing connection, to send the port, and then receive the
+      request to stop.
+    """
+    docs = generate_docs(ndocs, message_size, sparsity)
+    server = MockServer(("127.0.0.1", 0), docs, latency, compress)
+
+    # Encode the hits as requested by elnok, so that the server is not slowed
+    # down by this the first time they are requested.
+    for fields, timestamp_format in ((SHORT_FIELDS, output.ES_TIME_FMT), (None, None)):
+        hit_format = get_hit_format(es.build_hit_request(fields, timestamp_format), es.SEARCH_FILTER_PATH)
+        for i in range(ndocs):
+            server.encode_hit(i, *hit_format)
+
+    conn.send(server.server_address[1])
+    with server:
+        t = threading.Thread(target=server.serve_forever, daemon=True)
+        t.start()
+        conn.recv()  # Wait until asked to stop
+        conn.send({"requests": server.nrequests, "bytes": server.nbytes})
+        server.shutdown()
+
+
+def run(host: str, output_format: str, prefetch: int, parallel: int, page_size: Optional[int]) -> Dict[str, Any]:
+    """
+    Download all the entries of the (mock) server, and convert them to text,
+    as elnok does.
+    host: address of the server
+    output_format: "short" or "json"
+    prefetch, parallel, page_size: see Client.search()
+    return: the measurements
+    """
+    if output_format == "short":
+        render = output.Renderer(SHORT_FORMAT, server_timestamp=True)
+        fields = SHORT_FIELDS
+        timestamp_format = output.ES_TIME_FMT
+    elif output_format == "json":
+        render = output.render_json_raw
+        fields = None
+        timestamp_format = None
+    else:
+        raise ValueError("Unknown output %s" % (output_format,))
+
+    stages = {"mapping": 0.0, "search": 0.0, "render": 0.0, "write": 0.0}
+    nhits = 0
+    first_line = None
+    collector = stats.Collector()  # To get the details of the search
+    stats.subscribe(collector)
+    start = time.perf_counter()
+    with es.Client(host, max_connections=max(10, parallel)) as client:
+        client.get_field_types(INDEX)
+        t = time.perf_counter()
+        stages["mapping"] = t - start
+        hits = client.iter_search(INDEX, fields=fields, prefetch=prefetch, parallel=parallel,
+                                  page_size=page_size, timestamp_format=timestamp_format)
+        with open(os.devnull, "w") as devnull, output.BatchWriter(devnull) as writer:
+            # The time is measured around each step, for every hit, which
+            # slightly slows down the processing.
+            for hit in hits:
+                t_hit = time.perf_counter()
+                stages["search"] += t_hit - t
+                line = render(hit)
+                t_render = time.perf_counter()
+                stages["render"] += t_render - t_hit
+                writer.write(line)
+                t = time.perf_counter()
+                stages["write"] += t - t_render
+                if first_line is None:
+                    first_line = t - start
+                nhits += 1
+            t_flush = time.perf_counter()
+        t = time.perf_counter()
+        stages["write"] += t - t_flush
+    stats.unsubscribe(collector)
+
+    # Part of the search stage (but can overlap with the other stages, when prefetching)
+    stages["network"] = collector.network
+    stages["decode"] = collector.decode
+    duration = t - start
+    return {
+        "hits": nhits,
+        "duration": duration,
+        "hits_per_s": nhits / duration if duration else 0,
+        "time_to_first_line": first_line,
+        # On Linux, it's in KiB
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "pages": collector.pages,
+        "page_latencies": dict(zip([str(b) for b in stats.LATENCY_BINS] + ["more"], collector.latencies)),
+        "stages": stages,
+    }
+
+
+def print_results(results: Dict[str, Any], reference: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Show the results in a human-readable way
+    reference: previous results, to compare with
+    """
+    def compare(name, fmt, scale=1):
+        value = results[name]
+        text = fmt % (value * scale,)
+        if reference and reference.get(name):
+            text += " (%+.1f%%)" % ((value / reference[name] - 1) * 100,)
+        return text
+
+    print("Hits:               %d" % (results["hits"],))
+    print("Duration:           %s" % (compare("duration", "%.3f s"),))
+    print("Throughput:         %s" % (compare("hits_per_s", "%.0f hits/s"),))
+    if results["time_to_first_line"] is not None:
+        print("Time to first line: %s" % (compare("time_to_first_line", "%.3f s"),))
+    print("Peak RSS:           %s" % (compare("peak_rss_kib", "%.1f MiB", 1 / 1024),))
+    print("Server:             %d requests, %.1f MB" % (results["server"]["requests"], results["server"]["bytes"] / 1e6))
+    print("Pages:              %d" % (results["pages"],))
+    for stage, duration in results["stages"].items():
+        print("  %-16s  %.3f s" % (stage, duration))
+
+
+def main(args: list) -> int:
+    parser = argparse.ArgumentParser(description="Measure the speed of elnok, using a local fake Elasticsearch server")
+    parser.add_argument("--hits", dest="hits", type=int, default=100000,
+                        help="Number of log entries on the server (default is 100000)")
+    parser.add_argument("--message-size", dest="message_size", type=int, default=80,
+                        help="Average length of the messages, in characters (default is 80)")
+    parser.add_argument("--sparsity", dest="sparsity", type=float, default=0.1,
+                        help="Probability for each optional field to be missing (0->1, default is 0.1)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.005,
+                        help="Time the server takes to answer each request, in s (default is 0.005)")
+    parser.add_argument("--no-compression", dest="compress", action='store_false',
+                        help="The server does not compress the responses")
+    parser.add_argument("--output", "-o", dest="output", default="short", choices=["short", "json"],
+                        help="Format of the output (default is short)")
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=1,
+                        help="Number of pages to download in advance (default is 1)")
+    parser.add_argument("--parallel", dest="parallel", type=int, default=1,
+                        help="Number of parts of the search to download simultaneously (default is 1)")
+    parser.add_argument("--page-size", dest="page_size", type=int,
+                        help="Number of log entries per request (default is adaptive)")
+    parser.add_argument("--save", dest="save", metavar="PATH",
+                        help="Store the results in the given JSON file")
+    parser.add_argument("--compare", dest="compare", metavar="PATH",
+                        help="Compare the results with the ones stored in the given JSON file")
+    parser.add_argument("--log-level", dest="loglev", type=int, choices=[0, 1, 2, 3], default=0,
+                        help="Set verbosity level (0-3, default = 0)")
+    options = parser.parse_args(args[1:])
+
+    loglev_names = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=loglev_names[options.loglev],
+                        format='%(asctime)s (%(module)s) %(levelname)s: %(message)s')
+
+    reference = None
+    if options.compare:
+        try:
+            with open(options.compare, "r") as f:
+                reference = json.load(f)["results"]
+        except (OSError, ValueError, KeyError) as ex:
+            logging.error("Failed to read the results to compare with: %s", ex)
+            return 1
+
+    settings = {k: getattr(options, k) for k in ("hits", "message_size", "sparsity", "latency", "compress",
+                                                   "output", "prefetch", "parallel", "page_size")}
+    conn, server_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(server_conn, options.hits, options.message_size,
+                                                          options.sparsity, options.latency, options.compress),
+                                     daemon=True)
+    server.start()
+    try:
+        logging.info("Generating %d entries...", options.hits)
+        port = conn.recv()
+        results = run("127.0.0.1:%d" % (port,), options.output, options.prefetch, options.parallel,
+                      options.page_size)
+        conn.send("stop")
+        results["server"] = conn.recv()
+    except KeyboardInterrupt:
+        logging.debug("Execution interrupted")
+        return 128
+    except Exception:
+        logging.exception("Failure during benchmark")
+        return 1
+    finally:
+        server.terminate()
+        server.join()
+
+    print_results(results, reference)
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"version": elnok.__version__,
+                       "date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                       "settings": settings,
+                       "results": results}, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv))
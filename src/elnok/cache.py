@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+# Local cache of the search results, for the periods which are over.
+# The results are stored per "bucket" of time (1h), for a given query (server,
+# index, matches and fields). As long as a bucket is in the past (with some
+# margin for the entries indexed late), its content doesn't change anymore, so
+# it can be read from the disk instead of being downloaded again.
+# Each bucket is stored as one gzip-compressed file, with one hit per line (NDJSON).
+
+import calendar
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from elnok import es
+
+BUCKET_DURATION = 3600 * 1000  # ms
+# A bucket is considered complete once it's over since that long (to let the
+# entries be indexed)
+CLOSED_DELAY = 15 * 60 * 1000  # ms
+DEFAULT_MAX_SIZE = 1024 ** 3  # bytes
+MAPPING_TTL = 3600  # s, how long the list of fields is kept
+# The temporary files are only deleted once they are not modified since that
+# long, as they might still be written by another process
+TMP_FILE_GRACE = 24 * 3600  # s
+COMPRESS_LEVEL = 4  # Good trade-off between speed and size
+
+# Keys of the hits stored
+HIT_KEYS = ("_id", "_source", "sort", "fields")
+READ_BATCH_SIZE = 1000  # Number of hits read at once from a bucket
+
+
+def get_cache_dir() -> str:
+    """
+    return: the directory where the cache of elnok should be stored
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "elnok")
+
+
+# Date parsing, following the Elasticsearch syntax (only the most common parts).
+# See https://www.elastic.co/guide/en/elasticsearch/reference/current/common-options.html#date-math
+_DATE_FORMATS = (
+    # format, precision (for rounding up)
+    ("%Y-%m-%dT%H:%M:%S.%f", "ms"),
+    ("%Y-%m-%dT%H:%M:%S", "s"),
+    ("%Y-%m-%dT%H:%M", "m"),
+    ("%Y-%m-%dT%H", "h"),
+    ("%Y-%m-%d", "d"),
+    ("%Y-%m", "M"),
+    ("%Y", "y"),
+)
+_DATE_MATH_RE = re.compile(r"([+-])(\d+)([yMwdhHms])|/([yMwdhHms])")
+
+
+def _round_down(dt: datetime, unit: str) -> datetime:
+    """
+    Round down the date to the given unit (eg, "d" -> beginning of the day)
+    """
+    if unit == "ms":
+        return dt
+    dt = dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+    if unit == "s":
+        return dt.replace(microsecond=0)
+    if unit == "m":
+        return dt.replace(second=0, microsecond=0)
+    if unit in ("h", "H"):
+        return dt.replace(minute=0, second=0, microsecond=0)
+    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "d":
+        return dt
+    if unit == "w":
+        return dt - timedelta(days=dt.weekday())
+    if unit == "M":
+        return dt.replace(day=1)
+    if unit == "y":
+        return dt.replace(month=1, day=1)
+    raise ValueError("Unknown unit %s" % (unit,))
+
+
+def _add(dt: datetime, n: int, unit: str) -> datetime:
+    """
+    Add n time units to the date (n can be negative)
+    """
+    if unit in ("M", "y"):
+        months = dt.month - 1 + (n if unit == "M" else n * 12)
+        year = dt.year + months // 12
+        month = months % 12 + 1
+        day = min(dt.day, calendar.monthrange(year, month)[1])
+        return dt.replace(year=year, month=month, day=day)
+    seconds = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "H": 3600, "d": 86400, "w": 7 * 86400}[unit]
+    return dt + timedelta(seconds=n * seconds)
+
+
+def parse_time(text: str, now: datetime, round_up: bool = False) -> Optional[int]:
+    """
+    Converts a date, as accepted by Elasticsearch, to an absolute time.
+    Supported are the ISO dates (in UTC), "now", and the date math (eg, "now-1d/d").
+    text: the date
+    now: the current time (in UTC)
+    round_up: if True, the incomplete dates and the rounding go to the last
+      millisecond of the period, as Elasticsearch does for "lte".
+    return: time in ms since epoch, or None if the date format is not supported
+    """
+    if text.startswith("now"):
+        dt = now
+        math = text[3:]
+        precision = "ms"
+    else:
+        if "||" in text:
+            anchor, math = text.split("||", 1)
+        else:
+            anchor, math = text, ""
+        anchor = anchor.rstrip("Z")
+        for fmt, precision in _DATE_FORMATS:
+            try:
+                dt = datetime.strptime(anchor, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            return None
+
+    pos = 0
+    for m in _DATE_MATH_RE.finditer(math):
+        if m.start() != pos:
+            return None
+        pos = m.end()
+        if m.group(4):  # Rounding
+            precision = m.group(4)
+            dt = _round_down(dt, precision)
+        else:
+            n = int(m.group(2))
+            dt = _add(dt, n if m.group(1) == "+" else -n, m.group(3))
+    if pos != len(math):
+        return None
+
+    if round_up and precision != "ms":
+        dt = _add(_round_down(dt, precision), 1, precision) - timedelta(milliseconds=1)
+
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+class Cache:
+    """
+    Stores the results of the searches on the disk, so that searches on past
+    periods do not need to download them again.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        path: the directory where the cache is stored. If None, uses the default
+          cache directory of the user.
+        max_size: maximum size used by the cache (bytes). When it's bigger, the
+          files least recently used are deleted.
+        """
+        self.path = path or get_cache_dir()
+        self.max_size = max_size
+
+    def search(self, client: es.Client, target: str, match: Optional[es.Match] = None,
+               since: Optional[str] = None, until: Optional[str] = None,
+               fields: Optional[Set[str]] = None, **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Same as Client.search(), but uses the cache for the parts of the period
+        which are already stored, and stores the parts which are complete.
+        client: the connection to the server
+        kwargs: passed as-is to Client.search()
+        """
+        try:
+            for batch in self.iter_batches(client, target, match, since, until, fields, **kwargs):
+                yield from batch
+        except es.SearchError as ex:
+            es.report_error(ex)
+
+    def iter_batches(self, client: es.Client, target: str, match: Optional[es.Match] = None,
+                     since: Optional[str] = None, until: Optional[str] = None,
+                     fields: Optional[Set[str]] = None, columnar: bool = False, **kwargs
+                     ) -> Iterator[Union[List[Dict[str, Any]], Dict[str, Sequence]]]:
+        """
+        Same as Client.iter_batches(), but uses the cache for the parts of the
+        period which are already stored, and stores the parts which are complete.
+        client: the connection to the server
+        kwargs: passed as-is to Client.iter_batches()
+        raises SearchError: if the server failed to run the search
+        raises requests.RequestException: if the connection to the server failed
+        """
+        nowdt = datetime.now(timezone.utc)
+        now = calendar.timegm(nowdt.timetuple()) * 1000 + nowdt.microsecond // 1000
+        start = parse_time(since, nowdt) if since else None
+        end = parse_time(until, nowdt, round_up=True) if until else now
+        if start is None or end is None:
+            # Cannot cache an unbounded period (or a date format which is not understood)
+            logging.debug("Not using the cache, as the period is not understood")
+            yield from client.iter_batches(target, match, since, until, fields, columnar=columnar, **kwargs)
+            return
+        end += 1  # From now on, the end is exclusive
+
+        key_dir = self._get_key_dir(client.host, target, match, fields,
+                                    kwargs.get("timestamp_format"), kwargs.get("keep_id", False))
+
+        stored = False  # True if some buckets might have been added to the cache
+        try:
+            for seg_start, seg_end, buckets in self._plan(key_dir, start, end, now):
+                batches = None
+                if buckets is None:  # Already in the cache
+                    batches = self._read_bucket(self._bucket_path(key_dir, seg_start))
+                    if batches is None:  # Removed meanwhile (eg, by another process) => download it again
+                        buckets = [seg_start]
+                if batches is None:
+                    stored = stored or bool(buckets)
+                    batches = self._fetch(client, target, match, fields, seg_start, seg_end, buckets, key_dir,
+                                          kwargs)
+                for batch in batches:
+                    yield es.to_columns(batch, fields) if columnar else batch
+        finally:
+            # Only needed when the cache has grown
+            if stored:
+                self._evict()
+
+    def get_field_types(self, client: es.Client, target: str, ttl: float = MAPPING_TTL,
+                        refresh: bool = False) -> Dict[str, str]:
+        """
+        Same as Client.get_field_types(), but the answer is kept on the disk
+        for some time, to avoid requesting it every time.
+        client: the connection to the server
+        target: the name of the index. Can be a pattern.
+        ttl: maximum age of the stored answer (s)
+        refresh: if True, always request the server (and update the stored answer)
+        return: field name -> type
+        """
+        key = json.dumps({"host": client.host, "target": target}, sort_keys=True)
+        path = os.path.join(self.path, "mapping-%s.json" % (hashlib.sha1(key.encode("utf-8")).hexdigest(),))
+
+        if not refresh:
+            try:
+                if time.time() - os.path.getmtime(path) < ttl:
+                    with open(path, "r", encoding="utf-8") as f:
+                        return json.load(f)
+            except (OSError, ValueError) as ex:
+                logging.debug("Failed to read the cached fields: %s", ex)
+
+        fields = client.get_field_types(target)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(fields, f)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            logging.warning("Failed to store the fields in the cache: %s", ex)
+        return fields
+
+    def _get_key_dir(self, host: str, target: str, match: Optional[es.Match],
+                     fields: Optional[Set[str]], timestamp_format: Optional[str] = None,
+                     keep_id: bool = False) -> str:
+        """
+        return: the directory of the cache for the given query
+        """
+        # The content of the hits depends on the timestamp_format and keep_id, so they are part of the key
+        key = json.dumps({"host": host, "target": target, "match": match,
+                          "fields": sorted(fields) if fields is not None else None,
+                          "timestamp_format": timestamp_format, "keep_id": keep_id},
+                         sort_keys=True, default=str)
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _bucket_path(self, key_dir: str, bucket_start: int) -> str:
+        return os.path.join(key_dir, "%d.ndjson.gz" % (bucket_start,))
+
+    def _plan(self, key_dir: str, start: int, end: int, now: int
+              ) -> Iterator[Tuple[int, int, Optional[List[int]]]]:
+        """
+        Split the period into parts read from the cache and parts downloaded.
+        start, end: the period (ms since epoch, end exclusive)
+        now: current time (ms since epoch)
+        yield: start, end, buckets to store: for each part, in time order. If
+          buckets is None, the part is a bucket read from the cache. Otherwise,
+          it's a part to download, and buckets is the list of the start of the
+          complete buckets it contains (which should be stored).
+        """
+        closed_until = now - CLOSED_DELAY
+        dl_start = None  # Start of the current part to download
+        dl_buckets = []
+        t = start
+        while t < end:
+            bucket_start = t - t % BUCKET_DURATION
+            bucket_end = bucket_start + BUCKET_DURATION
+            seg_end = min(bucket_end, end)
+            complete = (bucket_start == t and bucket_end <= end and bucket_end <= closed_until)
+            if complete and os.path.exists(self._bucket_path(key_dir, bucket_start)):
+                if dl_start is not None:
+                    yield dl_start, t, dl_buckets
+                    dl_start, dl_buckets = None, []
+                yield bucket_start, bucket_end, None
+            else:
+                if dl_start is None:
+                    dl_start = t
+                if complete:
+                    dl_buckets.append(bucket_start)
+            t = seg_end
+
+        if dl_start is not None:
+            yield dl_start, end, dl_buckets
+
+    def _read_bucket(self, path: str) -> Optional[Iterator[List[Dict[str, Any]]]]:
+        """
+        return: the hits stored in the bucket file, by batches, or None if the
+          file cannot be opened
+        """
+        logging.debug("Reading cached results from %s", path)
+        try:
+            # Mark it as recently used
+            os.utime(path)
+            # Once opened, the file can be read even if it's deleted
+            f = gzip.open(path, "rt", encoding="utf-8")
+        except OSError as ex:
+            logging.debug("Failed to open the cached results: %s", ex)
+            return None
+        return self._read_batches(f)
+
+    @staticmethod
+    def _read_batches(f) -> Iterator[List[Dict[str, Any]]]:
+        """
+        f: the bucket file, opened as text. It's closed at the end.
+        yield: the hits, by batches
+        """
+        with f:
+            while True:
+                batch = [json.loads(line) for line in itertools.islice(f, READ_BATCH_SIZE)]
+                if not batch:
+                    return
+                yield batch
+
+    def _fetch(self, client: es.Client, target: str, match: Optional[es.Match],
+               fields: Optional[Set[str]], start: int, end: int, buckets: List[int], key_dir: str,
+               search_kwargs: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Download a part of the period, and store the complete buckets in the cache
+        start, end: the period (ms since epoch, end exclusive)
+        buckets: the start of the complete buckets within the period
+        yield: the hits, by batches
+        """
+        logging.debug("Downloading period %d -> %d (%d buckets to store)", start, end, len(buckets))
+        if buckets:
+            os.makedirs(key_dir, exist_ok=True)
+        pending = list(buckets)
+        writer = None  # Current bucket file being written
+        writer_end = None
+        try:
+            for batch in client.iter_batches(target, match, start, end - 1, fields, **search_kwargs):
+                for hit in batch:
+                    ts = hit["sort"][0]
+                    # Close the buckets which are over
+                    while writer is not None and ts >= writer_end:
+                        writer.commit()
+                        writer = None
+                    while writer is None and pending and ts >= pending[0]:
+                        bucket_start = pending.pop(0)
+                        writer = _BucketWriter(self._bucket_path(key_dir, bucket_start))
+                        writer_end = bucket_start + BUCKET_DURATION
+                        if ts >= writer_end:  # Empty bucket
+                            writer.commit()
+                            writer = None
+
+                    if writer is not None:
+                        writer.write(hit)
+                yield batch
+
+            # Search completed => all the remaining buckets are complete (maybe empty)
+            if writer is not None:
+                writer.commit()
+                writer = None
+            for bucket_start in pending:
+                _BucketWriter(self._bucket_path(key_dir, bucket_start)).commit()
+        finally:
+            if writer is not None:  # Search interrupted => the bucket is incomplete
+                writer.discard()
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used files, until the cache is small enough
+        """
+        files = []
+        total = 0
+        tmp_limit = time.time() - TMP_FILE_GRACE
+        for dirpath, _, filenames in os.walk(self.path):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if fn.endswith(".tmp") and st.st_mtime > tmp_limit:
+                    continue  # Probably still being written
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return
+
+        files.sort()
+        for mtime, size, path in files:
+            logging.debug("Removing %s from the cache", path)
+            try:
+                os.remove(path)
+            except OSError as ex:
+                logging.warning("Failed to remove %s from cache: %s", path, ex)
+                continue
+            total -= size
+            if total <= self.max_size:
+                break
+
+
+class _BucketWriter:
+    """
+    Writes a bucket file. The file only appears once it's complete.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        self._file = gzip.open(self._tmp_path, "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL)
+
+    def write(self, hit: Dict[str, Any]) -> None:
+        h = {k: hit[k] for k in HIT_KEYS if k in hit}
+        self._file.write(json.dumps(h) + "\n")
+
+    def commit(self) -> None:
+        self._file.close()
+        os.replace(self._tmp_path, self._path)
+
+    def discard(self) -> None:
+        self._file.close()
+        os.remove(self._tmp_path)
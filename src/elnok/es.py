@@ -19,11 +19,23 @@ PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 ELnoK. If not, see http://www.gnu.org/licenses/.
 '''
-from collections import OrderedDict
+import array
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import queue
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from typing import Optional, Iterator, Dict, List, Set
+import threading
+import time
+from typing import Optional, Iterator, Iterable, Callable, Dict, List, Sequence, Set, Tuple, Union, Any
+
+from elnok import jsonstream, stats
 
 # Elasticsearch API described here:
 # https://www.elastic.co/guide/en/elasticsearch/reference/current/search-search.html
@@ -63,161 +75,1508 @@ from typing import Optional, Iterator, Dict, List, Set
 #      },
 #  :
 # }
-# SEARCH_URL =  "http://{host}/{target}/_search?"
+SEARCH_URL = "http://{host}/{target}/_search"
 SEARCH_MULTI_URL = "http://{host}/_search"
+MSEARCH_URL = "http://{host}/_msearch"
+COUNT_URL = "http://{host}/{target}/_count"
 PIT_URL = "http://{host}/{target}/_pit"
+PIT_DELETE_URL = "http://{host}/_pit"
 MAPPING_URL = "http://{host}/{target}/_mapping"
 
+CONNECT_TIMEOUT = 10  # s, maximum time to establish the connection to the server
+READ_TIMEOUT = 120  # s, maximum time to wait for the (next bytes of the) answer
+
+# Number of hits per page. Any number "works", but too small cause a lot of
+# overhead, and too big causes latency.
+MIN_PAGE_SIZE = 100  # Small, so that the first results arrive quickly
+MAX_PAGE_SIZE = 10000  # Maximum accepted by Elasticsearch (by default)
+PAGE_DURATION = 1  # s, ideal time to receive a page
+MAX_PAGE_BYTES = 50e6  # Maximum size of the answer of a page
+
+RESPONSE_CHUNK_SIZE = 64 * 1024  # bytes, amount of data read at once from the server
+
+# How long the PIT is kept by the server after each request. If the next page
+# is requested later (eg, because the output is slow), the search is reopened.
+PIT_KEEP_ALIVE = 60  # s
+
+# When the search fails due to a temporary issue (network, server overloaded,
+# or PIT expired), it's retried after a delay, which doubles at each failure.
+RETRIES = 5  # Maximum number of consecutive failures, before giving up
+RETRY_DELAY = 1  # s, delay after the first failure
+RETRY_MAX_DELAY = 60  # s
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # HTTP status which are (likely) temporary
+
+# A filter on the entries: either a mapping of field -> words, or a list of
+# query clauses (see build_query())
+Match = Union[Dict[str, str], List[dict]]
+
+# Only the parts of the search response which are used. In particular, the
+# _index, _type, _score of each hit are not needed. See:
+# https://www.elastic.co/guide/en/elasticsearch/reference/current/common-options.html#common-options-response-filtering
+SEARCH_FILTER_PATH = ["pit_id", "error", "status", "hits.hits._source", "hits.hits.sort", "hits.hits.fields"]
+
+# For the context of the matching entries, number of matching entries whose
+# context is requested at once (in a single multi-search request)
+CONTEXT_BATCH_SIZE = 50
 
-def get_pit(host:str, target: str, username: str, password: str, keep_alive:float=60) -> dict:
+# When merging the results of several servers (or slices), number of hits passed
+# at once between the threads, or returned in a batch
+MERGE_BATCH_SIZE = 500
+
+# In the columnar batches, the column containing the timestamp (ms since epoch)
+TIMESTAMP_COLUMN = "_ts"
+
+# When following the new entries, entries are requested again since a little
+# before the latest entry received, in case some entries were indexed late.
+FOLLOW_OVERLAP = 10  # s
+FOLLOW_MIN_INTERVAL = 0.5  # s, period between requests, when new entries are coming
+FOLLOW_MAX_INTERVAL = 10  # s, period between requests, when nothing new is coming
+FOLLOW_PAGE_SIZE = 1000
+
+
+class SearchError(Exception):
     """
-    keep_alive: how long the PIT should be valid (s)
+    The Elasticsearch server refused or failed to run a search request
     """
 
-    url = PIT_URL.format(host=host, target=target)
-    # Authentication
-    auth = HTTPBasicAuth(username=username, password=password) if (username and password) else None
-    response = requests.post(url, params={"keep_alive": "%ds" % keep_alive}, auth=auth)
-    logging.debug(response.text)
-    return response.json()["id"]
+    def __init__(self, error: dict, status: Optional[int] = None):
+        """
+        error: the "error" part of the server response
+        status: the HTTP status of the response, if known
+        """
+        self.error = error
+        self.status = status
+        if isinstance(error, dict):
+            msg = "%s: %s" % (error.get("type", "error"), error.get("reason", ""))
+        else:
+            msg = str(error)
+        super().__init__(msg)
 
 
-def search(host: str, target: str, username: str, password: str, match: Optional[Dict[str, str]]=None,
-              since: Optional[str]=None, until: Optional[str]=None,
-              fields: Optional[Set[str]]=None
-              ) -> Iterator[OrderedDict]:
+class PageSizer:
     """
-    Does a elasticsearch query, by returning each hit one at a time via an iterator
-    host: IP address/hostname + port of the elasticsearch server
-    target: the name of the index. Can be a pattern.
-    match: a mapping of field -> a filter on what to return. It follows the syntax of 
-      ElasticSearch "match" query. See:
-      https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-match-query.html
-    since: filter for the minimum time
-    until: filter for the maximum time. For the format. See:
-      https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations-bucket-daterange-aggregation.html
-    fields: restrict the fields to return in the hit
-    yield: OrderedDict (str -> value): each result (hit) found, in time ascending order
-    """
-    # TODO: add _source in query, to limit the fields returned
-    # We don't receive a single "endless" response. Instead, we start a search,
-    # and then "scroll" through it, by asking for more results. See:
-    # https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html
-
-    # Get a "Point-in-time" (PIT), which is a sort of pointer to a snapshot of
-    # the log, so that even if data changes, the paginated results don't change.
-    pit = get_pit(host, target, username, password, keep_alive=10)
-
-    # Keep requesting small amounts of data
-    hits = None
-    while True:
-        url = SEARCH_MULTI_URL.format(host=host, target=target)
+    Selects the number of hits to request for each page of a search.
+    It starts small, so that the first hits are quickly returned, and then adapts
+    based on the time and the amount of data it took to receive the previous page.
+    """
+
+    def __init__(self, size: Optional[int] = None, target_duration: float = PAGE_DURATION,
+                 max_bytes: float = MAX_PAGE_BYTES):
+        """
+        size: if not None, the page size is fixed to this value. Otherwise it's adaptive.
+        target_duration: the ideal duration of a request for a page (s)
+        max_bytes: maximum size of the answer for a page (in bytes)
+        """
+        self.fixed = size is not None
+        self.size = size if self.fixed else MIN_PAGE_SIZE
+        self._target_duration = target_duration
+        self._max_bytes = max_bytes
+
+    def update(self, duration: float, nbytes: int, nhits: int) -> None:
+        """
+        Report how the last page went, to adjust the size of the next one
+        duration: time it took to receive the page (s)
+        nbytes: size of the answer (bytes)
+        nhits: number of hits in the page
+        """
+        if self.fixed or nhits == 0:
+            return
+
+        size = self.size
+        if duration > self._target_duration * 2 or nbytes > self._max_bytes:
+            # Too slow or too big => back off
+            size //= 2
+        elif duration < self._target_duration / 2 and nhits >= self.size:
+            # Fast, and there might be more => go bigger
+            size *= 2
+
+        # Don't let the page go beyond the memory budget
+        bytes_per_hit = nbytes / nhits
+        size = min(size, int(self._max_bytes / bytes_per_hit))
+
+        size = max(MIN_PAGE_SIZE, min(size, MAX_PAGE_SIZE))
+        if size != self.size:
+            logging.debug("Changing page size from %d to %d hits (last page took %g s for %d bytes)",
+                          self.size, size, duration, nbytes)
+            self.size = size
+
+
+class PageReader:
+    """
+    Iterates over the hits of a search response, while it is being received.
+    The response is parsed incrementally, so only the current hit is kept in
+    memory, and the first hits are available before the whole response is received.
+    After the iteration, it contains the information needed for the next page.
+    """
+
+    def __init__(self, response: requests.Response, start: float):
+        """
+        response: the response to the search request, opened in streaming mode
+        start: time at which the request was sent (from time.monotonic())
+        """
+        self._response = response
+        self.count = 0  # Number of hits received
+        self.nbytes = 0  # Size of the response (in bytes)
+        # Time to send the request and receive the response (s). The time spent
+        # by the caller between the hits is not included, so that it only
+        # depends on the server and the network, even if the hits are read lazily.
+        self.duration = time.monotonic() - start
+        self.last_sort = None  # The "sort" value of the last hit, for "search_after"
+        self.meta: Dict[str, Any] = {}  # The rest of the response (eg, "pit_id")
+        self._network_time = response.elapsed.total_seconds()  # Time waiting for the server (s)
+        self._parse_time = 0  # Time spent in the parser, including waiting for the server (s)
+
+    def _read_chunks(self) -> Iterator[bytes]:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # Read it all, to log it
+            logging.debug(self._response.text)
+            chunks = iter([self._response.content])
+        else:
+            chunks = self._response.iter_content(RESPONSE_CHUNK_SIZE)
+
+        while True:
+            start = time.perf_counter()
+            c = next(chunks, None)
+            dur = time.perf_counter() - start
+            self._network_time += dur
+            self.duration += dur
+            if c is None:
+                return
+            self.nbytes += len(c)
+            yield c
+
+    def _timed_hits(self, hits: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Measures the time spent to get each hit (but not the time spent by the caller)
+        """
+        start = time.perf_counter()
+        for hit in hits:
+            self._parse_time += time.perf_counter() - start
+            yield hit
+            start = time.perf_counter()
+        self._parse_time += time.perf_counter() - start
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """
+        yield: each hit of the response
+        raises SearchError: if the server returned an error instead of hits
+        """
+        # Measuring the parsing time has a (small) cost, so only do it if needed
+        timed = bool(stats.subscribers)
+        with self._response:
+            hits = jsonstream.iter_hits(self._read_chunks(), self.meta)
+            if timed:
+                hits = self._timed_hits(hits)
+            for hit in hits:
+                self.count += 1
+                self.last_sort = hit.get("sort")
+                yield hit
+
+        if timed:
+            self._publish_stats()
+
+        # In case there was an error parsing the query, it'll return "error" instead of "hits".
+        # Note: as the response is filtered, when there is no hit, there is no "hits" either.
+        if "error" in self.meta:
+            raise SearchError(self.meta["error"], self.meta.get("status"))
+
+    def _publish_stats(self) -> None:
+        page = stats.PageStats()
+        page.hits = self.count
+        page.nbytes = self.nbytes
+        try:
+            page.wire_bytes = self._response.raw.tell()  # Before decompression
+        except AttributeError:  # Not a urllib3 response
+            page.wire_bytes = self.nbytes
+        page.latency = self._response.elapsed.total_seconds()
+        page.network = self._network_time
+        page.decode = max(0, self._parse_time - (self._network_time - page.latency))
+        page.duration = self.duration
+        stats.publish(page)
+
+
+class SearchPosition:
+    """
+    Position in the results of a search, to be able to continue it later (with
+    a new PIT), without returning again the hits already returned.
+    The hits are identified by their timestamp, and for the hits with the same
+    timestamp as the last one, by their content.
+    """
+
+    def __init__(self, ts: Optional[int] = None, keys: Optional[Dict[str, int]] = None):
+        """
+        ts: the timestamp of the last hit returned (ms since epoch), or None if
+          nothing was returned yet.
+        keys: for the hits returned with the timestamp ts: key -> number of hits
+          (see get_hit_key())
+        """
+        self.ts = ts
+        self._keys = collections.Counter(keys or {})
+        self._hits: List[Dict[str, Any]] = []  # Hits at ts, whose key is not yet computed
+
+    def add(self, hit: Dict[str, Any]) -> None:
+        """
+        Update the position, after the hit has been returned
+        """
+        ts = hit["sort"][0]
+        if ts != self.ts:
+            self.ts = ts
+            self._keys.clear()
+            self._hits.clear()
+        # The key is only computed if needed, as most hits will not be the last one
+        self._hits.append(hit)
+
+    def get_keys(self) -> collections.Counter:
+        """
+        return: the keys of the hits returned with the last timestamp -> number of hits
+        """
+        for h in self._hits:
+            self._keys[get_hit_key(h)] += 1
+        self._hits.clear()
+        return collections.Counter(self._keys)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        return: the position, in a JSON-compatible format
+        """
+        return {"ts": self.ts, "keys": self.get_keys()}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "SearchPosition":
+        """
+        d: the position, as returned by to_dict()
+        """
+        return cls(d["ts"], d["keys"])
+
+
+class Client:
+    """
+    Connection to an Elasticsearch server.
+    All the requests go through the same HTTP session, so that the (TCP/TLS)
+    connection is kept alive and reused between the requests, instead of being
+    re-established for every page of results.
+    """
+
+    def __init__(self, host: str, username: str = "", password: str = "",
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_connections: int = 10, retries: int = RETRIES):
+        """
+        host: IP address/hostname + port of the elasticsearch server
+        username: the Elasticsearch username. If empty, no authentication is used.
+        password: the Elasticsearch password. If empty, no authentication is used.
+        connect_timeout: maximum time to connect to the server (s)
+        read_timeout: maximum time to wait for the server to answer (s)
+        max_connections: maximum number of connections kept open simultaneously.
+          It should be at least as large as the number of parallel requests.
+        retries: maximum number of times a search is retried after a temporary failure
+        """
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_connections)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # Ask for the responses to be compressed. It's (much) smaller, as the
+        # logs are very repetitive.
+        self._session.headers["Accept-Encoding"] = "gzip"
+        # Authentication
+        if username and password:
+            self._session.auth = HTTPBasicAuth(username=username, password=password)
+
+    def close(self):
+        """
+        Release the connections to the server
+        """
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_pit(self, target: str, keep_alive: float = 60) -> str:
+        """
+        target: the name of the index. Can be a pattern.
+        keep_alive: how long the PIT should be valid (s)
+        return: the PIT id
+        """
+        url = PIT_URL.format(host=self.host, target=target)
+        response = self._session.post(url, params={"keep_alive": "%ds" % keep_alive}, timeout=self.timeout)
+        logging.debug(response.text)
+        try:
+            result = response.json()
+        except ValueError:  # Not even JSON (eg, error from a proxy)
+            result = {"error": {"type": "http_error", "reason": response.reason}}
+        if "id" not in result:
+            raise SearchError(result.get("error", {}), response.status_code)
+        return result["id"]
+
+    def delete_pit(self, pit: str) -> None:
+        """
+        Releases a PIT on the server. If it fails, it's not a big deal, as the
+        PIT will eventually expire anyway.
+        pit: the PIT id
+        """
+        url = PIT_DELETE_URL.format(host=self.host)
+        try:
+            response = self._session.delete(url, json={"id": pit}, timeout=self.timeout)
+            logging.debug(response.text)
+        except requests.RequestException as ex:
+            logging.debug("Failed to delete the PIT: %s", ex)
+
+    @contextlib.contextmanager
+    def open_pit(self, target: str, keep_alive: float = PIT_KEEP_ALIVE) -> Iterator[str]:
+        """
+        Context manager to get a PIT, which is deleted at the end
+        target, keep_alive: see get_pit()
+        yield: the PIT id
+        """
+        pit = self.get_pit(target, keep_alive)
+        try:
+            yield pit
+        finally:
+            self.delete_pit(pit)
+
+    def search(self, target: str, match: Optional[Match] = None,
+               since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+               fields: Optional[Set[str]] = None, prefetch: int = 0, parallel: int = 1,
+               page_size: Optional[int] = None, max_page_bytes: float = MAX_PAGE_BYTES,
+               timestamp_format: Optional[str] = None, keep_id: bool = False,
+               position: Optional["SearchPosition"] = None
+               ) -> Iterator[Dict[str, Any]]:
+        """
+        Does a elasticsearch query, by returning each hit one at a time via an iterator
+        target: the name of the index. Can be a pattern.
+        match: a mapping of field -> a filter on what to return. It follows the syntax of
+          ElasticSearch "match" query. See:
+          https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-match-query.html
+          Alternatively, a list of query clauses, which all have to match (as
+          returned by query.plan()).
+        since: filter for the minimum time
+        until: filter for the maximum time. For the format. See:
+          https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations-bucket-daterange-aggregation.html
+          Both since and until can also be an int, in ms since epoch.
+        fields: restrict the fields to return in the hit
+        prefetch: number of pages to fetch in advance, in a separate thread, while
+          the hits of the current page are being processed. If 0, the next page
+          is only requested once all the hits of the current page have been consumed.
+        parallel: number of "slices" of the search to request simultaneously.
+          If > 1, the hits of the slices are merged back, so the order is the same.
+        page_size: number of hits per page. If None, it's adapted automatically
+          based on the speed of the server.
+        max_page_bytes: when the page size is adaptive, maximum size of a page (bytes)
+        timestamp_format: if not None, the @timestamp is also returned already
+          formatted by the server (in Java DateTimeFormatter syntax), in
+          hit["fields"]["@timestamp"][0]. It's then not included in the _source.
+        keep_id: if True, the hits contain their "_id" (otherwise, it's not transferred)
+        position: where to start the search from, and updated with every hit
+          returned, so that the search can be continued later. If None, the
+          search starts from the beginning.
+        yield: dict (str -> value): each result (hit) found, in time ascending order.
+          It contains the "_source" (the fields of the entry), and "sort" (whose
+          first element is the timestamp in ms).
+          If a temporary failure happens, the search is retried (up to .retries
+          times in a row), and continues from the last hit returned.
+        """
+        try:
+            yield from self.iter_search(target, match, since, until, fields, prefetch, parallel,
+                                        page_size, max_page_bytes, timestamp_format, keep_id, position)
+        except SearchError as ex:
+            report_error(ex)
+
+    def iter_search(self, target: str, match: Optional[Match] = None,
+                    since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+                    fields: Optional[Set[str]] = None, prefetch: int = 0, parallel: int = 1,
+                    page_size: Optional[int] = None, max_page_bytes: float = MAX_PAGE_BYTES,
+                    timestamp_format: Optional[str] = None, keep_id: bool = False,
+                    position: Optional["SearchPosition"] = None
+                    ) -> Iterator[Dict[str, Any]]:
+        """
+        Same as search(), but if the server fails to run the search, it raises
+        an exception instead of reporting the error.
+        raises SearchError: if the server failed to run the search
+        raises requests.RequestException: if the connection to the server failed
+        """
+        if position is None:
+            position = SearchPosition()
+        for batch in self._iter_pages(target, match, since, until, fields, prefetch, parallel,
+                                      page_size, max_page_bytes, timestamp_format, keep_id, position):
+            # Pass one each log line, one at a time
+            for hit in batch:
+                position.add(hit)
+                yield hit
+
+    def iter_batches(self, target: str, match: Optional[Match] = None,
+                     since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+                     fields: Optional[Set[str]] = None, prefetch: int = 0, parallel: int = 1,
+                     page_size: Optional[int] = None, max_page_bytes: float = MAX_PAGE_BYTES,
+                     timestamp_format: Optional[str] = None, keep_id: bool = False,
+                     position: Optional["SearchPosition"] = None, columnar: bool = False
+                     ) -> Iterator[Union[List[Dict[str, Any]], Dict[str, Sequence]]]:
+        """
+        Runs a search, and returns the hits by batches. It's the recommended way
+        to use elnok from another program: processing a whole batch at once is
+        much faster than one hit at a time, and the errors are never reported
+        (only raised).
+        columnar: if True, each batch is converted to a dict field -> values
+          (see to_columns()), with the fields requested.
+        Other arguments: see search()
+        yield: the hits (as in search()) of each page received, in time order.
+          With parallel > 1 or prefetch == 0, the batches contain up to
+          MERGE_BATCH_SIZE hits. Batches are never empty.
+        raises SearchError: if the server failed to run the search
+        raises requests.RequestException: if the connection to the server failed
+        """
+        if position is None:
+            position = SearchPosition()
+        for batch in self._iter_pages(target, match, since, until, fields, prefetch, parallel,
+                                      page_size, max_page_bytes, timestamp_format, keep_id, position):
+            if not batch:
+                continue
+            for hit in batch:
+                position.add(hit)
+            yield to_columns(batch, fields) if columnar else batch
+
+    def _iter_pages(self, target: str, match: Optional[Match], since: Union[str, int, None],
+                    until: Union[str, int, None], fields: Optional[Set[str]], prefetch: int, parallel: int,
+                    page_size: Optional[int], max_page_bytes: float, timestamp_format: Optional[str],
+                    keep_id: bool, position: "SearchPosition") -> Iterator[List[Dict[str, Any]]]:
+        """
+        Runs the search, and retries it on temporary failures
+        position: the hits already returned. The caller must update it with
+          each hit it has returned, before requesting the next batch, so that
+          the search continues from there in case of failure.
+        Other arguments: see search()
+        yield: the hits of each page (possibly empty)
+        """
+        query = build_query(match, since, until)
+        hit_request = build_hit_request(fields, timestamp_format)
+
+        failures = 0
+        while True:
+            try:
+                for batch in self._search_from(target, query, hit_request, keep_id, position,
+                                               prefetch, parallel, page_size, max_page_bytes):
+                    failures = 0  # It works again
+                    yield batch
+                return
+            except (SearchError, requests.RequestException) as ex:
+                if not is_temporary_error(ex) or failures >= self.retries:
+                    raise
+                delay = min(RETRY_DELAY * 2 ** failures, RETRY_MAX_DELAY)
+                failures += 1
+                logging.warning("Search failed (%s), will continue in %g s", ex, delay)
+                time.sleep(delay)
+
+    def _search_from(self, target: str, query: dict, hit_request: dict, keep_id: bool,
+                     position: "SearchPosition", prefetch: int, parallel: int,
+                     page_size: Optional[int], max_page_bytes: float) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Runs the search, starting from the given position
+        position: the hits returned so far. It's not updated.
+        Other arguments: see iter_search()
+        yield: the hits after the position, page by page
+        """
+        # We don't receive a single "endless" response. Instead, we start a search,
+        # and then "scroll" through it, by asking for more results. See:
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html
+        if position.ts is not None:
+            # Continue from the last timestamp. The hits at that timestamp which
+            # were already returned are skipped.
+            logging.debug("Continuing search from %d", position.ts)
+            query = {"bool": {"filter": [query, {"range": {"@timestamp": {"gte": position.ts,
+                                                                           "format": "epoch_millis"}}}]}}
+            seen_ts, seen = position.ts, position.get_keys()
+        else:
+            seen_ts, seen = None, None
+
+        # Get a "Point-in-time" (PIT), which is a sort of pointer to a snapshot of
+        # the log, so that even if data changes, the paginated results don't change.
+        with self.open_pit(target) as pit:
+            batches = self._search_pit(pit, query, hit_request, keep_id, prefetch, parallel, page_size,
+                                       max_page_bytes)
+            if seen:
+                batches = _skip_seen(batches, seen_ts, seen)
+            yield from batches
+
+    def _search_pit(self, pit: str, query: dict, hit_request: dict, keep_id: bool,
+                    prefetch: int, parallel: int, page_size: Optional[int], max_page_bytes: float
+                    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Runs the search on a PIT, in slices if requested
+        pit: the PIT id
+        Other arguments: see iter_search()
+        return: the hits by batches (possibly empty), in time order. The batches
+          are the whole pages, unless they are streamed (ie, no prefetch) or
+          merged (ie, sliced).
+        """
+        def new_sizer():
+            return PageSizer(page_size, max_bytes=max_page_bytes)
+
+        if parallel > 1:
+            hits = self._search_sliced(pit, query, hit_request, keep_id, parallel, max(1, prefetch), new_sizer)
+            # The pages of the slices are mixed => make new batches of the merged hits
+            return batched(hits, MERGE_BATCH_SIZE)
+
+        pages = self._search_pages(pit, query, hit_request, keep_id, new_sizer())
+        if prefetch > 0:
+            # The pages have to be entirely read by the prefetching thread
+            return prefetched(_read_pages(pages), prefetch)
+        # Each page is read lazily, in small batches, so that it's never entirely in memory
+        return _stream_pages(pages, MERGE_BATCH_SIZE)
+
+    def search_last(self, target: str, n: int, match: Optional[Match] = None,
+                    since: Optional[str] = None, until: Optional[str] = None,
+                    fields: Optional[Set[str]] = None,
+                    timestamp_format: Optional[str] = None, keep_id: bool = False
+                    ) -> List[Dict[str, Any]]:
+        """
+        Does a elasticsearch query, and returns only the latest hits.
+        It's much faster than search() on a long period, as the hits are requested
+        starting from the latest one, so only the hits returned are transferred.
+        target: the name of the index. Can be a pattern.
+        n (> 0): maximum number of hits to return
+        match, since, until, fields, timestamp_format, keep_id: see search()
+        return: the latest n hits found, in time ascending order
+        raises SearchError: if the server failed to run the search
+        """
+        query = build_query(match, since, until)
+        hit_request = build_hit_request(fields, timestamp_format)
+        if n <= MAX_PAGE_SIZE:
+            # Everything fits in a single request
+            req_data = {
+                "size": n,
+                "sort": [{"@timestamp": "desc"}],
+                "query": query,
+            }
+            req_data.update(hit_request)
+            hits = list(self.request_page(req_data, target, keep_id))
+        else:
+            hits = []
+            with self.open_pit(target) as pit:
+                for page in self._search_pages(pit, query, hit_request, keep_id, PageSizer(MAX_PAGE_SIZE),
+                                               order="desc"):
+                    hits.extend(itertools.islice(page, n - len(hits)))
+                    if len(hits) >= n:
+                        break
+
+        hits.reverse()
+        return hits
+
+    def search_context(self, target: str, context_fields: Dict[str, str], before: int, after: int,
+                       match: Optional[Match] = None,
+                       since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+                       fields: Optional[Set[str]] = None, hit_filter: Optional[Callable[[dict], bool]] = None,
+                       prefetch: int = 0, parallel: int = 1, page_size: Optional[int] = None,
+                       timestamp_format: Optional[str] = None
+                       ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Does a elasticsearch query, and returns each hit found with the entries
+        just before and after it, from the same context (eg, same host and file).
+        Only the context entries are downloaded, with small requests starting
+        from each hit found, in both directions.
+        target: the name of the index. Can be a pattern.
+        context_fields: the fields which define the context: field in the _source
+          -> field to query, with the exact value (eg, "path" -> "path.keyword").
+          They must be included in the fields returned.
+        before: number of entries shown before each hit found
+        after: number of entries shown after each hit found
+        hit_filter: if not None, only the hits for which it returns True are
+          considered found. The context entries are not filtered.
+        match, since, until, fields, prefetch, parallel, page_size, timestamp_format: see search()
+        yield: groups of consecutive entries of the same context, containing
+          at least one hit found, in time order. Groups which overlap, or are
+          just next to each other, are merged. The groups are in the order of
+          their first hit found, so groups of different contexts can overlap
+          in time (ie, a group can start before the end of the previous one).
+        raises SearchError: if the server failed to run the search
+        """
+        query = build_query(match, since, until)
+        # The context entries are only looked for within the period
+        period_query = build_query(None, since, until)
+        hit_request = build_hit_request(fields, timestamp_format)
+
+        # The same PIT is used for the hits and their context, so that the
+        # "sort" values (including the tie-breaker) are comparable.
+        with self.open_pit(target) as pit:
+            hits = itertools.chain.from_iterable(
+                self._search_pit(pit, query, hit_request, False, prefetch, parallel, page_size, MAX_PAGE_BYTES))
+            if hit_filter:
+                hits = filter(hit_filter, hits)
+
+            groups: List[_ContextGroup] = []  # Not yet returned, in order
+            latest: Dict[tuple, _ContextGroup] = {}  # Context key -> latest group
+            for batch_id, found in enumerate(batched(hits, CONTEXT_BATCH_SIZE)):
+                keys = [tuple(_get_source_value(h, f) for f in context_fields) for h in found]
+                windows = self._get_context(pit, period_query, hit_request, context_fields, found, keys,
+                                            before, after)
+                for key, (window, complete, prev) in zip(keys, windows):
+                    group = latest.get(key)
+                    new_hits = group.get_new_hits(window, prev) if group else None
+                    if new_hits is not None:  # Overlaps the previous group of the same context
+                        if not group.returned:
+                            group.hits.extend(new_hits)
+                            group.complete = complete if new_hits else group.complete or complete
+                            group.batch_id = batch_id
+                            continue
+                        elif not new_hits:
+                            continue
+                        # Only the entries not yet returned, as a separate group
+                        window = new_hits
+                    group = _ContextGroup(key, window, complete, batch_id)
+                    groups.append(group)
+                    latest[key] = group
+
+                # Return the groups which cannot be extended anymore. The latest
+                # group of a context can still be extended by the next batch, if
+                # it's not complete. After that, it'd be returned anyway (and
+                # the entries already returned would be skipped).
+                while groups:
+                    group = groups[0]
+                    if not group.complete and group.batch_id == batch_id and latest[group.key] is group:
+                        break
+                    group.returned = True
+                    yield groups.pop(0).hits
+
+            for group in groups:
+                yield group.hits
+
+    def _get_context(self, pit: str, query: dict, hit_request: dict, context_fields: Dict[str, str],
+                     hits: List[Dict[str, Any]], keys: List[tuple], before: int, after: int
+                     ) -> List[Tuple[List[Dict[str, Any]], bool, Optional[Dict[str, Any]]]]:
+        """
+        Requests the context of the hits, in a single request
+        query: the query to select all the entries (typically, only the period)
+        hits: the hits found, whose context is requested
+        keys: for each hit, the value of each context field
+        return: for each hit, the entries of its context (including the hit itself),
+          in time order, whether there is no entry after the context, and the
+          entry just before the context (or None if there is none).
+        raises SearchError: if the server failed to run the search
+        """
+        # One more entry before is requested, to know whether the context is
+        # just after the previous group
+        directions = [(order, size) for order, size in (("desc", before + 1), ("asc", after)) if size > 0]
+
+        searches = []
+        for hit, key in zip(hits, keys):
+            ctx_filters = [query]
+            for qfield, v in zip(context_fields.values(), key):
+                if v is None:
+                    ctx_filters.append({"bool": {"must_not": {"exists": {"field": qfield}}}})
+                else:
+                    ctx_filters.append({"term": {qfield: v}})
+            # Searching in reverse order starting from the hit returns the entries just before it
+            for order, size in directions:
+                req_data = {
+                    "size": size,
+                    "sort": [{"@timestamp": order}, {"_shard_doc": order}],
+                    "pit": {"id": pit, "keep_alive": "%ds" % PIT_KEEP_ALIVE},
+                    "query": {"bool": {"filter": ctx_filters}},
+                    "search_after": hit["sort"],
+                }
+                req_data.update(hit_request)
+                searches.append(req_data)
+
+        # Format is "header\nbody\n" for each search. The PIT defines the indices.
+        # See https://www.elastic.co/guide/en/elasticsearch/reference/current/search-multi-search.html
+        body = "".join("{}\n%s\n" % (json.dumps(r),) for r in searches)
+        url = MSEARCH_URL.format(host=self.host)
+        filter_path = ["error", "responses.error", "responses.status"] + ["responses." + p for p in SEARCH_FILTER_PATH
+                                                                         if p.startswith("hits.")]
+        logging.debug("Requesting context of %d hits", len(hits))
+        response = self._session.post(url, params={"filter_path": ",".join(filter_path)}, data=body,
+                                      headers={"Content-Type": "application/x-ndjson"}, timeout=self.timeout)
+        try:
+            resp_dict = response.json()
+        except ValueError:
+            raise SearchError({"type": "http_error", "reason": response.reason}, response.status_code)
+        if "error" in resp_dict:
+            raise SearchError(resp_dict["error"], resp_dict.get("status"))
+
+        results = []
+        for r in resp_dict["responses"]:
+            if "error" in r:
+                raise SearchError(r["error"], r.get("status"))
+            results.append(r.get("hits", {}).get("hits", []))
+
+        windows = []
+        results = iter(results)
+        for hit in hits:
+            hits_before = next(results)
+            hits_after = next(results) if after > 0 else []
+            prev = hits_before.pop() if len(hits_before) > before else None
+            window = hits_before[::-1] + [hit] + hits_after
+            windows.append((window, len(hits_after) < after, prev))
+        return windows
+
+    def _search_sliced(self, pit: str, query: dict, hit_request: dict, keep_id: bool,
+                       n: int, prefetch: int, new_sizer: Callable[[], PageSizer]
+                       ) -> Iterator[Dict[str, Any]]:
+        """
+        Runs a search as n "slices" in parallel, and merge their results back.
+        Each slice is a subset of the search, with its own pagination. See:
+        https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html#slice-pit
+        pit: the PIT id
+        query: the query part of the search
+        hit_request: the part of the search defining the content of the hits
+        keep_id: if True, the hits contain their "_id"
+        n (> 1): number of slices
+        prefetch (>= 1): number of pages to fetch in advance, for each slice
+        new_sizer: creates the page sizer of each slice
+        yield: the hits, in the same order as the search without slicing
+        """
+        slices = [self._search_pages(pit, query, hit_request, keep_id, new_sizer(), slice_id=(i, n))
+                  for i in range(n)]
+
+        # Old servers (or some configurations) do not support slicing with a PIT.
+        # Check it on the first page, and in such case, do a normal search.
+        try:
+            first_page = list(next(slices[0], []))
+        except SearchError as ex:
+            if is_temporary_error(ex):
+                raise
+            logging.warning("Failed to run the search in parallel (%s), will run it sequentially", ex)
+            pages = self._search_pages(pit, query, hit_request, keep_id, new_sizer())
+            yield from itertools.chain.from_iterable(prefetched(_read_pages(pages), prefetch))
+            return
+
+        slices_hits = [itertools.chain(first_page,
+                                       itertools.chain.from_iterable(prefetched(_read_pages(slices[0]), prefetch)))]
+        for pages in slices[1:]:
+            slices_hits.append(itertools.chain.from_iterable(prefetched(_read_pages(pages), prefetch)))
+
+        # Each slice is sorted, and each hit has its "sort" value, which is unique
+        # (as the PIT adds a tie-breaker). So the merge results in the same order
+        # as the non-sliced search.
+        yield from heapq.merge(*slices_hits, key=lambda h: h["sort"])
+
+    def _search_pages(self, pit: str, query: dict, hit_request: dict, keep_id: bool = False,
+                      sizer: Optional[PageSizer] = None, slice_id: Optional[Tuple[int, int]] = None,
+                      order: str = "asc"
+                      ) -> Iterator[PageReader]:
+        """
+        Does a elasticsearch query, by returning each page of hits one at a time.
+        Each page must be entirely read before requesting the next one.
+        pit: the PIT id
+        query: the query part of the search
+        hit_request: the part of the search defining the content of the hits
+        keep_id: if True, the hits contain their "_id"
+        sizer: selects the size of each page. If None, an adaptive one is used.
+        slice_id: the slice number and the total number of slices, to only
+          return a subset of the search. If None, the whole search is returned.
+        order: "asc" or "desc", the time order of the hits
+        yield: iterable of the hits of each page, in the time order. Iterating
+          over it raises SearchError if the server failed to run the search.
+        """
+        if sizer is None:
+            sizer = PageSizer()
+
+        # Keep requesting small amounts of data
+        search_after = None
+        while True:
+            req_data = {
+                "size": sizer.size,
+                "sort": [{"@timestamp": order}],
+                "pit": {"id": pit,
+                        "keep_alive": "%ds" % PIT_KEEP_ALIVE,  # Extend the PIT duration
+                },
+                "query": query,
+            }
+            req_data.update(hit_request)
+
+            if slice_id is not None:
+                req_data["slice"] = {"id": slice_id[0], "max": slice_id[1]}
+
+            # Pass info from the previous request (if it's not the first one)
+            if search_after is not None:
+                req_data["search_after"] = search_after
+
+            page = self.request_page(req_data, keep_id=keep_id)
+            yield page
+
+            if page.count == 0:  # End of the search?
+                return
+
+            search_after = page.last_sort
+            sizer.update(page.duration, page.nbytes, page.count)
+
+    def request_page(self, req_data: dict, target: Optional[str] = None, keep_id: bool = False) -> PageReader:
+        """
+        Sends a search request
+        req_data: the search request
+        target: the name of the index. Can be a pattern. Must be None if the
+          request uses a PIT, as the PIT already defines the indices.
+        keep_id: if True, the hits contain their "_id"
+        return: the hits of the response
+        """
+        filter_path = SEARCH_FILTER_PATH + ["hits.hits._id"] if keep_id else SEARCH_FILTER_PATH
+        if target is None:
+            url = SEARCH_MULTI_URL.format(host=self.host)
+        else:
+            url = SEARCH_URL.format(host=self.host, target=target)
+        logging.debug("%s", req_data)
+        start = time.monotonic()
+        response = self._session.get(url, params={"filter_path": ",".join(filter_path)},
+                                     json=req_data, timeout=self.timeout, stream=True)
+        if response.status_code in RETRY_STATUSES and "json" not in response.headers.get("Content-Type", ""):
+            # Typically, a proxy in front of the server, which fails
+            response.close()
+            raise SearchError({"type": "http_error", "reason": response.reason}, response.status_code)
+        return PageReader(response, start)
+
+    def count(self, target: str, match: Optional[Match] = None,
+              since: Union[str, int, None] = None, until: Union[str, int, None] = None) -> int:
+        """
+        Counts the number of entries matching a query, without downloading them
+        target: the name of the index. Can be a pattern.
+        match, since, until: see search()
+        return: the number of entries
+        raises SearchError: if the server failed to run the query
+        """
+        url = COUNT_URL.format(host=self.host, target=target)
+        req_data = {"query": build_query(match, since, until)}
+        logging.debug("%s", req_data)
+        response = self._session.get(url, json=req_data, timeout=self.timeout)
+        logging.debug(response.text)
+        resp_dict = response.json()
+        if "count" not in resp_dict:
+            raise SearchError(resp_dict.get("error", {}))
+        return resp_dict["count"]
+
+    def aggregate(self, target: str, aggs: Dict[str, Any], match: Optional[Match] = None,
+                  since: Union[str, int, None] = None, until: Union[str, int, None] = None) -> Dict[str, Any]:
+        """
+        Computes aggregations (eg, statistics) on the entries matching a query,
+        without downloading the entries. See:
+        https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations.html
+        target: the name of the index. Can be a pattern.
+        aggs: the aggregations to compute (name -> definition)
+        match, since, until: see search()
+        return: the result of each aggregation (name -> result)
+        raises SearchError: if the server failed to run the query
+        """
+        url = SEARCH_URL.format(host=self.host, target=target)
         req_data = {
-            # Can be up to 10000. Any number "works", but too small cause a lot
-            # of overhead, and too big causes latency.
-            "size": 1000,
+            "size": 0,  # No hits, only the aggregations
+            "query": build_query(match, since, until),
+            "aggs": aggs,
+        }
+        logging.debug("%s", req_data)
+        response = self._session.get(url, json=req_data, timeout=self.timeout)
+        logging.debug(response.text)
+        resp_dict = response.json()
+        if "aggregations" not in resp_dict:
+            raise SearchError(resp_dict.get("error", {}))
+        return resp_dict["aggregations"]
+
+    def list_fields(self, target: str) -> List[str]:
+        """
+        List all the fields stored on the given index/indices (only the top-level ones)
+        target: the name of the index. Can be a pattern.
+        raises SearchError: if the server failed to return the mapping
+        """
+        fields: Set[str] = set()
+        for fields_desc in self._get_mappings(target):
+            fields.update(fields_desc.keys())
+        return list(fields)
+
+    def get_field_types(self, target: str) -> Dict[str, str]:
+        """
+        Get the type of all the fields stored on the given index/indices.
+        The sub-fields (of objects) and the multi-fields (eg, "message.keyword")
+        are included, with their full (dotted) name.
+        target: the name of the index. Can be a pattern.
+        return: field name -> type (eg, "text", "keyword", "date")
+        raises SearchError: if the server failed to return the mapping
+        """
+        fields: Dict[str, str] = {}
+        for fields_desc in self._get_mappings(target):
+            _add_fields(fields, fields_desc)
+        return fields
+
+    def _get_mappings(self, target: str) -> List[Dict[str, Any]]:
+        """
+        return: for each index, the description of its fields ("properties" of the mapping)
+        raises SearchError: if the server failed to return the mapping
+        """
+        url = MAPPING_URL.format(host=self.host, target=target)
+
+        # See  https://www.elastic.co/guide/en/elasticsearch/reference/current/indices-get-mapping.html
+        response = self._session.get(url, timeout=self.timeout)
+        resp_dict = response.json()
+        if "error" in resp_dict:
+            raise SearchError(resp_dict["error"])
+
+        # Format:
+        # list of str (index names) -> "mappings" -> "properties" -> dict str (field name) -> type
+        mappings = []
+        for idx_name, idx_desc in resp_dict.items():
+            logging.debug("Parsing index %s", idx_name)
+            try:
+                mappings.append(idx_desc["mappings"]["properties"])
+            except KeyError as ex:
+                logging.info("Skipping index %s: %s", idx_name, ex)
+        return mappings
+
+
+class _ContextGroup:
+    """
+    Consecutive entries of the same context (see Client.search_context())
+    """
+
+    def __init__(self, key: tuple, hits: List[Dict[str, Any]], complete: bool, batch_id: int):
+        """
+        key: the values of the context fields
+        hits: the entries, in time order
+        complete: True if there is no more entry after the last one
+        batch_id: the batch of hits found which last extended this group
+        """
+        self.key = key
+        self.hits = hits
+        self.complete = complete
+        self.batch_id = batch_id
+        self.returned = False  # True once it was passed to the caller
+
+    def get_new_hits(self, hits: List[Dict[str, Any]], prev: Optional[Dict[str, Any]]
+                     ) -> Optional[List[Dict[str, Any]]]:
+        """
+        hits: entries of the same context, in time order, not starting before this group
+        prev: the entry just before the hits, or None if there is none
+        return: the entries after this group, or None if the entries don't
+          overlap this group, nor directly follow it
+        """
+        last_sort = self.hits[-1]["sort"]
+        if hits[0]["sort"] > last_sort and (prev is None or prev["sort"] > last_sort):
+            return None
+        return [h for h in hits if h["sort"] > last_sort]
+
+
+class Follower:
+    """
+    Waits for the new entries of a search, as they are being indexed.
+    The server is polled regularly, for the entries after the latest entry
+    already received. As some entries might be indexed a little late, the period
+    just before the latest entry is requested again, and the entries already
+    received are discarded based on their _id.
+    """
+
+    def __init__(self, client: Client, target: str, match: Optional[Match] = None,
+                 fields: Optional[Set[str]] = None, timestamp_format: Optional[str] = None,
+                 overlap: float = FOLLOW_OVERLAP,
+                 min_interval: float = FOLLOW_MIN_INTERVAL, max_interval: float = FOLLOW_MAX_INTERVAL):
+        """
+        client: the connection to the server
+        target: the name of the index. Can be a pattern.
+        match: a mapping of field -> a filter on what to return (see Client.search())
+        fields: restrict the fields to return in the hit
+        timestamp_format: if not None, the @timestamp is returned formatted (see Client.search())
+        overlap: period before the latest entry which is requested again (s)
+        min_interval: minimum period between two requests (s)
+        max_interval: maximum period between two requests (s)
+        """
+        self._client = client
+        self._target = target
+        self._match = match
+        self._hit_request = build_hit_request(fields, timestamp_format)
+        self._overlap_ms = int(overlap * 1000)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+
+        self._last_ts: Optional[int] = None  # Timestamp of the latest hit (ms since epoch)
+        self._min_ts: Optional[int] = None  # Hits before this timestamp are discarded
+        # Hits received within the overlap period (in time order)
+        self._recent: collections.deque = collections.deque()  # (timestamp in ms, _id)
+        self._recent_ids: Set[str] = set()
+
+    def add(self, hit: Dict[str, Any]) -> None:
+        """
+        Report a hit as already received, so that it's not returned again.
+        The hits must be passed in time order.
+        hit: a hit from a search sorted by @timestamp (so that "sort" contains the timestamp)
+        """
+        ts = hit["sort"][0]
+        self._last_ts = ts
+        hid = hit.get("_id")
+        if hid is not None:
+            self._recent.append((ts, hid))
+            self._recent_ids.add(hid)
+
+        # Forget about the hits which are too old to be returned again
+        oldest_ts = ts - self._overlap_ms
+        while self._recent and self._recent[0][0] < oldest_ts:
+            _, old_id = self._recent.popleft()
+            self._recent_ids.discard(old_id)
+
+    def ignore_before(self, ts: int) -> None:
+        """
+        Discard all the hits older than the given time, even if they were
+        indexed late. Useful if only some of the previous entries were received.
+        ts: timestamp, in ms since epoch (as in the "sort" value of the hits)
+        """
+        self._min_ts = ts
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """
+        Requests the entries which have arrived since the latest hit.
+        return: the new hits, in time order
+        """
+        query = build_query(self._match)
+        if self._last_ts is None:
+            # Nothing received yet => only look at what arrives from now on
+            q_time = {"gte": "now"}
+            self._last_ts = int(time.time() * 1000)
+        else:
+            q_time = {"gte": self._last_ts - self._overlap_ms, "format": "epoch_millis"}
+        query["bool"]["filter"].append({"range": {"@timestamp": q_time}})
+
+        req_data = {
+            "size": FOLLOW_PAGE_SIZE,
             "sort": [{"@timestamp": "asc"}],
-            "pit": {"id": pit,
-                    "keep_alive": "10s",  # Extend the PIT duration
-            },
+            "query": query,
         }
-        
-        # Due to elasticsearch being a search engine, the query syntax is very
-        # sophisticated. To look for multiple criteria (eg field match and time range),
-        # it's necessary to combine them via a "bool,filter" query, which just
-        # means all the criteria have to be fullfiled.
-        # Note that it's fine to run a query with an empty filter.
-        q_filters = []
-        req_data["query"] = {
-            "bool": {
-                "filter": q_filters
-            }
+        req_data.update(self._hit_request)
+
+        new_hits = []
+        while True:
+            page = self._client.request_page(req_data, self._target, keep_id=True)
+            first_ts = None
+            for h in page:
+                if first_ts is None:
+                    first_ts = h["sort"][0]
+                if h.get("_id") in self._recent_ids:
+                    continue
+                if self._min_ts is not None and h["sort"][0] < self._min_ts:
+                    continue
+                new_hits.append(h)
+                self.add(h)
+
+            if page.count < FOLLOW_PAGE_SIZE:
+                return new_hits
+
+            # The page is full => there are more entries. The next page starts
+            # again from the timestamp of the last hit, as there could be several
+            # entries with the same timestamp (the duplicates are discarded).
+            last_ts = page.last_sort[0]
+            if first_ts == last_ts:
+                logging.warning("More than %d entries at the same time, some entries might be missing",
+                                FOLLOW_PAGE_SIZE)
+                req_data["search_after"] = [last_ts]
+            else:
+                req_data["search_after"] = [last_ts - 1]
+
+    def __iter__(self) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Polls the server forever. The period between polls is short as long as
+        new entries arrive, and gets longer when nothing happens.
+        yield: the new hits of each poll (if any), in time order
+        """
+        interval = self._min_interval
+        while True:
+            hits = self.poll()
+            if hits:
+                interval = self._min_interval
+                yield hits
+            else:
+                interval = min(interval * 2, self._max_interval)
+            time.sleep(interval)
+
+
+def build_query(match: Optional[Match] = None,
+                since: Union[str, int, None] = None, until: Union[str, int, None] = None) -> dict:
+    """
+    Creates the "query" part of a search request
+    match: a mapping of field -> a filter on what to return (see Client.search())
+    since: filter for the minimum time. If an int, it's in ms since epoch.
+    until: filter for the maximum time (inclusive). If an int, it's in ms since epoch.
+    return: the query, in the elasticsearch query DSL
+    """
+    # Due to elasticsearch being a search engine, the query syntax is very
+    # sophisticated. To look for multiple criteria (eg field match and time range),
+    # it's necessary to combine them via a "bool,filter" query, which just
+    # means all the criteria have to be fullfiled.
+    # Note that it's fine to run a query with an empty filter.
+    q_filters = []
+    query = {
+        "bool": {
+            "filter": q_filters
         }
+    }
 
+    if isinstance(match, dict):
+        # There are many types of text search "term" is looking for exactly the value.
+        # For more flexible options (OR, wildcard, regexp...), see query.plan().
         for field, val in match.items():
-            # There are many types of text search "term" is looking for exactly the value
-            # There might be better or more flexible options with match, wildcard or regexp...
-            # https://www.elastic.co/guide/en/elasticsearch/reference/7.13/query-dsl-wildcard-query.html
-            # q_filters.append({"wildcard": {field: {"value": val}}})
-            # TODO: if the field is repeated, extend the query to work as a OR (ie, separate words with a space)
             q_filters.append({"match": {field: {"query": val}}})
-            # TODO make the query case sensitive. It should be the matter of selecting
-            # the right analyzer.
-            # https://www.elastic.co/guide/en/elasticsearch/reference/current/specify-analyzer.html
-            # However, for now adding "analyzer": "whitespace" seems to only make
-            # the query text as-is, while the fields are always lowercase...
+    elif match:
+        q_filters.extend(match)
+
+    # Add a time range, if requested. See:
+    # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-range-query.html
+    q_time = {}
+    if since is not None and since != "":
+        q_time["gte"] = since
+    if until is not None and until != "":
+        q_time["lte"] = until
+    if isinstance(since, int) or isinstance(until, int):
+        # Accept both the standard date format and the epoch in ms
+        q_time["format"] = "strict_date_optional_time||epoch_millis"
+
+    if q_time:
+        q_filters.append({"range": {"@timestamp": q_time}})
 
-        # Add a time range, if requested. See:
-        # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-range-query.html
-        q_time = {}
-        if since:
-            q_time["gte"] = since
-        if until:
-            q_time["lte"] = until
+    # TODO: report properly if the date format is incorrect (ie, not understood by ES)
 
-        if q_time:
-            q_filters.append({"range": {"@timestamp": q_time}})
+    return query
 
-        # TODO: report properly if the date format is incorrect (ie, not understood by ES)
 
+def build_hit_request(fields: Optional[Set[str]] = None, timestamp_format: Optional[str] = None) -> dict:
+    """
+    Creates the part of a search request which defines the content of each hit
+    fields: restrict the fields to return in the hit. If None, all are returned.
+    timestamp_format: if not None, the @timestamp is returned formatted by the
+      server, in "fields", instead of in the _source.
+    return: the entries to add to the search request
+    """
+    hit_request = {}
+    source_fields = fields
+    if timestamp_format:
+        # It's very fast for the server to read & convert the timestamp, as it's
+        # directly available from the index ("doc value"). It avoids parsing it on the client.
+        hit_request["docvalue_fields"] = [{"field": "@timestamp", "format": timestamp_format}]
         if fields is not None:
-            req_data["_source"] = list(fields)
+            source_fields = fields - {"@timestamp"}
 
-        # Pass info from the previous request (if it's not the first one)
-        if hits is not None:
-            req_data["search_after"] = hits[-1]["sort"]
+    if source_fields is not None:
+        # Note: an empty list would mean "everything", so explicitly disable it instead
+        hit_request["_source"] = sorted(source_fields) if source_fields else False
+    return hit_request
 
-        # Authentication
-        auth = HTTPBasicAuth(username=username, password=password) if (username and password) else None
 
-        logging.debug("%s", req_data)
-        response = requests.get(url, json=req_data, auth=auth)
-        logging.debug(response.text)
+def merge_clusters(searches: List[Tuple[str, Iterable[List[Dict[str, Any]]]]], prefetch: int = 1
+                   ) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Merges the hits of the same search run on several servers (clusters)
+    searches: for each server, its host and its batches of hits (in time order)
+    prefetch: number of batches of hits read in advance for each server, in a
+      separate thread, so that all the servers are queried simultaneously.
+      It bounds the memory used for each server. If 0, the hits are read only
+      when needed, one server at a time (typically, if they are already in memory).
+    yield: batches of hits, in time order. Each hit has the additional key "_cluster",
+      which contains the host of the server.
+    """
+    streams = []
+    for host, batches in searches:
+        batches = tag_batches(batches, host)
+        if prefetch > 0:
+            batches = prefetched(batches, prefetch)
+        streams.append(itertools.chain.from_iterable(batches))
 
-        # Use OrderedDict in order to keep the order
-        resp_dict = response.json(object_pairs_hook=OrderedDict)
+    # The "sort" values are not comparable between servers (due to the tie-breaker),
+    # so only the timestamp is used.
+    yield from batched(heapq.merge(*streams, key=lambda h: h["sort"][0]), MERGE_BATCH_SIZE)
 
-        # In case there was an error parsing the query, it'll return "error" instead of "hits"
-        if not "hits" in resp_dict:
-            logging.error("Search query failed")
-            if "error" in resp_dict:
-                # TODO: make it prettier (it should be some kind of recursive text?
-                for field, value in resp_dict["error"].items():
-                    print("%s: %s" % (field, value))
-            return
 
-        hits = resp_dict["hits"]["hits"]
-        if not hits:  # End of the search?
+def tag_batches(batches: Iterable[List[Dict[str, Any]]], host: str) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Adds to each hit the key "_cluster", with the host of the server
+    yield: the same batches
+    """
+    for batch in batches:
+        for hit in batch:
+            hit["_cluster"] = host
+        yield batch
+
+
+def batched(iterable: Iterable[Any], n: int) -> Iterator[List[Any]]:
+    """
+    yield: lists of (at most) n consecutive items of the iterable
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
             return
+        yield batch
 
-        # Pass one each log line, one at a time
-        for h in hits:
-            yield h
 
+def to_columns(hits: List[Dict[str, Any]], fields: Optional[Iterable[str]] = None) -> Dict[str, Sequence]:
+    """
+    Converts hits to a "columnar" format, which allows to process all the values
+    of a field at once (eg, with numpy.asarray()).
+    hits: the hits, as returned by search()
+    fields: the fields to convert. If None, all the fields present in any of the hits.
+    return: field -> values (list, with None if the field is missing in a hit).
+      In addition, the column TIMESTAMP_COLUMN contains the timestamp of each
+      hit, in ms since epoch, as an array of int64.
+    """
+    if fields is None:
+        fields = []
+        for hit in hits:
+            for f in itertools.chain(hit.get("_source", {}), hit.get("fields", {})):
+                if f not in fields:
+                    fields.append(f)
 
-def list_fields(host: str, target: str, username: str, password: str) -> List[str]:
+    columns: Dict[str, Sequence] = {TIMESTAMP_COLUMN: array.array("q", (hit["sort"][0] for hit in hits))}
+    for f in fields:
+        values = []
+        for hit in hits:
+            try:
+                values.append(hit["_source"][f])
+            except KeyError:
+                # With a timestamp_format, the @timestamp is in the "fields"
+                values.append(hit.get("fields", {}).get(f, [None])[0])
+        columns[f] = values
+    return columns
+
+
+def _get_source_value(hit: Dict[str, Any], field: str) -> Any:
     """
-    List all the fields stored on the given index/indices
-    host: IP address/hostname + port of the elasticsearch server
-    target: the name of the index. Can be a pattern.
-    """
-    url = MAPPING_URL.format(host=host, target=target)
-    # Authentication
-    auth = HTTPBasicAuth(username=username, password=password) if (username and password) else None
-
-    # See  https://www.elastic.co/guide/en/elasticsearch/reference/current/indices-get-mapping.html
-    response = requests.get(url, auth=auth)
-    resp_dict = response.json()
-    # Format:
-    # list of str (index names) -> "mappings" -> "properties" -> dict str (field name) -> type
-    fields: Set[str] = set()
-    for idx_name, idx_desc in resp_dict.items():
-        logging.debug("Parsing index %s", idx_name)
+    return: the value of the field in the _source of the hit, or None if not present
+    """
+    return hit.get("_source", {}).get(field)
+
+
+def get_hit_key(hit: Dict[str, Any]) -> str:
+    """
+    return: an identifier of the content of the hit
+    """
+    # The _id is not always available, so use the content
+    content = json.dumps([hit.get("_source"), hit.get("fields")], sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def _skip_seen(batches: Iterable[List[Dict[str, Any]]], ts: int, seen: collections.Counter
+               ) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Skip the hits already returned, at the beginning of the search
+    batches: the hits, in time order, starting at ts, by batches
+    ts: the timestamp of the hits already returned (ms since epoch)
+    seen: key of the hits -> number of hits already returned. It's updated.
+    yield: the batches, without the hits already returned
+    """
+    batches = iter(batches)
+    for batch in batches:
+        new_hits = []
+        done = False
+        for i, hit in enumerate(batch):
+            if hit["sort"][0] != ts:  # All the hits after are new
+                new_hits.extend(batch[i:])
+                done = True
+                break
+            k = get_hit_key(hit)
+            if seen[k] > 0:  # Same content as a hit already returned => consider it the same
+                seen[k] -= 1
+                continue
+            new_hits.append(hit)
+        yield new_hits
+        if done:
+            break
+    yield from batches
+
+
+def is_temporary_error(ex: Exception) -> bool:
+    """
+    return: True if the error is likely to go away, by trying again
+    """
+    if isinstance(ex, SearchError):
+        if isinstance(ex.error, dict):
+            # The PIT expired (eg, because too much time passed between two requests)
+            types = {ex.error.get("type")} | {c.get("type") for c in ex.error.get("root_cause", [])}
+            if "search_context_missing_exception" in types:
+                return True
+        return ex.status in RETRY_STATUSES
+    # Cannot connect, or the connection was lost
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def prefetched(iterable: Iterable[Any], depth: int) -> Iterator[Any]:
+    """
+    Iterates over an iterable from a separate thread, so that the next items are
+    already being computed while the current item is processed by the caller.
+    iterable: the iterable to read. It will be entirely handled by the separate thread.
+    depth (>= 1): maximum number of items computed in advance, and not yet consumed
+    return: iterator over the same items as the iterable, in the same order. If
+      the iterable raises an exception, it's raised again in the caller.
+      The separate thread starts immediately, so the iterator should be
+      iterated (at least partly), to let the thread know when to stop.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()  # Set when the caller doesn't want more items
+
+    def put(entry) -> bool:
+        """
+        return: True if the entry was passed, False if the caller has stopped
+        """
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        it = iter(iterable)
         try:
-            fields_desc = idx_desc["mappings"]["properties"]
-        except KeyError as ex:
-            logging.info("Skipping index %s: %s", idx_name, ex)
+            for item in it:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as ex:
+            put((_END, ex))
+        finally:
+            # Let the generator clean up (eg, release its resources) as soon as possible
+            if hasattr(it, "close"):
+                it.close()
+
+    worker = threading.Thread(target=run, name="Prefetcher", daemon=True)
+    worker.start()
+    return _read_prefetched(items, stop)
+
+
+def _read_prefetched(items: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+    """
+    The caller side of prefetched()
+    """
+    try:
+        while True:
+            item, ex = items.get()
+            if item is _END:
+                if ex is not None:
+                    raise ex
+                return
+            yield item
+    finally:
+        # Either finished, or the caller stopped early (including KeyboardInterrupt)
+        stop.set()
+
+
+def get_aggregatable_field(field: str, field_types: Dict[str, str]) -> str:
+    """
+    Find the field to use for aggregating (or sorting) on a given field.
+    The "text" fields cannot be used directly, but usually have a "keyword"
+    version, which contains the complete value.
+    field: the name of the field
+    field_types: field name -> type, as returned by Client.get_field_types()
+    return: the name of the field to use
+    """
+    if field_types.get(field) == "text":
+        for name, ftype in field_types.items():
+            if ftype == "keyword" and name.startswith(field + ".") and "." not in name[len(field) + 1:]:
+                return name
+        logging.warning("Field %s is a text field, aggregating on it will likely fail", field)
+    return field
+
+
+def get_histogram_interval(interval: str) -> Dict[str, str]:
+    """
+    Converts an interval to the date histogram parameter.
+    interval: a time unit as understood by Elasticsearch (eg, "30m", "1h", "1M")
+    return: the parameter to pass to the date histogram (calendar or fixed interval)
+    """
+    # Weeks, months, quarters and years don't have a fixed duration
+    if interval[-1:] in ("w", "M", "q", "y") or interval.isalpha():
+        return {"calendar_interval": interval}
+    else:
+        return {"fixed_interval": interval}
+
+
+def _add_fields(fields: Dict[str, str], properties: Dict[str, dict], prefix: str = "") -> None:
+    """
+    Add the fields of a mapping, including the sub-fields
+    fields: the fields found so far (field name -> type). It is updated.
+    properties: the "properties" of the mapping
+    prefix: the name of the parent object, with a final "."
+    """
+    for name, desc in properties.items():
+        full_name = prefix + name
+        if "properties" in desc:  # An object => also add each sub-field
+            fields.setdefault(full_name, desc.get("type", "object"))
+            _add_fields(fields, desc["properties"], full_name + ".")
+        else:
+            fields.setdefault(full_name, desc.get("type", "object"))
+        # Multi-fields (eg, "message.keyword")
+        for sub_name, sub_desc in desc.get("fields", {}).items():
+            fields.setdefault(full_name + "." + sub_name, sub_desc.get("type", "object"))
+
+
+def report_error(ex: SearchError) -> None:
+    """
+    Shows the error returned by the server for a search
+    """
+    if not isinstance(ex.error, dict):  # Some errors are just a text
+        logging.error("Search query failed: %s", ex)
+        return
+    logging.error("Search query failed")
+    # TODO: make it prettier (it should be some kind of recursive text?
+    for field, value in ex.error.items():
+        print("%s: %s" % (field, value))
 
-        fields.update(fields_desc.keys())
 
-    return list(fields)
+_END = object()  # Marker for the end of the prefetched iteration
+
+
+def _read_pages(pages: Iterable[PageReader]) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Reads each page entirely, so that the next page can be requested
+    """
+    for page in pages:
+        yield list(page)
+
+
+def _stream_pages(pages: Iterable[PageReader], n: int) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Reads each page by batches of (at most) n hits, while it is being received
+    """
+    for page in pages:
+        yield from batched(page, n)
+
+
+# Shortcuts, for a single request. Each of them opens a new connection.
+def get_pit(host: str, target: str, username: str, password: str, keep_alive: float = 60) -> str:
+    """
+    keep_alive: how long the PIT should be valid (s)
+    """
+    with Client(host, username, password) as client:
+        return client.get_pit(target, keep_alive)
+
+
+def search(host: str, target: str, username: str, password: str, match: Optional[Match] = None,
+           since: Optional[str] = None, until: Optional[str] = None,
+           fields: Optional[Set[str]] = None, prefetch: int = 0, parallel: int = 1,
+           page_size: Optional[int] = None
+           ) -> Iterator[Dict[str, Any]]:
+    """
+    See Client.search()
+    host: IP address/hostname + port of the elasticsearch server
+    """
+    with Client(host, username, password, max_connections=max(10, parallel)) as client:
+        yield from client.search(target, match, since, until, fields, prefetch, parallel, page_size)
+
+
+def search_batches(host: str, target: str, username: str, password: str, match: Optional[Match] = None,
+                   since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+                   fields: Optional[Set[str]] = None, prefetch: int = 1, parallel: int = 1,
+                   page_size: Optional[int] = None, timestamp_format: Optional[str] = None,
+                   columnar: bool = False
+                   ) -> Iterator[Union[List[Dict[str, Any]], Dict[str, Sequence]]]:
+    """
+    See Client.iter_batches()
+    host: IP address/hostname + port of the elasticsearch server
+    """
+    with Client(host, username, password, max_connections=max(10, parallel)) as client:
+        yield from client.iter_batches(target, match, since, until, fields, prefetch, parallel, page_size,
+                                       timestamp_format=timestamp_format, columnar=columnar)
+
+
+def list_fields(host: str, target: str, username: str, password: str) -> List[str]:
+    """
+    See Client.list_fields()
+    host: IP address/hostname + port of the elasticsearch server
+    """
+    with Client(host, username, password) as client:
+        return client.list_fields(target)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+# Writes the output into compressed files, for archiving.
+# The lines are grouped in blocks, which are each compressed independently, in
+# separate processes, so that all the CPUs are used. Each block is a complete
+# gzip "member" (or xz "stream"), and a file is the concatenation of blocks,
+# which is still a valid compressed file (eg, for zcat or xzcat).
+# A new file is started when the file is too big, or (optionally) every day.
+# The index file (index.jsonl) contains, for each block, one JSON line with:
+# * file: the name of the file
+# * offset: the position of the block in the file (bytes)
+# * size: the size of the block in the file (bytes)
+# * first, last: the timestamp of the first and last entry (ms since epoch)
+# * entries: the number of entries (lines)
+# So a period can be read by only decompressing the blocks which contain it.
+
+import collections
+from datetime import datetime, timezone
+import gzip
+import json
+import logging
+import lzma
+import multiprocessing
+import os
+import re
+import signal
+from typing import Any, Dict, Optional, Tuple
+
+BLOCK_SIZE = 4 * 1024 ** 2  # bytes (uncompressed), size of each block compressed at once
+DEFAULT_MAX_FILE_SIZE = 1024 ** 3  # bytes (compressed)
+COMPRESS_LEVEL = 6
+INDEX_FILE = "index.jsonl"
+COMPRESSIONS = {"gzip": ".gz", "xz": ".xz"}  # compression -> file extension
+DAY = 24 * 3600 * 1000  # ms
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_rotation(text: str) -> Tuple[Optional[int], bool]:
+    """
+    Converts the rotation definition from the command line
+    text: "day", or a size, like "500M" or "2G"
+    return:
+      max_size: the maximum size of a file (bytes), or None if not limited
+      daily: True if a new file is started every day
+    raises ValueError: if the text is not in a supported format
+    """
+    if text.lower() == "day":
+        return None, True
+    m = re.match(r"^(\d+)([KMGT]?)B?$", text.upper())
+    if not m:
+        raise ValueError("Rotation %s should be a size (eg, 500M) or day" % (text,))
+    return int(m.group(1)) * SIZE_UNITS[m.group(2)], False
+
+
+class Exporter:
+    """
+    Writes lines into compressed files, in a directory.
+    The compression runs in a pool of processes, while the lines are still
+    written in order.
+    """
+
+    def __init__(self, path: str, compression: str = "gzip", max_file_size: Optional[int] = DEFAULT_MAX_FILE_SIZE,
+                 daily: bool = False, workers: Optional[int] = None, suffix: str = ".log"):
+        """
+        path: the directory where to write the files. It's created if needed.
+          It must not already contain an export.
+        compression: "gzip" or "xz"
+        max_file_size: if not None, a new file is started before it gets bigger
+          than this size (bytes). It can only be exceeded by a single entry
+          (or a block which doesn't compress at all).
+        daily: if True, a new file is started for every day (in UTC)
+        workers: number of processes compressing. If None, the number of CPUs.
+        suffix: added to the name of the files, before the compression extension
+        raises ValueError: if the directory already contains an export
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError("Compression %s is not supported" % (compression,))
+        self.path = path
+        self._compression = compression
+        self._extension = suffix + COMPRESSIONS[compression]
+        self._max_file_size = max_file_size
+        self._daily = daily
+        # A block is never split between files, so it must fit in a file, even
+        # if it's hardly compressed
+        self._block_size = min(BLOCK_SIZE, max_file_size) if max_file_size else BLOCK_SIZE
+
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            raise ValueError("Directory %s already contains an export" % (path,))
+        self._index = open(index_path, "w")
+
+        # The block being filled
+        self._lines = []
+        self._size = 0
+        self._first_ts = None
+        self._last_ts = None
+
+        # The blocks being compressed, in order: (result, description)
+        self._pending: collections.deque = collections.deque()
+
+        # The file being written
+        self._file = None
+        self._file_name = None
+        self._file_day = None
+        self._n_files = 0
+        self.entries = 0  # Number of entries written
+
+        # The processes are started immediately, so that it happens before any
+        # thread is started (which is not safe with fork).
+        workers = workers or os.cpu_count() or 1
+        self._max_pending = workers * 2  # Enough to always keep all the workers busy
+        self._pool = multiprocessing.Pool(workers, initializer=_init_worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, line: str, ts: int) -> None:
+        """
+        Add a line
+        line: the text to write, without end-of-line
+        ts: the timestamp of the entry (ms since epoch). Must be in time order.
+        """
+        size = len(line) + 1
+        if self._lines and ((self._daily and ts // DAY != self._first_ts // DAY) or
+                            self._size + size > self._block_size):
+            self._submit()  # A block never spans two files, and is never bigger than a file
+
+        if self._first_ts is None:
+            self._first_ts = ts
+        self._last_ts = ts
+        self._lines.append(line)
+        self._size += size
+
+    def flush(self) -> None:
+        """
+        Write all the lines passed so far
+        """
+        if self._lines:
+            self._submit()
+        while self._pending:
+            self._write_next()
+        if self._file:
+            self._file.flush()
+
+    def close(self) -> None:
+        """
+        Write all the lines, and stop the processes. Can be called multiple times.
+        """
+        if self._pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.terminate()
+            self._pool = None
+            if self._file:
+                self._file.close()
+            self._index.close()
+        logging.info("Exported %d entries into %d files", self.entries, self._n_files)
+
+    def _submit(self) -> None:
+        """
+        Pass the current block to the compression
+        """
+        data = ("\n".join(self._lines) + "\n").encode("utf-8")
+        desc = {"first": self._first_ts, "last": self._last_ts, "entries": len(self._lines)}
+        self._pending.append((self._pool.apply_async(_compress, (data, self._compression)), desc))
+        self._lines = []
+        self._size = 0
+        self._first_ts = None
+        self._last_ts = None
+
+        # Limit the memory used, if the compression is slower than the search
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self) -> None:
+        """
+        Wait for the oldest block to be compressed, and write it
+        """
+        result, desc = self._pending.popleft()
+        data = result.get()
+
+        day = desc["first"] // DAY
+        if (self._file is None or
+            (self._daily and day != self._file_day) or
+            (self._max_file_size and self._file.tell() > 0 and self._file.tell() + len(data) > self._max_file_size)):
+            self._open_file(desc["first"])
+
+        offset = self._file.tell()
+        self._file.write(data)
+        # The file is written before the index, so that the index always refers to data present
+        self._file.flush()
+        entry: Dict[str, Any] = {"file": self._file_name, "offset": offset, "size": len(data)}
+        entry.update(desc)
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+        self.entries += desc["entries"]
+
+    def _open_file(self, ts: int) -> None:
+        """
+        Start a new file
+        ts: timestamp of the first entry of the file (ms since epoch)
+        """
+        if self._file:
+            self._file.close()
+        self._n_files += 1
+        # The name starts with the date, so that the files are sorted by time
+        date = datetime.fromtimestamp(ts / 1000, timezone.utc).strftime("%Y-%m-%d")
+        self._file_name = "%s_%04d%s" % (date, self._n_files, self._extension)
+        self._file_day = ts // DAY
+        logging.debug("Writing to %s", self._file_name)
+        self._file = open(os.path.join(self.path, self._file_name), "wb")
+
+
+def _init_worker() -> None:
+    # Ctrl+C is handled by the main process, which still writes the blocks
+    # already compressed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    """
+    Runs in a worker process
+    return: the data compressed, as a complete gzip member or xz stream
+    """
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+    else:
+        return lzma.compress(data, preset=COMPRESS_LEVEL)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+# Incremental parsing of the (potentially large) Elasticsearch search responses.
+# Instead of receiving the whole response, decoding it to a str, and then
+# converting it to a tree of dicts, the hits are parsed one at a time, while the
+# response is being received. So only one hit (and one chunk of the response)
+# is kept in memory, and the first hits are available before the end of the response.
+
+import codecs
+import json
+import re
+from typing import Any, Dict, Iterable, Iterator
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _StreamParser:
+    """
+    Reads JSON values from a stream of bytes, one token at a time
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        """
+        chunks: the stream of data, encoded in UTF-8
+        """
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """
+        Reads more data into the buffer
+        return: False if there is no more data
+        """
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            data = self._utf8.decode(chunk)
+            if data:
+                # Drop the part already parsed, to keep the buffer small
+                self._buf = self._buf[self._pos:] + data
+                self._pos = 0
+                return True
+        self._eof = True
+        self._buf = self._buf[self._pos:] + self._utf8.decode(b"", final=True)
+        self._pos = 0
+        return False
+
+    def peek(self) -> str:
+        """
+        return: the next non-whitespace character (without consuming it)
+        raises ValueError: if the end of the stream is reached
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def expect(self, chars: str) -> str:
+        """
+        Consumes the next non-whitespace character
+        chars: the characters allowed
+        return: the character read
+        raises ValueError: if the character is not one of the expected ones
+        """
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of '%s' at position %d, but got '%s'" % (chars, self._pos, c))
+        self._pos += 1
+        return c
+
+    def value(self) -> Any:
+        """
+        Reads a complete JSON value (eg, string, number, object...)
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Most likely the value is not entirely received yet
+                if not self._fill():
+                    raise
+                continue
+            # If the value stops exactly at the end of the buffer, it might
+            # continue in the next chunk (eg, a number)
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+
+def iter_hits(chunks: Iterable[bytes], meta: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Parses a search response, and passes each hit as soon as it is received.
+    chunks: the search response, as a stream of bytes
+    meta: dict which is filled with all the rest of the response (eg, "error", "pit_id").
+      The "hits" entry contains the "hits" part of the response, without the "hits" list.
+    yield: each hit of the "hits" list, in order
+    raises ValueError: if the data is not valid JSON
+    """
+    parser = _StreamParser(chunks)
+    for key in _object_keys(parser):
+        if key == "hits" and parser.peek() == "{":
+            hits_meta = meta.setdefault("hits", {})
+            for hkey in _object_keys(parser):
+                if hkey == "hits" and parser.peek() == "[":
+                    yield from _array_items(parser)
+                else:
+                    hits_meta[hkey] = parser.value()
+        else:
+            meta[key] = parser.value()
+
+
+def _object_keys(parser: _StreamParser) -> Iterator[str]:
+    """
+    Iterates over the keys of a JSON object. For each key, the caller must
+    read the value before asking for the next key.
+    """
+    parser.expect("{")
+    if parser.peek() == "}":
+        parser.expect("}")
+        return
+    while True:
+        key = parser.value()
+        parser.expect(":")
+        yield key
+        if parser.expect(",}") == "}":
+            return
+
+
+def _array_items(parser: _StreamParser) -> Iterator[Any]:
+    """
+    Iterates over each value of a JSON array
+    """
+    parser.expect("[")
+    if parser.peek() == "]":
+        parser.expect("]")
+        return
+    while True:
+        yield parser.value()
+        if parser.expect(",]") == "]":
+            return
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+# Reads the log entries directly from the log files (eg, /var/log/odemis.log),
+# to show the entries not yet indexed by the server, along with the others.
+# The files are in the same format as the raw_message field (see es.py), one
+# entry per line, with the timestamp in local time:
+# 2021-04-12 14:57:46,306\tDEBUG\tlakeshore:494:\tSIM: parsing *ESR?
+# The lines which don't start with a timestamp (eg, a traceback) are part of
+# the previous entry.
+# The file is memory-mapped, and the entries are expected in time order, so
+# the first entry of the period is found by binary search, without reading the
+# whole file.
+
+import collections
+from datetime import datetime, timezone
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import re
+import socket
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from elnok import cache, es, query
+
+# Pseudo-field, which contains the path of the file the hit comes from
+FILE_FIELD = "_file"
+
+# Fields of the entries read from the files. The other fields of the server
+# (eg, module) cannot be deduced from the text of the entries.
+ENTRY_FIELDS = frozenset({"@timestamp", "timestamp", "level", "component", "subcomponent", "line",
+                          "message", "raw_message", "host", "path"})
+
+# Timestamp at the beginning of a line, as "2021-04-12 14:57:46,306"
+_TIMESTAMP_RE = re.compile(rb"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3})\t")
+
+
+class LogFile:
+    """
+    A log file, from which the entries of a period can be read
+    """
+
+    def __init__(self, path: str):
+        """
+        path: the path of the log file
+        raises OSError: if the file cannot be opened
+        """
+        self.path = os.path.abspath(path)
+        self._host = socket.gethostname()
+        # The component is the name of the file, as for /var/log/odemis.log(.1)
+        self._component = os.path.basename(self.path).split(".", 1)[0]
+        self._file = open(path, "rb")
+        # mmap doesn't support empty files
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+        # Only the complete lines are read, as the last one might still be being written
+        self._size = self._map.rfind(b"\n") + 1
+
+        # Cache for the timestamp conversion, as many consecutive entries are in the same second
+        self._last_ts_prefix = None
+        self._last_ts_prefix_conv = None  # ms since epoch, @timestamp without the ms
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _parse_timestamp(self, pos: int) -> Optional[Tuple[int, str]]:
+        """
+        pos: the beginning of a line
+        return: the timestamp of the entry (ms since epoch) and in ISO format (UTC),
+          or None if the line doesn't start with a timestamp (ie, not an entry)
+        """
+        m = _TIMESTAMP_RE.match(self._map, pos, pos + 24)
+        if not m:
+            return None
+        prefix = m.group(1)
+        if prefix != self._last_ts_prefix:
+            # The time is local, so it depends on the timezone (and DST) of the computer
+            secs = int(time.mktime(time.strptime(prefix.decode("ascii"), "%Y-%m-%d %H:%M:%S")))
+            self._last_ts_prefix = prefix
+            iso_prefix = datetime.fromtimestamp(secs, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.")
+            self._last_ts_prefix_conv = secs * 1000, iso_prefix
+        ts, iso_prefix = self._last_ts_prefix_conv
+        ms = m.group(2).decode("ascii")
+        return ts + int(ms), iso_prefix + ms + "Z"
+
+    def _next_line(self, pos: int) -> int:
+        """
+        return: the beginning of the line after the one containing pos
+        """
+        end = self._map.find(b"\n", pos, self._size)
+        return self._size if end < 0 else end + 1
+
+    def _next_entry(self, pos: int) -> Tuple[int, Optional[int]]:
+        """
+        pos: any position in the file
+        return: the beginning of the first entry at or after pos, and its
+          timestamp (ms since epoch). If no entry, the end of the file and None.
+        """
+        if pos > 0 and self._map[pos - 1:pos] != b"\n":  # In the middle of a line
+            pos = self._next_line(pos)
+        while pos < self._size:
+            ts = self._parse_timestamp(pos)
+            if ts is not None:
+                return pos, ts[0]
+            pos = self._next_line(pos)
+        return self._size, None
+
+    def find(self, ts: int) -> int:
+        """
+        Look for the first entry at or after a given time
+        ts: the time (ms since epoch)
+        return: the position of the entry (or the end of the file, if all the
+          entries are older)
+        """
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos, entry_ts = self._next_entry(mid)
+            if entry_ts is None or entry_ts >= ts:
+                hi = mid
+            else:
+                lo = pos + 1
+        return self._next_entry(lo)[0]
+
+    def read(self, since: Optional[int] = None, until: Optional[int] = None,
+             hit_filter: Optional[query.HitFilter] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Read the entries of a period
+        since: the minimum time (ms since epoch)
+        until: the maximum time (ms since epoch)
+        hit_filter: if not None, only the hits fulfilling it are returned
+        yield: the hits, in the same format as the server (with the _source and
+          sort keys), in time order. In addition, each hit has the key "_file",
+          and the key "_cluster" (both containing the path of the file).
+        """
+        pos = self.find(since) if since is not None else self._next_entry(0)[0]
+        while pos < self._size:
+            ts, iso_ts = self._parse_timestamp(pos)
+            if until is not None and ts > until:
+                return
+            # The entry continues until the next line with a timestamp
+            end = self._next_line(pos)
+            while end < self._size and self._parse_timestamp(end) is None:
+                end = self._next_line(end)
+            hit = self._to_hit(self._map[pos:end], ts, iso_ts)
+            pos = end
+            if hit is None or (hit_filter and not hit_filter(hit)):
+                continue
+            yield hit
+
+    def _to_hit(self, data: bytes, ts: int, iso_ts: str) -> Optional[Dict[str, Any]]:
+        """
+        Converts the text of an entry to a hit, with the same fields as indexed
+        return: the hit, or None if the text is not in the expected format
+        """
+        raw_message = data.decode("utf-8", errors="replace").rstrip("\n")
+        try:
+            timestamp, level, location, message = raw_message.split("\t", 3)
+            subcomponent, line = location.rstrip(":").rsplit(":", 1)
+        except ValueError:
+            logging.info("Failed to parse entry %s of %s", raw_message[:100], self.path)
+            return None
+        source = {
+            "@timestamp": iso_ts,
+            "timestamp": timestamp,
+            "level": level,
+            "component": self._component,
+            "subcomponent": subcomponent,
+            "line": line,
+            "message": message,
+            "raw_message": raw_message,
+            "host": self._host,
+            "path": self.path,
+        }
+        return {"_source": source, "sort": [ts], FILE_FIELD: self.path, "_cluster": self.path}
+
+
+def merge(batches: Iterable[List[Dict[str, Any]]], files: List[LogFile],
+          conditions: Optional[List[query.Condition]] = None,
+          since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+          fields: Optional[Set[str]] = None) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Merges the hits from the server with the entries of log files.
+    The entries of the files already present in the hits (ie, already indexed)
+    are dropped.
+    batches: the hits from the server, by batches, in time order. The hits must
+      contain the message field.
+    files: the log files to read
+    conditions: the matches, which the entries of the files must fulfill
+    since: filter for the minimum time, in the Elasticsearch format, or in ms since epoch
+    until: filter for the maximum time, in the Elasticsearch format, or in ms since epoch
+    fields: restrict the fields of the entries of the files, and of the hits
+      from the server, except for the message field which is only removed from
+      them if not included
+    return: batches of hits, in time order
+    raises ValueError: if since or until are not in a supported format
+    """
+    nowdt = datetime.now(timezone.utc)
+    times = []
+    for t, round_up in ((since, False), (until, True)):
+        if isinstance(t, str):
+            ts = cache.parse_time(t, nowdt, round_up)
+            if ts is None:
+                raise ValueError("Date %s is not in a supported format" % (t,))
+            t = ts
+        times.append(t)
+    start, end = times
+
+    missing_fields = {c.field for c in conditions or []} - ENTRY_FIELDS
+    if missing_fields:
+        logging.warning("The entries of the log files don't have the fields %s, so they are matched "
+                        "as if these fields were absent", ", ".join(sorted(missing_fields)))
+    hit_filter = query.HitFilter(conditions) if conditions else None
+    streams = [f.read(start, end, hit_filter) for f in files]
+    return es.batched(_merge_unique(batches, streams, fields), es.MERGE_BATCH_SIZE)
+
+
+def _get_entry_key(hit: Dict[str, Any]) -> Tuple[int, str]:
+    """
+    return: an identifier of the entry, which is the same for the hit from the
+      server and from the file
+    """
+    # Only the first line, in case the server stores a multi-line entry differently
+    message = str(hit["_source"].get("message", ""))
+    return hit["sort"][0], message.split("\n", 1)[0]
+
+
+def _merge_unique(batches: Iterable[List[Dict[str, Any]]], streams: List[Iterator[Dict[str, Any]]],
+                  fields: Optional[Set[str]]) -> Iterator[Dict[str, Any]]:
+    """
+    fields: restrict the fields of the hits. The message field of the hits of
+      the batches is dropped if not part of them (as it's only needed to
+      recognize the entries).
+    yield: the hits of the batches and of the streams, in time order, without
+      the entries of the streams which are also in the batches
+    """
+    drop_message = fields is not None and "message" not in fields
+    # On the same timestamp, the hits from the server come first
+    hits = heapq.merge(itertools.chain.from_iterable(batches), *streams, key=lambda h: h["sort"][0])
+    for ts, same_ts_hits in itertools.groupby(hits, key=lambda h: h["sort"][0]):
+        same_ts_hits = list(same_ts_hits)
+        indexed = collections.Counter(_get_entry_key(h) for h in same_ts_hits if FILE_FIELD not in h)
+        for hit in same_ts_hits:
+            if FILE_FIELD in hit:
+                if indexed:
+                    key = _get_entry_key(hit)
+                    if indexed[key] > 0:  # Already indexed
+                        indexed[key] -= 1
+                        continue
+                if fields is not None:
+                    hit["_source"] = {f: v for f, v in hit["_source"].items() if f in fields}
+            elif drop_message:
+                hit["_source"].pop("message", None)
+            yield hit
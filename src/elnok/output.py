@@ -20,13 +20,22 @@ You should have received a copy of the GNU General Public License along with
 ELnoK. If not, see http://www.gnu.org/licenses/.
 '''
 from datetime import datetime
+import functools
 import json
 import logging
 import string
+from typing import Callable, List, Optional, TextIO, Tuple
 
 TIME_FMT = "%Y-%m-%d %H:%M:%S.%f"
+# Same as TIME_FMT, but in the Java DateTimeFormatter syntax, used by Elasticsearch
+ES_TIME_FMT = "yyyy-MM-dd HH:mm:ss.SSSSSS"
 # OUTPUT_FMT = "{@timestamp}\t{level}\t{module}\t{component}\t{subcomponent}:{line}\t{message}"
 
+MISSING_VALUE = "∅"  # Shown when a field is not present in the hit
+TIMESTAMP_FIELD = "@timestamp"
+# Pseudo-field, which contains the server the hit comes from, when searching multiple servers
+CLUSTER_FIELD = "_cluster"
+
 
 class DefaultFormatter(string.Formatter):
     """
@@ -37,7 +46,197 @@ class DefaultFormatter(string.Formatter):
             return super().get_value(key, args, kwargs)
         except KeyError:
             logging.info("Missing field %s", key)
-            return "∅"
+            return MISSING_VALUE
+
+
+class Renderer:
+    """
+    Converts hits into text lines, according to a format.
+    The format is parsed only once, at initialisation, so that converting each
+    hit only consists in picking up the fields and concatenating them.
+    """
+
+    def __init__(self, fmt: str, server_timestamp: bool = False):
+        """
+        fmt: formatting string, with the fields to replace encoded as "{field_name}"
+        server_timestamp: if True, the @timestamp is expected to be already
+          formatted by the server in ES_TIME_FMT (in hit["fields"]).
+        """
+        self.fmt = fmt
+        self.server_timestamp = server_timestamp
+        # The format is converted to a "%" format, with one "%s" per field
+        pct_fmt = []
+        # field name, conversion function, whether the conversion takes the value
+        # from the _source (or the whole hit)
+        self._fields: List[Tuple[str, Callable, bool]] = []
+        for literal, field, spec, conversion in string.Formatter().parse(fmt):
+            pct_fmt.append(literal.replace("%", "%%"))
+            if field is None:  # Just the end of the string
+                continue
+            from_source = True
+            if field == TIMESTAMP_FIELD and not spec and not conversion:
+                if server_timestamp:  # Already converted, and in the "fields"
+                    convert = functools.partial(_get_hit_value, ("fields", field, 0))
+                    from_source = False
+                else:
+                    convert = self._convert_timestamp
+            elif field == CLUSTER_FIELD:
+                convert = functools.partial(_get_hit_value, (CLUSTER_FIELD,))
+                from_source = False
+            else:
+                convert = self._get_converter(spec, conversion)
+            self._fields.append((field, convert, from_source))
+            pct_fmt.append("%s")
+        self._pct_fmt = "".join(pct_fmt)
+
+        # Cache for the timestamp conversion: the date & time until the second
+        # is the same for many consecutive hits, only the sub-seconds differ.
+        self._last_ts_prefix = None
+        self._last_ts_prefix_conv = None
+
+    @staticmethod
+    def _get_converter(spec: str, conversion: Optional[str]) -> Callable:
+        """
+        return: a function converting a value to a string, following the str.format() rules
+        """
+        if not spec and not conversion:
+            return str
+        formatter = string.Formatter()
+        return lambda v: format(formatter.convert_field(v, conversion), spec)
+
+    def _convert_timestamp(self, ts: str) -> str:
+        """
+        Converts the timestamp as stored by elasticsearch to the display format
+        ts: timestamp in ISO format, as "2021-04-12T12:58:07.926Z"
+        return: the timestamp in TIME_FMT, as "2021-04-12 12:58:07.926000"
+        """
+        # Fast path for the standard format: only the string layout changes
+        if len(ts) == 24 and ts[19] == "." and ts[23] == "Z":
+            prefix = ts[:19]
+            if prefix != self._last_ts_prefix:
+                if prefix[10] != "T":
+                    return self._parse_timestamp(ts)
+                self._last_ts_prefix = prefix
+                self._last_ts_prefix_conv = prefix[:10] + " " + prefix[11:] + "."
+            return self._last_ts_prefix_conv + ts[20:23] + "000"
+
+        return self._parse_timestamp(ts)
+
+    @staticmethod
+    def _parse_timestamp(ts: str) -> str:
+        """
+        Slow path of _convert_timestamp(), for any ISO format
+        """
+        for ts_fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+            try:
+                return datetime.strptime(ts, ts_fmt).strftime(TIME_FMT)
+            except ValueError:
+                pass
+        logging.info("Failed to parse timestamp %s", ts)
+        return ts
+
+    def __call__(self, hit: dict) -> str:
+        """
+        hit: the elastic search response of the hit, as-is. It should contain a
+          _source key (and a fields key if server_timestamp is True).
+        return: the line corresponding to the hit (without end-of-line)
+        """
+        source = hit.get("_source", {})
+        values = []
+        for field, convert, from_source in self._fields:
+            try:
+                if from_source:
+                    values.append(convert(source[field]))
+                else:
+                    values.append(convert(hit))
+            except KeyError:
+                # If field missing => replace by empty symbol
+                logging.info("Missing field %s", field)
+                values.append(MISSING_VALUE)
+
+        return self._pct_fmt % tuple(values)
+
+
+def _get_hit_value(path: tuple, hit: dict) -> str:
+    """
+    path: the keys (or indices) to reach the value in the hit
+    return: the value
+    raises KeyError: if the value is not present
+    """
+    v = hit
+    for k in path:
+        v = v[k]
+    return v
+
+
+def render_json_raw(hit: dict) -> str:
+    """
+    Converts a hit to the its JSON representation (only the _source part)
+    """
+    return json.dumps(hit["_source"])
+
+
+def render_json_raw_cluster(hit: dict) -> str:
+    """
+    Same as render_json_raw(), but also contains the server of the hit (as "_cluster")
+    """
+    source = dict(hit["_source"])
+    source[CLUSTER_FIELD] = hit.get(CLUSTER_FIELD)
+    return json.dumps(source)
+
+
+class BatchWriter:
+    """
+    Writes lines to a stream, in large chunks, to reduce the overhead of each write.
+    If the stream is a terminal, every line is written immediately.
+    """
+
+    def __init__(self, stream: TextIO, max_size: int = 256 * 1024):
+        """
+        stream: where to write the lines
+        max_size: number of characters after which the buffer is written
+        """
+        self._stream = stream
+        try:
+            interactive = stream.isatty()
+        except (AttributeError, ValueError):
+            interactive = False
+        self._max_size = 0 if interactive else max_size
+        self._buffer: List[str] = []
+        self._size = 0
+
+    def write(self, line: str) -> None:
+        """
+        Adds a line. It will be written later, at the latest on flush().
+        line: the text to write, without end-of-line
+        """
+        self._buffer.append(line)
+        self._size += len(line) + 1
+        if self._size > self._max_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all the lines buffered
+        """
+        if self._buffer:
+            self._buffer.append("")  # To get a end-of-line after the last line too
+            data = "\n".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._stream.write(data)
+        self._stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+@functools.lru_cache(maxsize=8)
+def _get_renderer(fmt: str) -> Renderer:
+    return Renderer(fmt)
 
 
 def print_hit(hit: dict, fmt: str):
@@ -46,21 +245,10 @@ def print_hit(hit: dict, fmt: str):
     hit: the elastic search response of the hit, as-is. It should contain a _source key.
     fmt: formatting string, with the fields to replace encoded as "{filed_name}"
     """
-    source = hit["_source"]
-
-    # Convert from timestamp -> epoch, and put it back into the user's format
-    # example @timestamp: "2021-04-12T12:58:07.926Z"
-    # TODO: do it lazyly in the formater
-    if "@timestamp" in source:
-        ts = datetime.strptime(source["@timestamp"], "%Y-%m-%dT%H:%M:%S.%fZ")
-        source["@timestamp"] = ts.strftime(TIME_FMT)
-
-    # If field missing => replace by empty symbol
-    formatter = DefaultFormatter()
     try:
-        print(formatter.format(fmt, **source))
+        print(_get_renderer(fmt)(hit))
     except KeyError:
-        logging.exception("Failed to print %s", source)
+        logging.exception("Failed to print %s", hit.get("_source"))
         raise
 
 
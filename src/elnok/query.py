@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+
+# Converts the matches passed by the user into an Elasticsearch query.
+# The syntax of a match is:
+# * field=value: the field contains the word(s) of value
+# * field=val*e: the field matches the wildcard pattern (* and ?)
+# * field~regex: the field matches the regular expression
+# * field!=value, field!~regex: the opposite (the entry is excluded if it matches)
+# The same field can be passed multiple times, in which case the entry is selected
+# if any of the (positive) matches is fulfilled. Matches on different fields
+# all have to be fulfilled.
+# As much as possible, the matches are converted to query clauses, evaluated by
+# the server. However, the patterns (wildcard and regex) can only be evaluated
+# on the complete value of the field, which is not available for the "text"
+# fields (only the words are indexed). If there is no "keyword" version of the
+# field, such match is evaluated locally, by HitFilter. The "keyword" version
+# doesn't contain the values which are too long (ignore_above, eg, tracebacks),
+# so the server also returns the entries without it, and the match is also
+# evaluated locally.
+# The regular expressions follow the Python syntax. The server uses a different
+# syntax (Lucene), so they are converted, which is only possible for the common
+# subset. The other ones are also evaluated locally.
+
+import collections
+import logging
+import re
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# The types of fields on which the server can evaluate wildcard and regexp queries
+PATTERN_TYPES = ("keyword", "constant_keyword", "wildcard")
+
+# field, operator, value. The field name cannot contain any of the operator characters.
+MATCH_RE = re.compile(r"^([^=!~]+)(!=|!~|=|~)(.*)$", re.DOTALL)
+
+# Characters which are special in the Lucene regular expressions (with all the
+# optional operators, as used by default by Elasticsearch), but not in Python
+LUCENE_ONLY_SPECIAL = '#@&<>~"'
+# Repetition, as "{2}", "{2,}", "{2,5}" or "{,5}"
+REPEAT_RE = re.compile(r"\{(\d*)(,?)(\d*)\}")
+
+
+class Condition:
+    """
+    One match on a field
+    """
+
+    def __init__(self, field: str, kind: str, value: str, negate: bool = False):
+        """
+        field: the name of the field
+        kind: "match" (contains the words), "wildcard" or "regexp"
+        value: the words or pattern
+        negate: if True, the entries matching are excluded
+        """
+        self.field = field
+        self.kind = kind
+        self.value = value
+        self.negate = negate
+
+    def __repr__(self):
+        return "Condition(%r, %r, %r, negate=%r)" % (self.field, self.kind, self.value, self.negate)
+
+    def compile(self) -> Callable[[str], bool]:
+        """
+        return: function which returns True if the value of the field matches
+          the condition (ignoring the negation)
+        """
+        if self.kind == "match":
+            # Approximates the default analyzer: lower case words, any of them is enough
+            words = set(re.findall(r"\w+", self.value.lower()))
+            return lambda v: not words.isdisjoint(re.findall(r"\w+", v.lower()))
+        elif self.kind == "wildcard":
+            # Like Elasticsearch, the pattern has to match the whole value, and
+            # only * (any characters) and ? (one character) are special.
+            pattern = "".join(".*" if p == "*" else "." if p == "?" else re.escape(p)
+                              for p in re.split(r"([*?])", self.value))
+            return re.compile(pattern, re.DOTALL).fullmatch
+        elif self.kind == "regexp":
+            return re.compile(self.value, re.DOTALL).fullmatch
+        else:
+            raise ValueError("Unknown condition kind %s" % (self.kind,))
+
+
+def parse_match(text: str) -> Condition:
+    """
+    Converts a match from the command line into a condition
+    text: the match, as "field=value", "field!=value", "field~regex", or "field!~regex"
+    return: the corresponding condition
+    raises ValueError: if the text is not a valid match
+    """
+    m = MATCH_RE.match(text)
+    if not m or not m.group(3):
+        raise ValueError("Match %s is not in the format field=value" % (text,))
+    field, op, value = m.groups()
+    if op.endswith("~"):
+        kind = "regexp"
+        try:
+            re.compile(value)
+        except re.error as ex:
+            raise ValueError("Match %s has an invalid regular expression: %s" % (text, ex))
+    elif "*" in value or "?" in value:
+        kind = "wildcard"
+    else:
+        kind = "match"
+    return Condition(field, kind, value, negate=op.startswith("!"))
+
+
+class HitFilter:
+    """
+    Selects the hits which fulfill the conditions, for the conditions which
+    cannot be evaluated by the server.
+    Same semantics as the matches: the positive conditions on the same field
+    are OR'd, and all the fields must be fulfilled, while none of the negated
+    conditions must be.
+    """
+
+    def __init__(self, conditions: List[Condition]):
+        """
+        conditions: the conditions to evaluate
+        """
+        self.conditions = conditions
+        # field -> functions
+        self._includes: Dict[str, List[Callable[[str], bool]]] = collections.OrderedDict()
+        self._excludes: List[Tuple[str, Callable[[str], bool]]] = []
+        for c in conditions:
+            if c.negate:
+                self._excludes.append((c.field, c.compile()))
+            else:
+                self._includes.setdefault(c.field, []).append(c.compile())
+
+    @property
+    def fields(self) -> Set[str]:
+        """
+        The fields needed in the hits to evaluate the conditions
+        """
+        return {c.field for c in self.conditions}
+
+    def __call__(self, hit: dict) -> bool:
+        """
+        hit: the elastic search response of the hit. It should contain all the fields needed in the _source.
+        return: True if the hit fulfills all the conditions
+        """
+        source = hit["_source"]
+        for field, matchers in self._includes.items():
+            try:
+                v = str(source[field])
+            except KeyError:
+                return False
+            if not any(m(v) for m in matchers):
+                return False
+
+        for field, matcher in self._excludes:
+            try:
+                v = str(source[field])
+            except KeyError:
+                continue
+            if matcher(v):
+                return False
+
+        return True
+
+
+def plan(conditions: List[Condition], field_types: Dict[str, str], check_long: bool = True
+         ) -> Tuple[List[dict], Optional[HitFilter]]:
+    """
+    Converts the conditions to query clauses for the server, and (if needed)
+    a filter for the conditions which cannot be evaluated by the server.
+    conditions: the matches, as returned by parse_match()
+    field_types: field name -> type, as returned by Client.get_field_types()
+    check_long: if False, the values too long to be evaluated by the server
+      (see _get_missing_clause()) are not checked locally, and the entries
+      with such values are ignored (a warning is logged).
+    return:
+      clauses: the query clauses (in the elasticsearch query DSL) to pass as
+        "match" to the search. They all have to be fulfilled.
+      hit_filter: the filter to apply to the hits received, or None if the
+        server can evaluate all the conditions.
+    """
+    clauses = []
+    local_conds = []
+
+    # The positive conditions on the same field are OR'd => group them
+    includes: Dict[str, List[Condition]] = collections.OrderedDict()
+    for c in conditions:
+        if not c.negate:
+            includes.setdefault(c.field, []).append(c)
+
+    for field, conds in includes.items():
+        field_clauses = _get_clauses(field, conds, field_types)
+        if field_clauses is None:
+            # One of the alternatives cannot be evaluated by the server => all of them locally
+            local_conds.extend(conds)
+            continue
+        missing_clause = _get_missing_clause(field, conds, field_types)
+        if missing_clause and check_long:
+            # The server cannot evaluate the long values => also return them, to check them locally
+            field_clauses.append(missing_clause)
+            local_conds.extend(conds)
+        elif missing_clause:
+            logging.warning("Entries with a long %s (eg, a traceback) will not be matched", field)
+        if len(field_clauses) == 1:
+            clauses.append(field_clauses[0])
+        else:
+            clauses.append({"bool": {"should": field_clauses, "minimum_should_match": 1}})
+
+    exclusions = []
+    for c in conditions:
+        if c.negate:
+            field_clauses = _get_clauses(c.field, [c], field_types)
+            if field_clauses is None:
+                local_conds.append(c)
+            else:
+                exclusions.extend(field_clauses)
+                if _get_missing_clause(c.field, [c], field_types):
+                    if check_long:  # The long values are not excluded by the server
+                        local_conds.append(c)
+                    else:
+                        logging.warning("Entries with a long %s (eg, a traceback) will not be excluded", c.field)
+    if exclusions:
+        clauses.append({"bool": {"must_not": exclusions}})
+
+    if local_conds:
+        logging.info("Matches %s will be evaluated locally", ", ".join(repr(c) for c in local_conds))
+        return clauses, HitFilter(local_conds)
+    return clauses, None
+
+
+def _get_clauses(field: str, conditions: List[Condition], field_types: Dict[str, str]
+                 ) -> Optional[List[dict]]:
+    """
+    Converts conditions on the same field into query clauses
+    conditions: conditions on the field. They are OR'd.
+    return: the query clauses (any of them has to match), or None if the server
+      cannot evaluate one of the conditions.
+    """
+    clauses = []
+    words = []
+    for c in conditions:
+        if c.kind == "match":
+            words.append(c.value)
+            continue
+
+        pattern_field = _get_pattern_field(field, field_types)
+        if pattern_field is None:
+            return None
+        value = c.value
+        if c.kind == "regexp":
+            value = to_lucene_regexp(value)
+            if value is None:
+                logging.debug("Regular expression %s cannot be converted for the server", c.value)
+                return None
+        clauses.append({c.kind: {pattern_field: {"value": value}}})
+
+    if words:
+        if field_types.get(field) in PATTERN_TYPES and len(words) > 1:
+            # The complete value is indexed: look for exactly one of the values
+            clauses.insert(0, {"terms": {field: words}})
+        else:
+            # There are many types of text search. "match" looks for any of the words
+            # (separated by spaces). It works also for the non-text fields,
+            # in which case it's an exact match.
+            # TODO make the query case sensitive. It should be the matter of selecting
+            # the right analyzer.
+            # https://www.elastic.co/guide/en/elasticsearch/reference/current/specify-analyzer.html
+            # However, for now adding "analyzer": "whitespace" seems to only make
+            # the query text as-is, while the fields are always lowercase...
+            clauses.insert(0, {"match": {field: {"query": " ".join(words)}}})
+
+    return clauses
+
+
+def _get_missing_clause(field: str, conditions: List[Condition], field_types: Dict[str, str]
+                        ) -> Optional[dict]:
+    """
+    Checks whether the conditions are evaluated by the server on the "keyword"
+    version of the field, which doesn't contain the values too long.
+    conditions: conditions on the field, which can be evaluated by the server
+    return: the query clause selecting the entries with a value too long for
+      the "keyword" version, or None if the server evaluates all the values.
+    """
+    if not any(c.kind != "match" for c in conditions):
+        return None
+    pattern_field = _get_pattern_field(field, field_types)
+    if pattern_field == field:
+        return None
+    return {"bool": {"filter": [{"exists": {"field": field}}],
+                     "must_not": [{"exists": {"field": pattern_field}}]}}
+
+
+def _get_pattern_field(field: str, field_types: Dict[str, str]) -> Optional[str]:
+    """
+    Find the field on which the server can evaluate wildcard and regexp queries
+    return: the name of the field to use, or None if there is no such field
+    """
+    ftype = field_types.get(field)
+    if ftype in PATTERN_TYPES:
+        return field
+    elif ftype == "text":
+        # Typically, the text fields also have a "keyword" version.
+        # Note that such version is only present if the value is not too long
+        # (ignore_above), see _get_missing_clause().
+        for name, subtype in field_types.items():
+            if subtype in PATTERN_TYPES and name.startswith(field + ".") and "." not in name[len(field) + 1:]:
+                return name
+    return None
+
+
+def to_lucene_regexp(pattern: str) -> Optional[str]:
+    """
+    Converts a (Python) regular expression to the syntax of the regexp query of
+    Elasticsearch (Lucene). Only the common subset is supported: the literal
+    characters, ., *, +, ?, {m,n}, |, groups, character sets (with ranges), and
+    \\d. As the server always matches the complete value, ^ and $ are only
+    accepted at the beginning and at the end.
+    pattern: the regular expression, to match the complete value (ie, fullmatch())
+    return: the equivalent regular expression, or None if it uses a syntax which
+      cannot be converted
+    """
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            esc = _convert_escape(pattern[i + 1:i + 2])
+            if esc is None:
+                return None
+            out.append(esc)
+            i += 2
+            continue
+        elif c == "[":
+            end, charset = _convert_charset(pattern, i)
+            if charset is None:
+                return None
+            out.append(charset)
+            i = end
+            continue
+        elif c == "{":
+            m = REPEAT_RE.match(pattern, i)
+            if m and (m.group(1) or m.group(3)):
+                out.append("{%s%s%s}" % (m.group(1) or "0", m.group(2), m.group(3)))
+                i = m.end()
+            else:  # Not a repetition => just the character
+                out.append("\\{")
+                i += 1
+            if pattern[i:i + 1] in ("?", "+"):  # Lazy or possessive
+                return None
+            continue
+        elif c in "*+?":
+            if pattern[i + 1:i + 2] in ("?", "+"):  # Lazy or possessive
+                return None
+            out.append(c)
+        elif c == "(":
+            if pattern[i + 1:i + 2] == "?":  # Extensions (non-capturing group, lookahead...)
+                return None
+            out.append(c)
+        elif c in ").|":
+            out.append(c)
+        elif c == "^":
+            if i != 0:
+                return None
+        elif c == "$":
+            if i != len(pattern) - 1:
+                return None
+        elif c in LUCENE_ONLY_SPECIAL:
+            out.append("\\" + c)
+        else:
+            out.append(c)
+        i += 1
+    return "".join(out)
+
+
+def _convert_escape(c: str) -> Optional[str]:
+    """
+    c: the character after a backslash
+    return: the equivalent in Lucene syntax, or None if not supported
+    """
+    if c == "d":
+        return "[0-9]"
+    elif not c or c.isalnum():  # Special sequences (eg, \w, \b), or back-references
+        return None
+    return "\\" + c
+
+
+def _convert_charset(pattern: str, start: int) -> Tuple[int, Optional[str]]:
+    """
+    Converts a set of characters (eg, "[^a-z_]")
+    start: position of the opening bracket in the pattern
+    return: the position after the closing bracket, and the equivalent set in
+      Lucene syntax (or None if not supported)
+    """
+    out = ["["]
+    i = start + 1
+    if pattern[i:i + 1] == "^":
+        out.append("^")
+        i += 1
+    first = True
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "]" and not first:
+            out.append("]")
+            return i + 1, "".join(out)
+        first = False
+        if c == "\\":
+            esc = pattern[i + 1:i + 2]
+            if esc == "d":
+                out.append("0-9")
+            elif not esc or esc.isalnum():
+                return i, None
+            else:
+                out.append("\\" + esc)
+            i += 2
+            continue
+        elif c in "[]&~":  # Special in Lucene (or in future versions of Python)
+            out.append("\\" + c)
+        else:
+            out.append(c)
+        i += 1
+    return i, None  # No end
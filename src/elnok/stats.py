@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+
+# Measurements of where the time is spent, to find out whether a slow search
+# is due to the server, the network, the parsing, or the output.
+# Every time a page of results is completely received, a PageStats is passed to
+# all the functions subscribed. To get them:
+# stats.subscribe(callback)
+# Note that the detailed measurements (of the parsing) are only done when there
+# is at least one subscriber.
+
+import bisect
+import collections
+import threading
+import time
+from typing import Callable, List
+
+# Upper bounds of the bins of the page latency histogram (s)
+LATENCY_BINS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30)
+
+
+class PageStats:
+    """
+    Measurements of one page of results (ie, one search request)
+    """
+
+    def __init__(self):
+        self.hits = 0  # Number of hits
+        self.nbytes = 0  # Size of the response, after decompression (bytes)
+        self.wire_bytes = 0  # Size of the response, as received (bytes)
+        self.latency = 0  # Time between sending the request and receiving the headers of the response (s)
+        self.network = 0  # Total time waiting for the server, including the latency (s)
+        self.decode = 0  # Time spent parsing the response (s)
+        self.duration = 0  # Time to send the request and receive the response, without the time of the caller (s)
+
+
+# Functions called with a PageStats, every time a page is received
+subscribers: List[Callable[[PageStats], None]] = []
+
+
+def subscribe(callback: Callable[[PageStats], None]) -> None:
+    """
+    Register a function to be called every time a page is received.
+    Note that the function may be called from a separate thread.
+    callback: function which receives a PageStats
+    """
+    subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[PageStats], None]) -> None:
+    """
+    Stop calling the function. It must have been subscribed before.
+    """
+    subscribers.remove(callback)
+
+
+def publish(page: PageStats) -> None:
+    """
+    Pass the measurements of a page to all the subscribers
+    """
+    for callback in subscribers:
+        callback(page)
+
+
+class Collector:
+    """
+    Accumulates the measurements of all the pages, and of the output.
+    To be subscribed, to get the information about the pages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # The pages can be received in separate threads
+        self._start = time.perf_counter()
+        self.pages = 0
+        self.hits = 0
+        self.nbytes = 0
+        self.wire_bytes = 0
+        self.network = 0
+        self.decode = 0
+        self.latencies = [0] * (len(LATENCY_BINS) + 1)  # Number of pages in each bin (the last one is "more")
+        # Name of the step -> time spent (s)
+        self.steps = collections.OrderedDict()
+
+    def __call__(self, page: PageStats) -> None:
+        with self._lock:
+            self.pages += 1
+            self.hits += page.hits
+            self.nbytes += page.nbytes
+            self.wire_bytes += page.wire_bytes
+            self.network += page.network
+            self.decode += page.decode
+            self.latencies[bisect.bisect_left(LATENCY_BINS, page.latency)] += 1
+
+    def timed(self, step: str, func: Callable) -> Callable:
+        """
+        Measures the time spent in a function
+        step: the name under which the time is counted
+        func: the function to measure
+        return: a function which behaves the same as func
+        """
+        self.steps.setdefault(step, 0)
+
+        def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.steps[step] += time.perf_counter() - start
+
+        return timed_func
+
+    def summary(self) -> str:
+        """
+        return: a (multi-line) human-readable summary of the measurements
+        """
+        lines = [
+            "Pages: %d, hits: %d" % (self.pages, self.hits),
+            "Received: %.1f MB (%.1f MB transferred)" % (self.nbytes / 1e6, self.wire_bytes / 1e6),
+            "Waiting for the server: %.3f s" % (self.network,),
+            "Decoding: %.3f s" % (self.decode,),
+        ]
+        for step, duration in self.steps.items():
+            lines.append("%s: %.3f s" % (step.capitalize(), duration))
+        lines.append("Total: %.3f s" % (time.perf_counter() - self._start,))
+
+        lines.append("Page latency:")
+        for i, n in enumerate(self.latencies):
+            if i < len(LATENCY_BINS):
+                lines.append("  < %6g s: %d" % (LATENCY_BINS[i], n))
+            else:
+                lines.append("  >=%6g s: %d" % (LATENCY_BINS[-1], n))
+        return "\n".join(lines)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 16 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+# Local copy of the log entries, to search them repeatedly without the server.
+# The entries are stored in a SQLite database, which contains:
+# * hits: one row per entry, with its timestamp (ms since epoch, indexed) and
+#   its _source (as JSON).
+# * words: for the fields selected to be indexed, the (lower case) words of
+#   their value. It allows to quickly find the entries matching field=value,
+#   which has the same semantics as the "match" query of the server.
+# * meta: the description of the search synchronized, the position of the
+#   last entry synchronized, so that the next synchronization continues from there,
+#   and the names of all the fields present in the entries.
+# The position is updated in the same transaction as the entries, so even if the
+# synchronization is interrupted, the store stays consistent.
+
+from datetime import datetime, timezone
+import json
+import logging
+import re
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+from elnok import cache, es, query
+
+SCHEMA_VERSION = 1
+COMMIT_SIZE = 10000  # Number of entries inserted per transaction
+# The newest entries are not synchronized yet, to let them be indexed by the server
+# (as the entries indexed later with an older timestamp would be missed)
+SYNC_UNTIL = "now-1m"
+
+
+class Store:
+    """
+    Local database of log entries
+    """
+
+    def __init__(self, path: str):
+        """
+        path: the file of the database. It's created if it doesn't exist.
+        """
+        self.path = path
+        self._db = sqlite3.connect(path)
+        # Allows reading the store while it's being synchronized
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS hits (id INTEGER PRIMARY KEY, "
+                             "ts INTEGER NOT NULL, source TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS hits_ts ON hits (ts)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS words (field TEXT NOT NULL, "
+                             "word TEXT NOT NULL, hit INTEGER NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS words_field_word ON words (field, word)")
+            version = self.get_meta("version")
+            if version is None:
+                self.set_meta("version", SCHEMA_VERSION)
+            elif version != SCHEMA_VERSION:
+                raise ValueError("Store %s has an unsupported version %s" % (path, version))
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_meta(self, key: str) -> Any:
+        """
+        return: the value stored for the key, or None if it's not present
+        """
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key: str, value: Any) -> None:
+        """
+        Store a value. It's written on disk with the next commit.
+        value: any JSON-compatible value
+        """
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    @property
+    def indexed_fields(self) -> List[str]:
+        """
+        The fields whose words are indexed
+        """
+        return self.get_meta("indexed_fields") or []
+
+    def add_indexed_fields(self, fields: Iterable[str]) -> None:
+        """
+        Index the words of more fields. The entries already stored are indexed too.
+        fields: the names of the fields
+        """
+        new_fields = [f for f in fields if f not in self.indexed_fields]
+        if not new_fields:
+            return
+        logging.info("Indexing fields %s", ", ".join(new_fields))
+        with self._db:
+            rows = self._db.execute("SELECT id, source FROM hits")
+            self._db.executemany("INSERT INTO words (field, word, hit) VALUES (?, ?, ?)",
+                                 ((f, w, hid) for hid, source in rows
+                                  for f, w in _get_words(json.loads(source), new_fields)))
+            self.set_meta("indexed_fields", self.indexed_fields + new_fields)
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM hits").fetchone()[0]
+
+    def list_fields(self) -> List[str]:
+        """
+        return: the names of all the fields present in the entries stored
+        """
+        fields = self.get_meta("fields")
+        if fields is None:  # Stored before the fields were recorded => look at all the entries
+            found: Set[str] = set()
+            for source, in self._db.execute("SELECT source FROM hits"):
+                found.update(json.loads(source).keys())
+            fields = sorted(found)
+            with self._db:
+                self.set_meta("fields", fields)
+        return fields
+
+    def sync(self, client: es.Client, target: str, match: Optional[es.Match] = None,
+             hit_filter: Optional[query.HitFilter] = None, since: Union[str, int, None] = None,
+             **kwargs) -> int:
+        """
+        Download the entries newer than the ones already stored
+        client: the connection to the server
+        target: the name of the index. Can be a pattern.
+        match: the query clauses to select the entries (see Client.search())
+        hit_filter: the filter for the matches which are not evaluated by the server
+        since: the oldest time to download, when the store is still empty
+        kwargs: passed as-is to Client.iter_search()
+        return: the number of entries added
+        raises SearchError: if the server failed to run the search
+        raises requests.RequestException: if the connection to the server failed
+        """
+        state = self.get_meta("position")
+        position = es.SearchPosition.from_dict(state) if state else es.SearchPosition()
+        if position.ts is not None:
+            logging.info("Continuing synchronization from %s", position.ts)
+            since = None  # The position already restricts the period
+
+        # All the fields are needed, to be able to show any of them later
+        hits = client.iter_search(target, match=match, since=since, until=SYNC_UNTIL,
+                                  position=position, **kwargs)
+        indexed_fields = self.indexed_fields
+        n = 0
+        batch = []
+        for hit in hits:
+            if hit_filter and not hit_filter(hit):
+                continue
+            batch.append(hit)
+            if len(batch) >= COMMIT_SIZE:
+                # position already takes into account all the hits of the batch
+                self._insert(batch, indexed_fields, position)
+                n += len(batch)
+                batch = []
+        # Store the position even without new entries, as it may skip filtered entries
+        self._insert(batch, indexed_fields, position)
+        n += len(batch)
+        return n
+
+    def _insert(self, hits: List[Dict[str, Any]], indexed_fields: List[str],
+                position: es.SearchPosition) -> None:
+        """
+        Add entries, and store the new position, in one transaction
+        """
+        fields = set(self.list_fields())
+        n_fields = len(fields)
+        with self._db:
+            for hit in hits:
+                source = hit["_source"]
+                fields.update(source.keys())
+                cur = self._db.execute("INSERT INTO hits (ts, source) VALUES (?, ?)",
+                                       (hit["sort"][0], json.dumps(source, separators=(",", ":"))))
+                self._db.executemany("INSERT INTO words (field, word, hit) VALUES (?, ?, ?)",
+                                     ((f, w, cur.lastrowid) for f, w in _get_words(source, indexed_fields)))
+            if len(fields) != n_fields:
+                self.set_meta("fields", sorted(fields))
+            self.set_meta("position", position.to_dict())
+
+    def search(self, conditions: Optional[List[query.Condition]] = None,
+               since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+               fields: Optional[Set[str]] = None, reverse: bool = False
+               ) -> Iterator[Dict[str, Any]]:
+        """
+        Search the entries stored, in the same way as Client.search()
+        conditions: the matches, as returned by query.parse_match()
+        since: filter for the minimum time, in the Elasticsearch format, or in ms since epoch
+        until: filter for the maximum time, in the Elasticsearch format, or in ms since epoch
+        fields: restrict the fields to return in the hit
+        reverse: if True, the newest entries are returned first
+        return: the hits, in the same format as the server (with only the
+          _source and sort keys), in time order
+        raises ValueError: if since or until are not in a supported format
+        """
+        nowdt = datetime.now(timezone.utc)
+        start = _parse_time(since, nowdt)
+        end = _parse_time(until, nowdt, round_up=True)
+        conditions = conditions or []
+
+        sql = "SELECT ts, source FROM hits WHERE 1"
+        params: List[Any] = []
+        if start is not None:
+            sql += " AND ts >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND ts <= ?"
+            params.append(end)
+        # Use the index for the fields where any of the words has to be present.
+        # It's only a pre-selection, the conditions are checked exactly afterwards.
+        indexed_fields = self.indexed_fields
+        includes: Dict[str, List[query.Condition]] = {}
+        for c in conditions:
+            if not c.negate:
+                includes.setdefault(c.field, []).append(c)
+        for field, conds in includes.items():
+            if field in indexed_fields and all(c.kind == "match" for c in conds):
+                words = sorted({w for c in conds for w in re.findall(r"\w+", c.value.lower())})
+                if not words:  # Nothing to look for in the index => let the filter decide
+                    logging.warning("The matches on %s contain no word, so no entry can match", field)
+                    continue
+                sql += (" AND id IN (SELECT hit FROM words WHERE field = ? AND word IN (%s))"
+                        % (",".join("?" * len(words)),))
+                params.append(field)
+                params.extend(words)
+        sql += " ORDER BY ts DESC, id DESC" if reverse else " ORDER BY ts, id"
+        logging.debug("Running %s with %s", sql, params)
+
+        hit_filter = query.HitFilter(conditions) if conditions else None
+        return self._read_hits(self._db.execute(sql, params), hit_filter, fields)
+
+    @staticmethod
+    def _read_hits(rows: Iterable, hit_filter: Optional[query.HitFilter],
+                   fields: Optional[Set[str]]) -> Iterator[Dict[str, Any]]:
+        for ts, source in rows:
+            hit = {"_source": json.loads(source), "sort": [ts]}
+            if hit_filter and not hit_filter(hit):
+                continue
+            if fields is not None:
+                hit["_source"] = {f: v for f, v in hit["_source"].items() if f in fields}
+            yield hit
+
+    def search_last(self, n: int, conditions: Optional[List[query.Condition]] = None,
+                    since: Union[str, int, None] = None, until: Union[str, int, None] = None,
+                    fields: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Same as search(), but only returns the latest n entries (in time order)
+        """
+        hits = []
+        if n > 0:
+            for hit in self.search(conditions, since, until, fields, reverse=True):
+                hits.append(hit)
+                if len(hits) >= n:
+                    break
+        hits.reverse()
+        return hits
+
+
+def _parse_time(t: Union[str, int, None], nowdt: datetime, round_up: bool = False) -> Optional[int]:
+    """
+    return: the time in ms since epoch, or None if no time
+    raises ValueError: if the time format is not supported
+    """
+    if t is None or isinstance(t, int):
+        return t
+    ts = cache.parse_time(t, nowdt, round_up)
+    if ts is None:
+        raise ValueError("Date %s is not in a supported format" % (t,))
+    return ts
+
+
+def _get_words(source: Dict[str, Any], fields: Iterable[str]) -> Iterator[tuple]:
+    """
+    return: (field, word) for each (different) word of the fields of the entry.
+      It's the same definition of word as query.Condition.
+    """
+    for f in fields:
+        try:
+            v = str(source[f])
+        except KeyError:
+            continue
+        for w in set(re.findall(r"\w+", v.lower())):
+            yield f, w
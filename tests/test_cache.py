@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+import calendar
+from datetime import datetime, timezone
+import os
+import time
+
+import pytest
+
+from elnok import cache
+
+NOW = datetime(2021, 4, 14, 10, 30, 15, 123456, timezone.utc)
+
+
+def ms(*args) -> int:
+    """
+    return: the time in ms since epoch of the UTC date
+    """
+    dt = datetime(*args)
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+@pytest.mark.parametrize("text, round_up, expected", [
+    ("now", False, ms(2021, 4, 14, 10, 30, 15, 123000)),
+    ("now", True, ms(2021, 4, 14, 10, 30, 15, 123000)),
+    ("now-1d", False, ms(2021, 4, 13, 10, 30, 15, 123000)),
+    ("now/d", False, ms(2021, 4, 14)),
+    ("now/d", True, ms(2021, 4, 14, 23, 59, 59, 999000)),
+    ("now-1M/M", False, ms(2021, 3, 1)),
+    ("now-1M/M", True, ms(2021, 3, 31, 23, 59, 59, 999000)),
+    ("now/w", False, ms(2021, 4, 12)),  # Monday
+    ("now+2h/h", True, ms(2021, 4, 14, 12, 59, 59, 999000)),
+    ("2021-04-12", False, ms(2021, 4, 12)),
+    ("2021-04-12", True, ms(2021, 4, 12, 23, 59, 59, 999000)),
+    ("2021-04-12T12:58:10", True, ms(2021, 4, 12, 12, 58, 10, 999000)),
+    ("2021-04-12T12:58:10Z", False, ms(2021, 4, 12, 12, 58, 10)),
+    ("2021-04-12T12:58:10.250", True, ms(2021, 4, 12, 12, 58, 10, 250000)),
+    ("2021-02", True, ms(2021, 2, 28, 23, 59, 59, 999000)),
+    ("2021-01-31||+1M", False, ms(2021, 2, 28)),
+    ("2021-04-12||-1d/d", True, ms(2021, 4, 11, 23, 59, 59, 999000)),
+])
+def test_parse_time(text, round_up, expected):
+    assert cache.parse_time(text, NOW, round_up) == expected
+
+
+def test_parse_time_naive_now():
+    # A naive UTC time gives the same result
+    assert cache.parse_time("now-1h/h", NOW.replace(tzinfo=None)) == cache.parse_time("now-1h/h", NOW)
+
+
+@pytest.mark.parametrize("text", ["yesterday", "now-1x", "now-1d+", "2021-13-01", "2021-04-12||1d"])
+def test_parse_time_unsupported(text):
+    assert cache.parse_time(text, NOW) is None
+
+
+def test_plan(tmp_path):
+    c = cache.Cache(str(tmp_path))
+    key_dir = str(tmp_path / "key")
+    os.makedirs(key_dir)
+    h = cache.BUCKET_DURATION
+    start = 100 * h
+    # The second bucket is already stored
+    open(c._bucket_path(key_dir, start + h), "w").close()
+    now = start + 10 * h
+    parts = list(c._plan(key_dir, start + h // 2, start + 4 * h, now))
+    assert parts == [(start + h // 2, start + h, []),  # Incomplete bucket
+                     (start + h, start + 2 * h, None),  # Read from the cache
+                     (start + 2 * h, start + 4 * h, [start + 2 * h, start + 3 * h])]
+
+    # The buckets not closed yet are not stored
+    now = start + 3 * h + cache.CLOSED_DELAY * 3 // 2
+    parts = list(c._plan(key_dir, start + 2 * h, start + 4 * h, now))
+    assert parts == [(start + 2 * h, start + 4 * h, [start + 2 * h])]
+
+
+def test_read_bucket(tmp_path):
+    c = cache.Cache(str(tmp_path))
+    path = str(tmp_path / "0.ndjson.gz")
+    hits = [{"_source": {"message": "m%d" % i}, "sort": [i]} for i in range(cache.READ_BATCH_SIZE + 5)]
+    w = cache._BucketWriter(path)
+    for hit in hits:
+        w.write(hit)
+    w.commit()
+
+    batches = list(c._read_bucket(path))
+    assert [len(b) for b in batches] == [cache.READ_BATCH_SIZE, 5]
+    assert sum(batches, []) == hits
+
+    # Removed (eg, by another process) => cannot be read
+    os.remove(path)
+    assert c._read_bucket(path) is None
+
+
+def test_evict(tmp_path):
+    c = cache.Cache(str(tmp_path), max_size=2500)
+    now = time.time()
+    for i, name in enumerate(["a", "b", "c"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 1000)
+        os.utime(str(path), (now - 100 + i, now - 100 + i))
+    # Being written by another process
+    (tmp_path / "d.1234.tmp").write_bytes(b"x" * 1000)
+    # Left over by a process which was killed
+    old_tmp = tmp_path / "e.1234.tmp"
+    old_tmp.write_bytes(b"x" * 1000)
+    old = now - cache.TMP_FILE_GRACE - 1
+    os.utime(str(old_tmp), (old, old))
+
+    c._evict()
+    assert sorted(os.listdir(str(tmp_path))) == ["b", "c", "d.1234.tmp"]
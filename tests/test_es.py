@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+import collections
+import json
+
+import pytest
+import requests
+
+from elnok import es
+
+
+def make_hits(timestamps):
+    """
+    return: hits with the given timestamps, and a different message for each
+    """
+    return [{"_source": {"message": "entry %d" % i}, "sort": [ts, i]} for i, ts in enumerate(timestamps)]
+
+
+def resume(hits, position):
+    """
+    Simulates a search continued from the position: the server returns again
+    all the hits from the timestamp of the position
+    return: the hits returned
+    """
+    batches = es.batched([h for h in hits if h["sort"][0] >= position.ts], 2)
+    return [h for b in es._skip_seen(batches, position.ts, position.get_keys()) for h in b]
+
+
+@pytest.mark.parametrize("n_done", range(1, 9))
+def test_resume_position(n_done):
+    """
+    After any number of hits returned, resuming the search returns exactly the
+    remaining hits, even when several hits have the same timestamp
+    """
+    hits = make_hits([10, 20, 20, 20, 30, 30, 40, 50, 50])
+    position = es.SearchPosition()
+    for hit in hits[:n_done]:
+        position.add(hit)
+
+    # The position is stored in a file, as JSON
+    position = es.SearchPosition.from_dict(json.loads(json.dumps(position.to_dict())))
+    assert resume(hits, position) == hits[n_done:]
+
+
+def test_resume_duplicates():
+    """
+    Hits with the same content and timestamp are only skipped as many times as
+    they were returned
+    """
+    hits = [{"_source": {"message": "same"}, "sort": [10, i]} for i in range(4)] + make_hits([20])
+    position = es.SearchPosition()
+    for hit in hits[:2]:
+        position.add(hit)
+    assert position.get_keys() == {es.get_hit_key(hits[0]): 2}
+    assert resume(hits, position) == hits[2:]
+
+
+def test_position_new_timestamp():
+    position = es.SearchPosition()
+    assert position.ts is None
+    hits = make_hits([10, 10, 20])
+    for hit in hits:
+        position.add(hit)
+    assert position.ts == 20
+    # Only the hits at the last timestamp are needed
+    assert position.get_keys() == {es.get_hit_key(hits[2]): 1}
+
+
+def test_skip_seen_stops_at_next_timestamp():
+    hits = make_hits([10, 10, 20])
+    # A hit of the next timestamp with the same key as a seen one is not skipped
+    seen = collections.Counter({es.get_hit_key(hits[0]): 1, es.get_hit_key(hits[2]): 1})
+    batches = list(es._skip_seen([hits[:1], hits[1:]], 10, seen))
+    assert batches == [[], hits[1:]]
+
+
+@pytest.mark.parametrize("ex, expected", [
+    (es.SearchError({"type": "search_phase_execution_exception",
+                     "root_cause": [{"type": "search_context_missing_exception"}]}, 404), True),
+    (es.SearchError({"type": "es_rejected_execution_exception"}, 429), True),
+    (es.SearchError({"type": "parsing_exception"}, 400), False),
+    (es.SearchError("Internal error", 503), True),
+    (requests.ConnectionError(), True),
+    (requests.HTTPError(), False),
+    (ValueError(), False),
+])
+def test_is_temporary_error(ex, expected):
+    assert es.is_temporary_error(ex) == expected
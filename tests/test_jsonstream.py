@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+import json
+
+import pytest
+
+from elnok import jsonstream
+
+RESPONSE = {
+    "pit_id": "abc==",
+    "took": 12,
+    "hits": {
+        "total": {"value": 3, "relation": "eq"},
+        "hits": [
+            {"_source": {"message": "first", "level": "INFO"}, "sort": [1618232266306, 0]},
+            {"_source": {"message": "sécond \"quoted\" \\ {[,:]}", "level": "DEBUG"}, "sort": [1618232266307, 1]},
+            {"_source": {"message": "☃ tab\there", "nested": {"a": [1, 2.5, None, True]}},
+             "sort": [1618232266308, 2]},
+        ],
+        "max_score": None,
+    },
+}
+
+
+def split_chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1000000])
+def test_iter_hits_chunk_boundaries(size):
+    """
+    The hits are the same, wherever the chunks are cut (including in the middle
+    of the multi-byte characters and of the escape sequences)
+    """
+    data = json.dumps(RESPONSE, ensure_ascii=False).encode("utf-8")
+    meta = {}
+    hits = list(jsonstream.iter_hits(split_chunks(data, size), meta))
+    assert hits == RESPONSE["hits"]["hits"]
+    assert meta["pit_id"] == "abc=="
+    assert meta["took"] == 12
+    assert meta["hits"] == {"total": {"value": 3, "relation": "eq"}, "max_score": None}
+
+
+def test_iter_hits_whitespace():
+    data = json.dumps(RESPONSE, indent=2).encode("utf-8")
+    hits = list(jsonstream.iter_hits(split_chunks(data, 5), {}))
+    assert hits == RESPONSE["hits"]["hits"]
+
+
+def test_iter_hits_empty():
+    meta = {}
+    assert list(jsonstream.iter_hits([b'{"pit_id": "x", "hits": {"hits": []}}'], meta)) == []
+    assert meta == {"pit_id": "x", "hits": {}}
+
+    # When filtered, the response has no "hits" at all
+    meta = {}
+    assert list(jsonstream.iter_hits([b'{"pit_id": "x"}'], meta)) == []
+    assert meta == {"pit_id": "x"}
+
+
+def test_iter_hits_error():
+    meta = {}
+    data = b'{"error": {"type": "parsing_exception", "reason": "bad"}, "status": 400}'
+    assert list(jsonstream.iter_hits(split_chunks(data, 3), meta)) == []
+    assert meta["error"]["type"] == "parsing_exception"
+    assert meta["status"] == 400
+
+
+@pytest.mark.parametrize("data", [b'{"hits": {"hits": [{"a": 1}', b'{"hits": {"hits": [{"a": 1},,]}}', b"[]"])
+def test_iter_hits_invalid(data):
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_hits(split_chunks(data, 4), {}))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+import calendar
+from datetime import datetime
+import time
+
+import pytest
+
+from elnok import logfile
+
+LINES = [
+    "2021-04-12 14:57:46,306\tDEBUG\tlakeshore:494:\tSIM: parsing *ESR?",
+    "2021-04-12 14:57:46,306\tINFO\tlakeshore:495:\tSame time",
+    "2021-04-12 14:57:47,000\tERROR\tstage:12:\tFailed to move",
+    "Traceback (most recent call last):",
+    "  File \"stage.py\", line 12, in move",
+    "2021-04-12 14:57:48,999\tWARNING\tstage:20:\tSlow",
+    "2021-04-12 15:00:00,000\tINFO\tbackend:1:\tDone",
+]
+
+
+def ms(*args) -> int:
+    """
+    return: the time in ms since epoch of the UTC date
+    """
+    dt = datetime(*args)
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    """
+    The timestamps of the files are in local time => use UTC
+    """
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def log_path(tmp_path, utc):
+    path = tmp_path / "odemis.log"
+    # The last line is still being written
+    path.write_text("\n".join(LINES) + "\n2021-04-12 15:00:01,000\tINFO\tbac")
+    return str(path)
+
+
+def test_find(log_path):
+    with logfile.LogFile(log_path) as f:
+        assert f.find(ms(2021, 4, 12, 14, 57, 46, 306000)) == 0
+        pos = f.find(ms(2021, 4, 12, 14, 57, 46, 307000))
+        assert f._map[pos:].startswith(b"2021-04-12 14:57:47,000")
+        # In the middle of a multi-line entry
+        pos = f.find(ms(2021, 4, 12, 14, 57, 48))
+        assert f._map[pos:].startswith(b"2021-04-12 14:57:48,999")
+        assert f.find(ms(2021, 4, 12, 14, 0, 0)) == 0
+        # After the last complete entry
+        assert f.find(ms(2021, 4, 12, 15, 0, 0, 1000)) == f._size
+
+
+def test_read(log_path):
+    with logfile.LogFile(log_path) as f:
+        hits = list(f.read())
+        assert [h["_source"]["line"] for h in hits] == ["494", "495", "12", "20", "1"]
+        error = hits[2]
+        assert error["sort"] == [ms(2021, 4, 12, 14, 57, 47)]
+        assert error["_source"]["@timestamp"] == "2021-04-12T14:57:47.000Z"
+        assert error["_source"]["message"] == "Failed to move\n" + "\n".join(LINES[3:5])
+        assert error["_source"]["component"] == "odemis"
+        assert error["_source"]["subcomponent"] == "stage"
+        assert error["_file"] == log_path
+        assert set(error["_source"]) == logfile.ENTRY_FIELDS
+
+        hits = list(f.read(since=ms(2021, 4, 12, 14, 57, 47), until=ms(2021, 4, 12, 14, 57, 48, 999000)))
+        assert [h["_source"]["line"] for h in hits] == ["12", "20"]
+
+
+def test_read_empty(tmp_path, utc):
+    path = tmp_path / "empty.log"
+    path.write_text("")
+    with logfile.LogFile(str(path)) as f:
+        assert list(f.read()) == []
+
+
+def server_hit(ts, message, **source):
+    source["message"] = message
+    return {"_source": source, "sort": [ts, 0]}
+
+
+def file_hit(ts, message):
+    return {"_source": {"message": message, "level": "INFO"}, "sort": [ts], logfile.FILE_FIELD: "odemis.log"}
+
+
+def test_merge_unique():
+    batches = [[server_hit(10, "a"), server_hit(20, "b\nTraceback"), server_hit(20, "b")], [server_hit(30, "c")]]
+    # The entries up to 30 are already on the server, but not the ones after
+    stream = [file_hit(10, "a"), file_hit(20, "b\nTraceback (as in the file)"), file_hit(20, "b"),
+              file_hit(20, "new"), file_hit(30, "c"), file_hit(30, "c"), file_hit(40, "d")]
+    hits = list(logfile._merge_unique(batches, [iter(stream)], None))
+    assert [(h["sort"][0], h["_source"]["message"], logfile.FILE_FIELD in h) for h in hits] == [
+        (10, "a", False),
+        (20, "b\nTraceback", False),
+        (20, "b", False),
+        (20, "new", True),
+        (30, "c", False),
+        (30, "c", True),  # Twice in the file, but only once on the server
+        (40, "d", True),
+    ]
+
+
+def test_merge_unique_fields():
+    batches = [[server_hit(10, "a", level="INFO"), server_hit(20, "b", level="ERROR")]]
+    stream = [file_hit(10, "a"), file_hit(30, "c")]
+    # The message is only used to recognize the entries => not returned
+    hits = list(logfile._merge_unique(batches, [iter(stream)], {"level"}))
+    assert [h["_source"] for h in hits] == [{"level": "INFO"}, {"level": "ERROR"}, {"level": "INFO"}]
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of ELnoK.
+
+ELnoK is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+ELnoK is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+ELnoK. If not, see http://www.gnu.org/licenses/.
+'''
+import re
+
+import pytest
+
+from elnok import query
+
+FIELD_TYPES = {
+    "level": "keyword",
+    "message": "text",
+    "message.keyword": "keyword",
+    "path": "text",  # No keyword version
+    "line": "long",
+}
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    ("abc", "abc"),
+    ("a.*b", "a.*b"),
+    ("^foo$", "foo"),
+    ("foo|bar", "foo|bar"),
+    ("(ab)+c?", "(ab)+c?"),
+    ("a{2,}", "a{2,}"),
+    ("a{,3}", "a{0,3}"),
+    ("x{", "x\\{"),
+    ("[a-z0-9_]+", "[a-z0-9_]+"),
+    ("[^abc]", "[^abc]"),
+    ("[]a]", "[\\]a]"),
+    ("\\d+", "[0-9]+"),
+    ("[\\d]", "[0-9]"),
+    ("\\.", "\\."),
+    # Special characters only for the server
+    ("a#b", "a\\#b"),
+    ("a@b<c>", "a\\@b\\<c\\>"),
+    ('"q"~', '\\"q\\"\\~'),
+    ("[a&b]", "[a\\&b]"),
+])
+def test_to_lucene_regexp(pattern, expected):
+    assert query.to_lucene_regexp(pattern) == expected
+
+
+@pytest.mark.parametrize("pattern", ["\\w+", "\\bword", "a*?", "a+?", "a{2}?", "(?i)abc", "a^b", "foo$bar", "\\n"])
+def test_to_lucene_regexp_unsupported(pattern):
+    assert query.to_lucene_regexp(pattern) is None
+
+
+@pytest.mark.parametrize("pattern", ["a.*b", "^foo$", "foo|bar", "(ab)+c?", "a{,3}", "x{", "[]a]", "\\d+",
+                                     "a#b", "a@b<c>", '"q"~', "[a&b]"])
+def test_to_lucene_regexp_same_matches(pattern):
+    """
+    For the values tested here, the converted expression (also valid in Python)
+    matches the same values
+    """
+    converted = re.compile(query.to_lucene_regexp(pattern))
+    original = re.compile(pattern)
+    for value in ["", "ab", "axb", "foo", "bar", "foobar", "ababc", "aa", "aaaa", "x{", "]", "a", "12",
+                  "1a", "a#b", "a@b<c>", '"q"~', "&", "b"]:
+        assert bool(original.fullmatch(value)) == bool(converted.fullmatch(value)), value
+
+
+def test_parse_match():
+    c = query.parse_match("message!~a=b")
+    assert (c.field, c.kind, c.value, c.negate) == ("message", "regexp", "a=b", True)
+    c = query.parse_match("level=ERR*")
+    assert (c.field, c.kind, c.value, c.negate) == ("level", "wildcard", "ERR*", False)
+    c = query.parse_match("level!=ERROR")
+    assert (c.field, c.kind, c.value, c.negate) == ("level", "match", "ERROR", True)
+    for text in ["level", "level=", "message~a(b"]:
+        with pytest.raises(ValueError):
+            query.parse_match(text)
+
+
+def plan(*matches, **kwargs):
+    return query.plan([query.parse_match(m) for m in matches], FIELD_TYPES, **kwargs)
+
+
+def test_plan_server():
+    clauses, hit_filter = plan("level=ERROR", "level=WARNING", "level!~DEB.G", "line=12")
+    assert hit_filter is None
+    assert clauses == [
+        {"terms": {"level": ["ERROR", "WARNING"]}},
+        {"match": {"line": {"query": "12"}}},
+        {"bool": {"must_not": [{"regexp": {"level": {"value": "DEB.G"}}}]}},
+    ]
+
+
+def test_plan_local():
+    # No keyword version, and regex not supported by the server
+    clauses, hit_filter = plan("path=*odemis*", "level~\\w+")
+    assert clauses == []
+    assert hit_filter.fields == {"path", "level"}
+
+
+def test_plan_keyword_long_values():
+    """
+    The patterns on a text field are evaluated on the keyword version, which
+    doesn't have the long values => they are also checked locally
+    """
+    clauses, hit_filter = plan("message=*failed*")
+    missing = {"bool": {"filter": [{"exists": {"field": "message"}}],
+                        "must_not": [{"exists": {"field": "message.keyword"}}]}}
+    assert clauses == [{"bool": {"should": [{"wildcard": {"message.keyword": {"value": "*failed*"}}}, missing],
+                                 "minimum_should_match": 1}}]
+    assert hit_filter.fields == {"message"}
+
+    # Exclusion: only checked locally
+    clauses, hit_filter = plan("message!~.*failed.*")
+    assert clauses == [{"bool": {"must_not": [{"regexp": {"message.keyword": {"value": ".*failed.*"}}}]}}]
+    assert hit_filter.fields == {"message"}
+
+    # The words are evaluated on the text field => no issue
+    clauses, hit_filter = plan("message=failed")
+    assert hit_filter is None
+
+    # Only the server (eg, for the aggregations)
+    clauses, hit_filter = plan("message=*failed*", check_long=False)
+    assert clauses == [{"wildcard": {"message.keyword": {"value": "*failed*"}}}]
+    assert hit_filter is None
+
+
+def test_hit_filter():
+    hit_filter = query.HitFilter([query.parse_match(m) for m in
+                                  ("level=ERROR", "level=WARN*", "message~.*fail.*", "message!=timeout")])
+
+    def hit(**source):
+        return {"_source": source}
+
+    assert hit_filter(hit(level="ERROR", message="it failed"))
+    assert hit_filter(hit(level="WARNING", message="failure\nwith traceback"))
+    assert not hit_filter(hit(level="INFO", message="it failed"))
+    assert not hit_filter(hit(level="ERROR", message="it worked"))
+    assert not hit_filter(hit(level="ERROR", message="it failed: Timeout"))
+    assert not hit_filter(hit(message="it failed"))